@@ -5,7 +5,8 @@ import os
 import time
 import atexit
 import logging
-from signal import SIGTERM
+import fff_logging
+from signal import SIGTERM, SIGHUP, SIGUSR1
 
 class Daemon:
     """
@@ -33,6 +34,8 @@ class Daemon:
         except OSError, e:
             sys.stderr.write("fork #1 failed: %d (%s)\n" % (e.errno, e.strerror))
             sys.exit(1)
+        # the parent writes what it logged so far, not us
+        fff_logging.reinitialize_after_fork()
 
         # decouple from parent environment
         os.chdir("/")
@@ -48,6 +51,7 @@ class Daemon:
         except OSError, e:
             sys.stderr.write("fork #2 failed: %d (%s)\n" % (e.errno, e.strerror))
             sys.exit(1)
+        fff_logging.reinitialize_after_fork()
 
         # redirect standard file descriptors
         ##sys.stdout.flush()
@@ -121,6 +125,33 @@ class Daemon:
                 print str(err)
                 sys.exit(1)
 
+    def reload(self):
+        """
+        Ask the daemon to reload its configuration (with SIGHUP)
+        """
+        self._send_signal(SIGHUP)
+
+    def profile(self):
+        """
+        Ask the daemon to profile itself for a while (with SIGUSR1)
+        """
+        self._send_signal(SIGUSR1)
+
+    def _send_signal(self, signal_number):
+        try:
+            pf = file(self.pidfile,'r')
+            pid = int(pf.read().strip())
+            pf.close()
+        except IOError:
+            pid = None
+
+        if not pid:
+            message = "pidfile %s does not exist. Daemon not running?\n"
+            sys.stderr.write(message % self.pidfile)
+            sys.exit(1)
+
+        os.kill(pid, signal_number)
+
     def restart(self):
         """
         Restart the daemon
@@ -176,7 +207,9 @@ class Daemon:
 
     def _try_get_log_filename(self):
         for handler in logging.getLogger('').__dict__['handlers']:
-            if handler.__class__.__name__ == 'FileHandler':
+            # The file handler might be wrapped, e.g. by a queue handler
+            handler = getattr(handler, 'target_handler', handler)
+            if hasattr(handler, 'baseFilename'):
                 return handler.baseFilename
 
     def run(self):
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+
+# Compressed source runs: instead of a run directory, the SourceDir can hold
+# the source run as one zip archive, <SourceRun>.zip, with the files of the
+# run in it. A big source run then takes a lot less space (and RAM, if the
+# SourceDir is on the ramdisk), at the cost of decompressing the data files
+# when we publish them.
+#
+# When we open the archive, we read its index (the central directory) once
+# and keep, per member, where its data starts in the archive, its sizes and
+# checksum. Publishing a data file then seeks to its data and decompresses it
+# in chunks straight into the output file, so the data file is never
+# completely in memory. The json files are small and read whole, once, when
+# building the source index (see fff_source_index). Every publication opens
+# the archive by itself, so the emission workers can decompress at the same
+# time (zlib does not hold the interpreter lock while it works).
+#
+# A run directory is always preferred over an archive of the same run.
+#
+# To compress a source run:
+#   python fff_archive.py /fff/output/playback_files/run247398
+# which writes /fff/output/playback_files/run247398.zip (or give the archive
+# as the second argument).
+
+import os
+import sys
+import zlib
+import time
+import struct
+import zipfile
+
+ARCHIVE_EXTENSION = '.zip'
+
+# The local header in front of the data of every member:
+LOCAL_HEADER_FORMAT = '<4s2B4HL2L2H'
+LOCAL_HEADER_SIZE = struct.calcsize(LOCAL_HEADER_FORMAT)
+LOCAL_HEADER_SIGNATURE = 'PK\003\004'
+
+CHUNK_SIZE = 1 << 20
+
+def get_archive_path(run_path):
+    return run_path + ARCHIVE_EXTENSION
+
+def find_archive(run_path):
+    # Gives the archive of the run, if there is one and no run directory.
+    archive_path = get_archive_path(run_path)
+    if not os.path.isdir(run_path) and os.path.isfile(archive_path):
+        return archive_path
+    return None
+
+def list_members(archive_path):
+    # The file names in the archive, without reading any of them.
+    with open(archive_path, 'rb') as archive_file:
+        return [os.path.basename(name)
+                for name in zipfile.ZipFile(archive_file).namelist()]
+
+
+class ArchiveMember(object):
+
+    def __init__(self, info, data_offset):
+        self.compress_type = info.compress_type
+        self.compress_size = info.compress_size
+        self.file_size = info.file_size
+        self.crc = info.CRC
+        self.mtime = time.mktime(info.date_time + (0, 0, -1))
+        self.data_offset = data_offset
+
+
+class SourceArchive(object):
+
+    def __init__(self, archive_path):
+        self.archive_path = archive_path
+        # Per file name (without directories):
+        self.members = {}
+        with open(archive_path, 'rb') as archive_file:
+            for info in zipfile.ZipFile(archive_file).infolist():
+                if info.filename.endswith('/'):
+                    continue
+                if info.compress_type not in [zipfile.ZIP_STORED,
+                                              zipfile.ZIP_DEFLATED]:
+                    raise Exception('%s in %s is compressed with an '
+                                    'unsupported method.'
+                                    % (info.filename, archive_path))
+                # The data starts after the local header, which has its own
+                # length for the extra field.
+                archive_file.seek(info.header_offset)
+                header = struct.unpack(LOCAL_HEADER_FORMAT,
+                                       archive_file.read(LOCAL_HEADER_SIZE))
+                if header[0] != LOCAL_HEADER_SIGNATURE:
+                    raise Exception('Bad local header for %s in %s.'
+                                    % (info.filename, archive_path))
+                data_offset = info.header_offset + LOCAL_HEADER_SIZE + \
+                              header[10] + header[11]
+                self.members[os.path.basename(info.filename)] = \
+                    ArchiveMember(info, data_offset)
+
+    def get_size(self, name):
+        return self.members[name].file_size
+
+    def get_mtime(self, name):
+        return self.members[name].mtime
+
+    def read(self, name):
+        chunks = []
+        self.decompress(name, chunks.append)
+        return ''.join(chunks)
+
+    def extract(self, name, target_path):
+        with open(target_path, 'wb') as target_file:
+            self.decompress(name, target_file.write)
+
+    def decompress(self, name, write):
+        # Gives the content of the member to write, chunk by chunk, and
+        # checks it.
+        member = self.members[name]
+        decompressor = None
+        if member.compress_type == zipfile.ZIP_DEFLATED:
+            decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        crc = 0
+        size = 0
+        with open(self.archive_path, 'rb') as archive_file:
+            archive_file.seek(member.data_offset)
+            remaining = member.compress_size
+            while remaining > 0:
+                chunk = archive_file.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    raise Exception('%s is truncated.' % self.archive_path)
+                remaining -= len(chunk)
+                # A highly compressed chunk can expand to far more than its
+                # size, so we never decompress more than a chunk at a time.
+                while chunk:
+                    if decompressor:
+                        output = decompressor.decompress(chunk, CHUNK_SIZE)
+                        chunk = decompressor.unconsumed_tail
+                    else:
+                        output, chunk = chunk, ''
+                    crc = zlib.crc32(output, crc)
+                    size += len(output)
+                    write(output)
+        if decompressor:
+            chunk = decompressor.flush()
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            write(chunk)
+        if size != member.file_size or crc & 0xffffffff != member.crc:
+            raise Exception('%s in %s is corrupt.' % (name,
+                                                      self.archive_path))
+
+
+def create_archive(run_path, archive_path=None):
+    # Compresses all the files of the run directory (except the hidden ones)
+    # into an archive. Gives the path of the archive.
+    if not archive_path:
+        archive_path = get_archive_path(run_path.rstrip('/'))
+    temporary_path = os.path.join(os.path.dirname(archive_path),
+                                  '.%s.tmp' % os.path.basename(archive_path))
+    archive = zipfile.ZipFile(temporary_path, 'w', zipfile.ZIP_DEFLATED,
+                              allowZip64=True)
+    try:
+        for file_name in sorted(os.listdir(run_path)):
+            file_path = os.path.join(run_path, file_name)
+            if file_name.startswith('.') or not os.path.isfile(file_path):
+                continue
+            archive.write(file_path, file_name)
+    finally:
+        archive.close()
+    os.rename(temporary_path, archive_path)
+    return archive_path
+
+if __name__ == "__main__":
+    if len(sys.argv) not in [2, 3]:
+        print "usage: %s run_dir [archive]" % sys.argv[0]
+        sys.exit(2)
+    run_path = sys.argv[1]
+    archive_path = create_archive(run_path, (sys.argv[2:] or [None])[0])
+    run_bytes = sum([os.path.getsize(os.path.join(run_path, file_name))
+                     for file_name in os.listdir(run_path)])
+    print "Wrote %s: %.1f MB, from %.1f MB." % (
+        archive_path, os.path.getsize(archive_path) / 1e6, run_bytes / 1e6)
@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+
+# The FFF Simulator benchmark measures how fast the simulator can emit
+# lumisections, without the need for a real BU/FU pair.
+#
+# The simulator runs in this process, against a target directory (preferably
+# on a tmpfs, like the real ramdisk), with generated source data. hltd and
+# ssh are replaced by local stand-ins: small scripts named "service" and "ssh"
+# that are put in front of the PATH. The stand-in ssh executes the command
+# locally.
+#
+# The source data is one of:
+# - synthetic: The synthetic source (see fff_synthetic).
+# - dir:       A source run directory, with SOURCE_LUMIS lumisections of
+#              data files per stream (generated like the synthetic data).
+# - archive:   The same source run, compressed (see fff_archive).
+#
+# For every combination of the given file sizes, lumisection periods, amounts
+# of emission workers, publish modes, lookahead depths and sources we
+# simulate one run (with the given amount of streams) and report:
+# - the emission latency per lumisection (percentiles, in ms),
+# - the throughput in MB/s and files/s,
+# - how late the lumisections were, compared to the schedule,
+# - the CPU time used per lumisection,
+# - the space (memory, on a tmpfs) taken by the source data.
+# Comparing dir and archive shows the memory a compressed source run saves
+# and the CPU it costs, which depends on how well the data compresses: the
+# repeat generation hardly compresses, real streamer files (use them with
+# --template) do better.
+#
+# The log of the simulator is written to fff_benchmark.log in the target
+# directory, which is left there after the benchmark.
+#
+# Usage (as root is not needed):
+#   python fff_benchmark.py --target /dev/shm/fff_benchmark \
+#       --sizes 1,10,50 --periods 1,0.2 --workers 1,3 --lumis 20 --streams 3 \
+#       --lookahead 0,2 --sources dir,archive
+
+import os
+import sys
+import shutil
+import json
+import resource
+import ConfigParser
+from optparse import OptionParser
+from fff_simulator import FFFSimulator
+from fff_synthetic import generate_data_file
+import fff_archive
+import fff_logging
+
+SERVICE_STAND_IN = '''#!/bin/sh
+# Stand-in for "service hltd start|stop|status"
+case "$2" in
+    start) echo "Starting hltd instance main :              [  OK  ]" ;;
+    stop) echo "Stopping hltd instance main: o.o.          [  OK  ]" ;;
+    status) echo "hltd is running" ;;
+esac
+'''
+
+SSH_STAND_IN = '''#!/bin/sh
+# Stand-in for "ssh [-o option]... host command": runs the command locally
+while [ "$1" = "-o" ]; do shift 2; done
+shift
+exec sh -c "$*"
+'''
+
+# The streams of the synthetic source, with the part of the file size that
+# goes to each stream. Histograms are a lot smaller than the streamer files.
+STREAM_SHARES = [('streamDQM', 0.6), ('streamDQMHistograms', 0.1),
+                 ('streamDQMCalibration', 0.3)]
+
+SOURCES = ['synthetic', 'dir', 'archive']
+
+# The lumisections per stream of the dir and archive sources. The simulation
+# starts over with the first one after the last.
+SOURCE_LUMIS = 5
+
+def get_stream_shares(stream_amount):
+    # With another amount of streams than the usual 3, they all get the same
+    # part of the file size.
+    if stream_amount == len(STREAM_SHARES):
+        return STREAM_SHARES
+    return [('streamBenchmark%d' % stream_number, 1. / stream_amount)
+            for stream_number in range(stream_amount)]
+
+def install_stand_ins(bin_dir):
+    if not os.path.exists(bin_dir):
+        os.makedirs(bin_dir)
+    for name, content in [('service', SERVICE_STAND_IN),
+                          ('ssh', SSH_STAND_IN)]:
+        path = os.path.join(bin_dir, name)
+        with open(path, 'w') as stand_in:
+            stand_in.write(content)
+        os.chmod(path, 0755)
+    os.environ['PATH'] = bin_dir + os.pathsep + os.environ.get('PATH', '')
+
+def create_source_run(source_dir, size_mb, lumis, generation,
+                      stream_amount, template_file='', archive=False):
+    # A source run like a real one, with a data file and a json file per
+    # stream and lumisection.
+    run_dir = os.path.join(source_dir, 'run100000')
+    os.makedirs(run_dir)
+    for stream_name, share in get_stream_shares(stream_amount):
+        file_size = int(size_mb * share * 1e6)
+        for lumi_number in range(1, min(lumis, SOURCE_LUMIS) + 1):
+            base_name = 'run100000_ls%04d_%s_mrg-benchmark' % (lumi_number,
+                                                                stream_name)
+            generate_data_file(os.path.join(run_dir, base_name + '.dat'),
+                               file_size, generation, template_file)
+            json_info = {'data': ['1000', '1000', '0', base_name + '.dat',
+                                  str(file_size), '0', '-1', '0']}
+            with open(os.path.join(run_dir, base_name + '.jsn'),
+                      'w') as json_file:
+                json.dump(json_info, json_file)
+    if archive:
+        fff_archive.create_archive(run_dir)
+        shutil.rmtree(run_dir)
+
+def get_disk_usage(path):
+    # The bytes the files really take (sparse files take nothing).
+    usage = 0
+    for dir_path, dir_names, file_names in os.walk(path):
+        for file_name in file_names:
+            usage += os.lstat(os.path.join(dir_path,
+                                           file_name)).st_blocks * 512
+    return usage
+
+def write_configuration(path, work_dir, size_mb, period, workers,
+                        publish_mode, lumis, generation, stream_amount,
+                        lookahead=0, source='synthetic', template_file=''):
+    config = ConfigParser.RawConfigParser()
+    config.optionxform = str
+    config.add_section('General')
+    for option, value in [('SourceRun', 'run100000'),
+                          ('SourceDir', os.path.join(work_dir, 'source')),
+                          ('AlternativeSourceDirs', ''),
+                          ('RamdiskDir', os.path.join(work_dir, 'ramdisk')),
+                          ('FUDataDir', os.path.join(work_dir, 'fu')),
+                          ('FUHostName', 'fu-benchmark'),
+                          ('RunKey', 'pp_run'),
+                          ('SecondsPerLumi', period),
+                          ('PublishMode', publish_mode),
+                          ('EmissionWorkers', workers),
+                          ('LookaheadDepth', lookahead),
+                          ('LumisToSkip', ''),
+                          ('LumisPerRun', lumis),
+                          ('SecondsBeforeFirstLumi', 0),
+                          # The stand-in hltd watches nothing:
+                          ('ReadinessTimeout', 0),
+                          ('NumberOfRuns', 1),
+                          ('MetricsPort', 0)]:
+        config.set('General', option, value)
+    stream_shares = get_stream_shares(stream_amount)
+    config.add_section('Streams')
+    config.set('Streams', 'Streams', ', '.join([stream_name for stream_name,
+                                                share in stream_shares]))
+    if source == 'synthetic':
+        config.add_section('Synthetic')
+        config.set('Synthetic', 'Synthetic', 'true')
+        config.set('Synthetic', 'SyntheticDir',
+                   os.path.join(work_dir, 'source'))
+        config.set('Synthetic', 'RunNumber', 100000)
+        config.set('Synthetic', 'Generation', generation)
+        config.set('Synthetic', 'TemplateFile', template_file)
+        for stream_name, share in stream_shares:
+            config.set('Synthetic', stream_name,
+                       '%f, %d' % (size_mb * share, lumis))
+    with open(path, 'w') as config_file:
+        config.write(config_file)
+
+def percentile(values, fraction):
+    if not values:
+        return 0.
+    ordered = sorted(values)
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+def benchmark(work_dir, size_mb, period, workers, publish_mode, lumis,
+              generation, stream_amount, lookahead=0, source='synthetic',
+              template_file=''):
+    shutil.rmtree(work_dir, ignore_errors=True)
+    for sub_dir in ['ramdisk', 'fu', 'source']:
+        os.makedirs(os.path.join(work_dir, sub_dir))
+    if source != 'synthetic':
+        create_source_run(os.path.join(work_dir, 'source'), size_mb, lumis,
+                          generation, stream_amount, template_file,
+                          source == 'archive')
+    config_path = os.path.join(work_dir, 'fff_simulator.conf')
+    write_configuration(config_path, work_dir, size_mb, period, workers,
+                        publish_mode, lumis, generation, stream_amount,
+                        lookahead, source, template_file)
+    cfg = FFFSimulator.load_configuration(config_path)
+    usage_before = resource.getrusage(resource.RUSAGE_SELF)
+    rates = FFFSimulator.simulate(cfg)
+    usage_after = resource.getrusage(resource.RUSAGE_SELF)
+    cpu_seconds = (usage_after.ru_utime - usage_before.ru_utime +
+                   usage_after.ru_stime - usage_before.ru_stime)
+    emission_times = list(rates.emission_times)
+    emission_seconds = max(sum(emission_times), 1e-9)
+    lateness = list(rates.lateness)
+    return {'size': size_mb, 'period': period, 'workers': workers,
+            'mode': publish_mode, 'lookahead': lookahead,
+            'source': source, 'lumis': rates.lumis,
+            'p50': 1e3 * percentile(emission_times, 0.5),
+            'p90': 1e3 * percentile(emission_times, 0.9),
+            'p99': 1e3 * percentile(emission_times, 0.99),
+            'max': 1e3 * max(emission_times or [0.]),
+            # Throughput while writing (not counting the idle time):
+            'mb_per_s': rates.bytes / 1e6 / emission_seconds,
+            'files_per_s': rates.files / emission_seconds,
+            'mean_late': 1e3 * sum(lateness) / max(len(lateness), 1),
+            'max_late': 1e3 * max(lateness or [0.]),
+            'cpu_per_lumi': 1e3 * cpu_seconds / max(rates.lumis, 1),
+            'source_mb': get_disk_usage(os.path.join(work_dir,
+                                                     'source')) / 1e6}
+
+HEADER = ('%8s %7s %7s %10s %5s %9s %5s | %8s %8s %8s %8s | %9s %8s | '
+          '%9s %9s | %9s %9s'
+          % ('size MB', 'period', 'workers', 'mode', 'ahead', 'source',
+             'lumis', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms', 'MB/s',
+             'files/s', 'late ms', 'maxlate', 'cpu ms/ls', 'source MB'))
+ROW = ('%(size)8.1f %(period)7.2f %(workers)7d %(mode)10s %(lookahead)5d '
+       '%(source)9s %(lumis)5d | '
+       '%(p50)8.1f %(p90)8.1f %(p99)8.1f %(max)8.1f | %(mb_per_s)9.1f '
+       '%(files_per_s)8.1f | %(mean_late)9.1f %(max_late)9.1f | '
+       '%(cpu_per_lumi)9.1f %(source_mb)9.1f')
+
+def parse_list(value, convert):
+    return [convert(item) for item in value.split(',') if item.strip()]
+
+if __name__ == "__main__":
+    parser = OptionParser(usage='usage: %prog [options]')
+    parser.add_option('--target', default='/dev/shm/fff_benchmark',
+                      help='work directory, preferably on a tmpfs')
+    parser.add_option('--sizes', default='1,10,50',
+                      help='total MB per lumisection, comma separated')
+    parser.add_option('--periods', default='1,0.2',
+                      help='seconds per lumisection, comma separated')
+    parser.add_option('--workers', default='1,3',
+                      help='emission workers, comma separated')
+    parser.add_option('--publish-modes', default='auto,copy',
+                      help='publish modes, comma separated')
+    parser.add_option('--lumis', type='int', default=20,
+                      help='lumisections per measurement')
+    parser.add_option('--generation', default='repeat',
+                      help='data generation (sparse, repeat, template)')
+    parser.add_option('--template', default='',
+                      help='template file for the template generation')
+    parser.add_option('--streams', type='int', default=3,
+                      help='amount of streams per lumisection')
+    parser.add_option('--lookahead', default='0',
+                      help='lookahead depths, comma separated')
+    parser.add_option('--sources', default='synthetic',
+                      help='sources (%s), comma separated'
+                           % ', '.join(SOURCES))
+    options, arguments = parser.parse_args()
+    for source in parse_list(options.sources, str):
+        if source not in SOURCES:
+            parser.error('unknown source %s' % source)
+
+    install_stand_ins(os.path.join(options.target, 'bin'))
+    work_dir = os.path.join(options.target, 'work')
+    log_file_name = os.path.join(options.target, 'fff_benchmark.log')
+    fff_logging.redirect_logging(log_file_name)
+    print HEADER
+    for size_mb in parse_list(options.sizes, float):
+        for period in parse_list(options.periods, float):
+            for workers in parse_list(options.workers, int):
+                for publish_mode in parse_list(options.publish_modes, str):
+                    for lookahead in parse_list(options.lookahead, int):
+                        for source in parse_list(options.sources, str):
+                            result = benchmark(work_dir, size_mb, period,
+                                               workers, publish_mode,
+                                               options.lumis,
+                                               options.generation,
+                                               options.streams, lookahead,
+                                               source, options.template)
+                            print ROW % result
+                            sys.stdout.flush()
+    for sub_dir in ['bin', 'work']:
+        shutil.rmtree(os.path.join(options.target, sub_dir),
+                      ignore_errors=True)
+    print 'The log is in %s.' % log_file_name
@@ -0,0 +1,124 @@
+# Checkpoints: after every lumisection we save where the simulation is (the
+# run and lumisection, the position of every stream in the source run and,
+# when replaying, the volume we still owe the trace, see fff_trace) and when
+# the next lumisection is due. When the daemon is started with Resume (or with
+# "service fff_simulator resume"), it continues from there:
+# - If the run of the checkpoint is still on the ramdisk (e.g. the daemon
+#   crashed or was restarted), we neither clean the ramdisk nor restart hltd
+#   (we only start it where it is not running). The run continues with the
+#   next lumisection, at its time if that is still to come, otherwise right
+#   away: the lumisections we missed while we were down are not caught up.
+# - Otherwise (e.g. after a reboot emptied the ramdisk), we start as usual,
+#   but with the run after the one of the checkpoint, and the streams go on
+#   where they were.
+# A checkpoint of another source run or of other streams is ignored.
+#
+# The checkpoint is a small json file. It is written under a temporary name
+# and renamed, so that a crash does not leave a partial checkpoint behind.
+# Flushing it to disk on every lumisection would hold up the simulation, so
+# we only do that at the end of a run: after a reboot we may go on from the
+# end of the previous run, or find no usable checkpoint (and start over).
+# It should not be on the ramdisk. Its directory is created at startup; if
+# that fails, we go on without checkpoints.
+
+import os
+import json
+import time
+import errno
+import logging
+import fff_os_operations
+
+class Checkpoint(object):
+
+    def __init__(self, checkpoint_file, source_run, stream_names):
+        self.checkpoint_file = checkpoint_file
+        self.source_run = source_run
+        self.stream_names = stream_names
+        self.saved = 0
+
+    def prepare(self):
+        # Creates the directory of the checkpoint, if needed. Tells whether
+        # we can save checkpoints there.
+        directory = os.path.dirname(self.checkpoint_file)
+        try:
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory, 0755)
+        except OSError, error:
+            logging.error('Could not create the directory of checkpoint %s, '
+                          'going on without checkpoints: %s'
+                          % (self.checkpoint_file, error))
+            return False
+        return True
+
+    def load(self):
+        # Gives the saved state, or None if there is none we can use.
+        try:
+            with open(self.checkpoint_file, 'r') as checkpoint_file:
+                state = json.load(checkpoint_file)
+        except IOError, error:
+            if error.errno != errno.ENOENT:
+                logging.error('Could not read checkpoint %s: %s'
+                              % (self.checkpoint_file, error))
+            return None
+        except ValueError, error:
+            logging.error('Ignoring unreadable checkpoint %s: %s'
+                          % (self.checkpoint_file, error))
+            return None
+        if state.get('source_run') != self.source_run or \
+           state.get('streams') != self.stream_names:
+            logging.warning('Ignoring checkpoint %s, it is of source run %s '
+                            'with streams %s.' % (self.checkpoint_file,
+                                                  state.get('source_run'),
+                                                  state.get('streams')))
+            return None
+        return state
+
+    def save(self, run_number, lumi_number, run_ended, positions, carry,
+             scheduler):
+        # Called after the lumisection (or the run) is done. The positions
+        # and the carry are those for the next lumisection to publish (see
+        # FFFSimulator.get_planning_state). Only the checkpoint at the end
+        # of a run is flushed to disk.
+        state = {'source_run': self.source_run,
+                 'streams': self.stream_names,
+                 'run_number': run_number,
+                 'lumi_number': lumi_number,
+                 'run_ended': run_ended,
+                 'positions': positions,
+                 'carry': carry,
+                 'next_deadline_time': scheduler.get_deadline_time()}
+        temporary_path = fff_os_operations.get_temporary_path(
+                             self.checkpoint_file)
+        try:
+            with open(temporary_path, 'w') as checkpoint_file:
+                json.dump(state, checkpoint_file)
+            fff_os_operations.commit_file(temporary_path,
+                                          self.checkpoint_file,
+                                          fsync=run_ended)
+            self.saved += 1
+        except (IOError, OSError), error:
+            logging.error('Could not save checkpoint %s: %s'
+                          % (self.checkpoint_file, error))
+
+    def restore(self, state, streams, replay=None):
+        # Puts the streams (and the replay) where the checkpoint left them.
+        # The source run may have changed in the meantime, so the positions
+        # may not all exist anymore.
+        for stream, position in zip(streams, state['positions']):
+            if len(stream):
+                stream.position = position % len(stream)
+        if replay and state['carry'] and \
+           len(state['carry']) == len(replay.carry):
+            replay.carry = list(state['carry'])
+
+    def restore_schedule(self, state, scheduler):
+        # The next step is due when it was due before the restart, or now if
+        # that passed already.
+        missed = time.time() - state['next_deadline_time']
+        if missed > 0:
+            logging.info('Resuming %.1f s after the next step was due, what '
+                         'we missed in the meantime is not caught up.'
+                         % missed)
+            scheduler.start()
+        else:
+            scheduler.set_deadline_time(state['next_deadline_time'])
@@ -0,0 +1,243 @@
+# Cleaning up the runs of earlier simulations before we start: the run
+# directories (and their .run*.global files) on the ramdisk and in the data
+# directory of every FU. After days of simulating there can be hundreds of
+# runs with thousands of files each, so:
+# - On the ramdisk, CleanupWorkers threads delete the run directories at the
+#   same time (deleting files mostly waits for the kernel, so threads do
+#   help). We count the files and bytes we free (see get_reclaimable_size).
+# - On every FU, everything is done by one remote command (all the FUs at the
+#   same time, see on_hosts), which reports the runs and files it deleted as
+#   well. It counts the files as it deletes them, rather than going through
+#   the runs beforehand, so it does not know how many bytes it freed.
+# - With BackgroundCleanup, the run directories are only renamed into a
+#   hidden trash directory next to them, which takes no time, and deleted
+#   from there while the simulation starts. hltd does not look at hidden
+#   directories. A deletion that did not finish (e.g. because we were
+#   stopped) is finished at the next start.
+# Files that disappear while we delete them (e.g. deleted by hltd) are fine,
+# other errors are logged and do not stop the cleanup.
+
+import os
+import re
+import stat
+import time
+import errno
+import pipes
+import logging
+import tempfile
+import threading
+from multiprocessing.pool import ThreadPool
+import fff_os_operations
+from fff_retention import get_reclaimable_size
+from fff_os_operations import RUN_DIR_PATTERN
+
+TRASH_DIR_NAME = '.fff_simulator_trash'
+
+GLOBAL_FILE_PATTERN = re.compile(r'^\.run\d+\.global$')
+
+# The remote command, executed in the data directory of the FU. It ends with
+# a line telling what it did: "deleted <runs> <files>" or "moved <runs>".
+# rm -v tells every file and directory it removed, in the C locale as
+# "removed '<file>'" and "removed directory '<directory>'".
+REMOTE_FIND_RUNS = ("runs=$(find . -mindepth 1 -maxdepth 1 -type d "
+                    "-regextype posix-extended -regex '\\./run[0-9]+')\n")
+REMOTE_DELETE = ("cd %(fu_data_dir)s || exit 1\n" + REMOTE_FIND_RUNS +
+                 "if [ -n \"$runs\" ]; then\n"
+                 "    files=$(LC_ALL=C rm -rfv $runs | "
+                 "grep -vc '^removed directory')\n"
+                 "fi\n"
+                 "echo deleted $(echo $runs | wc -w) ${files:-0}\n")
+REMOTE_MOVE_ASIDE = ("cd %(fu_data_dir)s || exit 1\n" + REMOTE_FIND_RUNS +
+                     "if [ -n \"$runs\" ]; then\n"
+                     "    trash=%(trash_dir)s/$(date +%%s%%N)\n"
+                     "    mkdir -p $trash && mv $runs $trash/\n"
+                     "fi\n"
+                     "if [ -d %(trash_dir)s ]; then\n"
+                     "    nohup rm -rf %(trash_dir)s < /dev/null > /dev/null "
+                     "2>&1 &\n"
+                     "fi\n"
+                     "echo moved $(echo $runs | wc -w)\n")
+
+class CleanupReport(object):
+
+    def __init__(self, target):
+        self.target = target # For logging
+        self.runs = 0
+        self.files = 0
+        self.bytes = 0 # None if we don't know
+        self.errors = 0
+        self.start_time = time.time()
+        self.seconds = 0.
+
+    def add(self, files, bytes, errors=0):
+        self.files += files
+        if bytes is None or self.bytes is None:
+            self.bytes = None
+        else:
+            self.bytes += bytes
+        self.errors += errors
+
+    def finish(self):
+        self.seconds = time.time() - self.start_time
+        logging.info('Cleanup of %s: %s' % (self.target, self.get_summary()))
+
+    def get_summary(self):
+        summary = 'deleted %d runs, %d files' % (self.runs, self.files)
+        if self.bytes is not None:
+            summary += ', %.1f MB' % (self.bytes / 1e6)
+        summary += ' in %.1f s' % self.seconds
+        if self.errors:
+            summary += ' (%d files could not be deleted)' % self.errors
+        return summary
+
+
+def list_directory(path):
+    # Gives (name, lstat result) for the entries of the directory. Entries
+    # that disappear while we list them are left out.
+    entries = []
+    for name in os.listdir(path):
+        try:
+            entries.append((name, os.lstat(os.path.join(path, name))))
+        except OSError, error:
+            if error.errno != errno.ENOENT:
+                raise
+    return entries
+
+def delete_tree(path):
+    # Deletes the directory with everything in it and gives the amount of
+    # files and bytes freed, and of files we could not delete.
+    files = 0
+    bytes = 0
+    errors = 0
+    try:
+        entries = list_directory(path)
+    except OSError, error:
+        if error.errno != errno.ENOENT:
+            logging.error('Could not list %s: %s' % (path, error))
+            errors += 1
+        return files, bytes, errors
+    for name, entry_stat in entries:
+        entry_path = os.path.join(path, name)
+        if stat.S_ISDIR(entry_stat.st_mode):
+            tree_files, tree_bytes, tree_errors = delete_tree(entry_path)
+            files += tree_files
+            bytes += tree_bytes
+            errors += tree_errors
+            continue
+        try:
+            os.remove(entry_path)
+            files += 1
+            bytes += get_reclaimable_size(entry_path, entry_stat)
+        except OSError, error:
+            if error.errno != errno.ENOENT:
+                logging.error('Could not delete %s: %s' % (entry_path, error))
+                errors += 1
+    try:
+        os.rmdir(path)
+    except OSError, error:
+        if error.errno != errno.ENOENT:
+            logging.error('Could not delete %s: %s' % (path, error))
+    return files, bytes, errors
+
+def delete_trees(paths, workers, report):
+    # Deletes the directories, with the given amount of threads.
+    if paths:
+        pool = ThreadPool(max(min(workers, len(paths)), 1))
+        try:
+            for files, bytes, errors in pool.map(delete_tree, paths):
+                report.add(files, bytes, errors)
+        finally:
+            pool.close()
+    report.finish()
+
+def get_trash_paths(trash_dir):
+    # The run directories in the trash: each cleanup moves them into its own
+    # directory there.
+    paths = []
+    if os.path.isdir(trash_dir):
+        for batch_name, batch_stat in list_directory(trash_dir):
+            batch_dir = os.path.join(trash_dir, batch_name)
+            if stat.S_ISDIR(batch_stat.st_mode):
+                paths += [os.path.join(batch_dir, name) for name, run_stat
+                          in list_directory(batch_dir)]
+    return paths
+
+def empty_trash(trash_dir, workers, report):
+    delete_trees(get_trash_paths(trash_dir), workers, report)
+    delete_tree(trash_dir)
+
+def clean_ramdisk(ramdisk_dir, workers=4, background=False):
+    # Deletes the old run directories from the ramdisk (and what is left in
+    # the trash). In the background, we give back before they are deleted.
+    logging.info('Deleting old runs from ramdisk.')
+    report = CleanupReport(ramdisk_dir)
+    run_dirs = []
+    for name, entry_stat in list_directory(ramdisk_dir):
+        path = os.path.join(ramdisk_dir, name)
+        if GLOBAL_FILE_PATTERN.match(name):
+            try:
+                os.remove(path)
+            except OSError, error:
+                if error.errno != errno.ENOENT:
+                    raise
+        elif stat.S_ISDIR(entry_stat.st_mode) and \
+             RUN_DIR_PATTERN.match(name):
+            run_dirs.append(path)
+    report.runs = len(run_dirs)
+    trash_dir = os.path.join(ramdisk_dir, TRASH_DIR_NAME)
+    if not background:
+        run_dirs += get_trash_paths(trash_dir)
+        delete_trees(run_dirs, workers, report)
+        delete_tree(trash_dir)
+        return report
+    if run_dirs:
+        if not os.path.exists(trash_dir):
+            os.makedirs(trash_dir, 0755)
+        batch_dir = tempfile.mkdtemp(dir=trash_dir)
+        for run_dir in run_dirs:
+            os.rename(run_dir, os.path.join(batch_dir,
+                                            os.path.basename(run_dir)))
+    logging.info('Moved %d old runs aside on the ramdisk, deleting them in '
+                 'the background.' % len(run_dirs))
+    cleaner = threading.Thread(target=empty_trash, name='Cleanup',
+                               args=(trash_dir, workers, report))
+    cleaner.daemon = True
+    cleaner.start()
+    return report
+
+def clean_fu_data_dirs(fu_host_names, fu_data_dir, timeout=None,
+                       background=False):
+    # All the FUs at the same time (see on_hosts).
+    return fff_os_operations.on_hosts(clean_fu_data_dir, fu_host_names,
+                                      fu_data_dir, timeout=timeout,
+                                      background=background)
+
+def clean_fu_data_dir(fu_host_name, fu_data_dir, timeout=None,
+                      background=False):
+    # Deletes the old run directories from the data dir of the FU, with one
+    # remote command. In the background, they are only moved aside when we
+    # give back.
+    logging.info('Deleting old runs from fu data dir on %s.' % fu_host_name)
+    report = CleanupReport('fu data dir on %s' % fu_host_name)
+    script = REMOTE_DELETE
+    if background:
+        script = REMOTE_MOVE_ASIDE
+    script = script % {'fu_data_dir': pipes.quote(fu_data_dir),
+                       'trash_dir': TRASH_DIR_NAME}
+    stdout, stderr = fff_os_operations.run_command(
+                         fff_os_operations.ssh_command(fu_host_name,
+                                                       [script]), timeout)
+    result = (stdout.strip().splitlines() or [''])[-1].split()
+    if not result or result[0] not in ['deleted', 'moved']:
+        raise Exception(stderr or 'No result from the cleanup.')
+    if stderr:
+        # E.g. files that disappeared while we deleted them.
+        logging.warning('Cleanup of %s: %s' % (report.target, stderr.strip()))
+    report.runs = int(result[1])
+    if result[0] == 'moved':
+        logging.info('Moved %d old runs aside on %s, deleting them in the '
+                     'background.' % (report.runs, fu_host_name))
+        return report
+    report.add(int(result[2]), None)
+    report.finish()
+    return report
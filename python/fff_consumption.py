@@ -0,0 +1,318 @@
+# The consumption observer watches what happens to the lumisections we
+# publish, so that we can see whether hltd and the DQM clients keep up with
+# the simulation, and where the time goes.
+#
+# It watches (with inotify) the run directories on the ramdisk and, if it is
+# reachable from here (e.g. mounted), the FU data dir:
+# - A lumisection of a stream counts as consumed when one of its files is
+#   read (closed without writing) or moved away. Files deleted before that
+#   (e.g. by the retention) count as expired, not as consumed. (Note that
+#   with AtomicPublish = false and FsyncMode = data or all, our own fsync of
+#   the data file looks like a read.)
+# - A lumisection counts as processed when the first output file of that
+#   lumisection appears in the FU data dir.
+# We report the latency from publication to consumption per stream, and from
+# publication to the first output.
+#
+# The backlog is the amount of published lumisections of which at least one
+# stream was not consumed yet. With MaxBacklog, the simulation waits before
+# publishing the next lumisection as long as the backlog is bigger than that
+# (the waiting counts as lateness, see OverrunPolicy).
+#
+# inotify is used through the C library.
+
+import os
+import re
+import errno
+import ctypes
+import select
+import struct
+import logging
+import threading
+from collections import deque
+from fff_scheduler import monotonic
+from fff_os_operations import RUN_DIR_PATTERN, LUMI_FILE_PATTERN
+
+IN_CLOSE_WRITE = 0x00000008
+IN_CLOSE_NOWRITE = 0x00000010
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0x00080000
+
+RUN_WATCH_MASK = IN_CLOSE_NOWRITE | IN_MOVED_FROM | IN_DELETE
+OUTPUT_WATCH_MASK = IN_CREATE | IN_MOVED_TO | IN_CLOSE_WRITE
+
+EVENT_HEADER = struct.Struct('iIII')
+
+# At most this amount of (run, lumi, stream) waits to be consumed. Beyond
+# that, the oldest count as expired, so that a consumer that never reads
+# does not make us pile them up forever:
+MAX_PENDING = 100000
+
+# The label we report the FU outputs with:
+OUTPUT_LABEL = 'output'
+
+class ConsumptionObserver(threading.Thread):
+
+    def __init__(self, fu_data_dir='', max_backlog=0, backpressure_timeout=0.,
+                 stream_names=()):
+        threading.Thread.__init__(self, name='ConsumptionObserver')
+        self.daemon = True
+        # The files of a lumisection, with the stream they belong to (see
+        # FFFSimulator.format_base_name). The longest names first, so that
+        # e.g. streamDQMHistograms is not taken for streamDQM:
+        self.stream_file_pattern = re.compile(
+            LUMI_FILE_PATTERN.pattern + '(%s)_' % '|'.join(
+                [re.escape(stream_name) for stream_name
+                 in sorted(stream_names, key=len, reverse=True)]))
+        self.max_backlog = max_backlog
+        self.backpressure_timeout = backpressure_timeout
+        self.condition = threading.Condition()
+        self.stop_event = threading.Event()
+        libc = ctypes.CDLL(None, use_errno=True)
+        self.inotify_add_watch = libc.inotify_add_watch
+        self.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                           ctypes.c_uint32]
+        self.inotify_fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.inotify_fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        # Per watch descriptor, what it watches: (path, is FU data dir, run)
+        self.watches = {}
+        # Per (run, lumi, stream) that is not consumed yet: the time it was
+        # published (None while it is being written).
+        self.pending = {}
+        # Per (run, lumi): when the lumisection was published, until its first
+        # output appeared.
+        self.pending_outputs = {}
+        # Consumptions we saw before the publication was recorded:
+        self.early_consumptions = {}
+        # Per stream (and OUTPUT_LABEL): count, total and recent latencies
+        self.consumed = {}
+        self.total_latency = {}
+        self.max_latency = {}
+        self.recent_latency = {}
+        self.expired = 0
+        self.throttled_lumis = 0
+        self.throttled_seconds = 0.
+        self.overflows = 0
+        self.observe_outputs = bool(fu_data_dir and
+                                    os.path.isdir(fu_data_dir))
+        if self.observe_outputs:
+            self.add_watch(fu_data_dir, IN_CREATE | IN_MOVED_TO | IN_ISDIR,
+                           True, 0)
+        elif fu_data_dir:
+            logging.info('FU data dir %s is not reachable from here, we only '
+                         'observe the ramdisk.' % fu_data_dir)
+
+    def add_watch(self, path, mask, is_fu_data_dir, run_number):
+        watch_descriptor = self.inotify_add_watch(self.inotify_fd, path, mask)
+        if watch_descriptor < 0:
+            logging.error('Could not watch %s: %s'
+                          % (path, os.strerror(ctypes.get_errno())))
+            return
+        self.watches[watch_descriptor] = (path, is_fu_data_dir, run_number)
+
+    def watch_run(self, run_dir, run_number):
+        # Called when the simulation created a run directory on the ramdisk.
+        self.add_watch(run_dir, RUN_WATCH_MASK, False, run_number)
+
+    def expect_lumi(self, run_number, lumi_number, stream_names):
+        # Called before the lumisection is written, so that we don't miss a
+        # consumption that happens before we recorded the publication.
+        with self.condition:
+            for stream_name in stream_names:
+                self.pending[(run_number, lumi_number, stream_name)] = None
+
+    def record_publication(self, run_number, lumi_number, stream_names):
+        # Called when all the files of the lumisection are published.
+        now = monotonic()
+        with self.condition:
+            for stream_name in stream_names:
+                key = (run_number, lumi_number, stream_name)
+                if key not in self.pending:
+                    continue
+                self.pending[key] = now
+                if key in self.early_consumptions:
+                    del self.pending[key]
+                    self.record_latency(stream_name, max(
+                        self.early_consumptions.pop(key) - now, 0.))
+            while len(self.pending) > MAX_PENDING:
+                del self.pending[min(self.pending)]
+                self.expired += 1
+            if self.observe_outputs:
+                self.pending_outputs[(run_number, lumi_number)] = now
+
+    def forget_lumi(self, run_number, lumi_number):
+        # Called when the lumisection could not be published: we don't wait
+        # for it to be consumed.
+        with self.condition:
+            for key in [key for key in self.pending
+                        if key[:2] == (run_number, lumi_number)]:
+                del self.pending[key]
+                self.early_consumptions.pop(key, None)
+            self.condition.notify_all()
+
+    def forget_run(self, run_number):
+        # Called when the run directory is deleted (see fff_retention), in
+        # case we did not watch it.
+        with self.condition:
+            self.expire_run(run_number)
+            self.condition.notify_all()
+
+    def get_backlog(self):
+        with self.condition:
+            return len(set([(run_number, lumi_number)
+                            for run_number, lumi_number, stream_name
+                            in self.pending]))
+
+    def get_unconsumed_lumis(self, max_seconds=0.):
+        # The (run, lumi) of the lumisections with a stream that was not
+        # consumed yet (see fff_retention). With max_seconds, only those
+        # published less than that long ago.
+        now = monotonic()
+        with self.condition:
+            return set([(run_number, lumi_number)
+                        for (run_number, lumi_number, stream_name),
+                            published in self.pending.items()
+                        if not max_seconds or published is None or
+                           now - published < max_seconds])
+
+    def wait_for_backlog(self):
+        # Waits as long as the backlog is too big (or until the timeout).
+        # Returns how long we waited.
+        if not self.max_backlog or self.get_backlog() <= self.max_backlog:
+            return 0.
+        start = monotonic()
+        logging.warning('Backlog of %d lumisections, waiting for the '
+                        'consumers to catch up.' % self.get_backlog())
+        with self.condition:
+            while self.get_backlog() > self.max_backlog and \
+                  not self.stop_event.is_set():
+                waited = monotonic() - start
+                if self.backpressure_timeout and \
+                   waited >= self.backpressure_timeout:
+                    logging.warning('Backlog still %d lumisections after '
+                                    '%.1f s, continuing anyway.'
+                                    % (self.get_backlog(), waited))
+                    break
+                self.condition.wait(1.)
+        waited = monotonic() - start
+        self.throttled_lumis += 1
+        self.throttled_seconds += waited
+        return waited
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                readable = select.select([self.inotify_fd], [], [], 1.)[0]
+                if not readable:
+                    continue
+                events = os.read(self.inotify_fd, 65536)
+            except (OSError, select.error), error:
+                if error.args[0] in [errno.EINTR, errno.EAGAIN]:
+                    continue
+                raise
+            now = monotonic()
+            with self.condition:
+                self.handle_events(events, now)
+                self.condition.notify_all()
+        os.close(self.inotify_fd)
+
+    def stop(self):
+        self.stop_event.set()
+        with self.condition:
+            self.condition.notify_all()
+
+    def handle_events(self, events, now):
+        offset = 0
+        while offset < len(events):
+            watch_descriptor, mask, cookie, name_length = \
+                EVENT_HEADER.unpack_from(events, offset)
+            offset += EVENT_HEADER.size
+            name = events[offset:offset + name_length].rstrip('\0')
+            offset += name_length
+            if mask & IN_Q_OVERFLOW:
+                self.overflows += 1
+                continue
+            if mask & IN_IGNORED:
+                # The directory is gone (e.g. deleted by the retention), so
+                # whatever was not consumed from it never will be:
+                path, is_fu_data_dir, run_number = \
+                    self.watches.pop(watch_descriptor, (None, True, 0))
+                if not is_fu_data_dir:
+                    self.expire_run(run_number)
+                continue
+            if watch_descriptor not in self.watches:
+                continue
+            path, is_fu_data_dir, run_number = self.watches[watch_descriptor]
+            if is_fu_data_dir and not run_number:
+                # A new run directory on the FU, we watch it for outputs:
+                run_match = RUN_DIR_PATTERN.match(name)
+                if mask & IN_ISDIR and run_match:
+                    self.add_watch(os.path.join(path, name),
+                                   OUTPUT_WATCH_MASK, True,
+                                   int(run_match.group(1)))
+                continue
+            if mask & IN_ISDIR or name.startswith('.'):
+                continue
+            if is_fu_data_dir:
+                # The outputs are named after their own streams:
+                lumi_match = LUMI_FILE_PATTERN.match(name)
+                lumi = lumi_match and (int(lumi_match.group(1)),
+                                       int(lumi_match.group(2)))
+                if lumi in self.pending_outputs:
+                    self.record_latency(OUTPUT_LABEL,
+                                        now - self.pending_outputs.pop(lumi))
+                continue
+            lumi_match = self.stream_file_pattern.match(name)
+            if not lumi_match:
+                continue
+            key = (int(lumi_match.group(1)), int(lumi_match.group(2)),
+                   lumi_match.group(3))
+            if key not in self.pending:
+                continue
+            if mask & IN_DELETE:
+                del self.pending[key]
+                self.expired += 1
+            elif self.pending[key] is None:
+                self.early_consumptions[key] = now
+            else:
+                self.record_latency(key[2], now - self.pending.pop(key))
+        # Without output, the FU lumisections would pile up forever:
+        while len(self.pending_outputs) > 10000:
+            del self.pending_outputs[min(self.pending_outputs)]
+
+    def expire_run(self, run_number):
+        for key in [key for key in self.pending if key[0] == run_number]:
+            del self.pending[key]
+            self.early_consumptions.pop(key, None)
+            self.expired += 1
+
+    def record_latency(self, label, latency):
+        self.consumed[label] = self.consumed.get(label, 0) + 1
+        self.total_latency[label] = self.total_latency.get(label, 0.) + latency
+        self.max_latency[label] = max(self.max_latency.get(label, 0.),
+                                      latency)
+        self.recent_latency.setdefault(label, deque(maxlen=1000)).append(
+            latency)
+
+    def get_summary(self):
+        with self.condition:
+            parts = ['backlog %d lumisections' % self.get_backlog()]
+            for label in sorted(self.consumed.keys()):
+                parts.append('%s: %d, mean latency %.3f s, max %.3f s'
+                             % (label, self.consumed[label],
+                                self.total_latency[label] /
+                                self.consumed[label],
+                                self.max_latency[label]))
+            parts.append('%d expired unconsumed' % self.expired)
+            if self.throttled_lumis:
+                parts.append('throttled %d times for %.1f s'
+                             % (self.throttled_lumis, self.throttled_seconds))
+            return ', '.join(parts)
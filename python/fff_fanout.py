@@ -0,0 +1,149 @@
+# Fan-out: the same simulated runs can be published to more targets than the
+# RamdiskDir, e.g. the ramdisks of other BUs or FU directories mounted over
+# NFS (ExtraTargets). One simulation feeds them all, so the source run is
+# indexed and its json files are parsed only once (see fff_source_index), and
+# they all follow the same schedule.
+#
+# The RamdiskDir is written by the simulation itself, as usual. Every extra
+# target has a thread of its own, which gets every step of the simulation (a
+# new run, the files of a lumisection, the end of a run) when the simulation
+# takes it, and writes it to the target at the same time. A slow or broken
+# target (e.g. a hanging mount) therefore never delays the RamdiskDir or the
+# other targets: its steps queue up, and once it is more than
+# MAX_QUEUED_LUMIS lumisections behind, its oldest lumisections are dropped.
+# Errors are logged and counted per target, which then goes on with its next
+# step. How late each target is, is measured from the moment the simulation
+# took the step.
+#
+# With the auto PublishMode, the mode is chosen per target (see
+# fff_os_operations.publish_file): the data files are hardlinks where the
+# target is on the filesystem of the source, and are copied by the kernel
+# elsewhere, so the simulator does not read them. Only with the copy mode
+# every target reads them (from the page cache).
+#
+# The old runs of the extra targets are cleaned up at the start like those of
+# the RamdiskDir (see fff_cleanup). The retention (see fff_retention) and the
+# consumption observer (see fff_consumption) only look at the RamdiskDir.
+
+import logging
+import threading
+from collections import deque
+from fff_scheduler import monotonic
+
+MAX_QUEUED_LUMIS = 50
+
+class FanoutTarget(threading.Thread):
+
+    def __init__(self, target_dir, max_queued_lumis=MAX_QUEUED_LUMIS):
+        threading.Thread.__init__(self, name='FanoutTarget')
+        self.daemon = True
+        self.target_dir = target_dir
+        self.max_queued_lumis = max_queued_lumis
+        self.condition = threading.Condition()
+        # The steps to write, in order: (time taken, description, write,
+        # whether it is a lumisection).
+        self.steps = deque()
+        self.queued_lumis = 0
+        self.stopped = False
+        # Statistics:
+        self.lumis = 0
+        self.bytes = 0
+        self.errors = 0
+        self.dropped_lumis = 0
+        self.total_lateness = 0.
+        self.max_lateness = 0.
+        self.last_lateness = 0.
+
+    def add_step(self, description, write, lumi=False):
+        with self.condition:
+            if lumi:
+                if self.queued_lumis >= self.max_queued_lumis:
+                    self.drop_oldest_lumi()
+                self.queued_lumis += 1
+            self.steps.append((monotonic(), description, write, lumi))
+            self.condition.notify_all()
+
+    def drop_oldest_lumi(self):
+        # (With the condition held.)
+        for step in self.steps:
+            if step[3]:
+                self.steps.remove(step)
+                self.queued_lumis -= 1
+                self.dropped_lumis += 1
+                logging.warning('Target %s is %d lumisections behind, not '
+                                'writing %s there.' % (self.target_dir,
+                                                       self.max_queued_lumis,
+                                                       step[1]))
+                return
+
+    def run(self):
+        # Once stopped, we still write the steps we have.
+        while True:
+            with self.condition:
+                while not self.steps and not self.stopped:
+                    self.condition.wait()
+                if not self.steps:
+                    return
+                step_time, description, write, lumi = self.steps.popleft()
+                if lumi:
+                    self.queued_lumis -= 1
+            try:
+                bytes_written = write(self.target_dir)
+            except Exception, error:
+                self.errors += 1
+                logging.error('Target %s: could not %s: %s'
+                              % (self.target_dir, description, error))
+                continue
+            if lumi:
+                lateness = monotonic() - step_time
+                self.lumis += 1
+                self.bytes += bytes_written or 0
+                self.last_lateness = lateness
+                self.total_lateness += lateness
+                self.max_lateness = max(self.max_lateness, lateness)
+
+    def stop(self, timeout=None):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        if self.is_alive():
+            self.join(timeout)
+        if self.is_alive():
+            logging.warning('Target %s did not finish in %.1f s, giving up '
+                            'on %d steps.' % (self.target_dir, timeout,
+                                              len(self.steps)))
+
+    def get_summary(self):
+        mean_lateness = 0.
+        if self.lumis:
+            mean_lateness = self.total_lateness / self.lumis
+        return ('%d lumisections, %.1f MB, %d dropped, %d errors, mean '
+                'lateness %.3f s, max lateness %.3f s'
+                % (self.lumis, self.bytes / 1e6, self.dropped_lumis,
+                   self.errors, mean_lateness, self.max_lateness))
+
+
+class Fanout(object):
+
+    def __init__(self, target_dirs, max_queued_lumis=MAX_QUEUED_LUMIS):
+        self.targets = [FanoutTarget(target_dir, max_queued_lumis)
+                        for target_dir in target_dirs]
+
+    def start(self):
+        for target in self.targets:
+            target.start()
+
+    def add_step(self, description, write, lumi=False):
+        # write(target_dir) writes the step to a target. For a lumisection
+        # it gives the amount of data bytes written.
+        for target in self.targets:
+            target.add_step(description, write, lumi)
+
+    def stop(self, timeout=None):
+        for target in self.targets:
+            target.stop(timeout)
+
+    def get_summary(self):
+        return '; '.join(['%s: %s' % (target.target_dir,
+                                      target.get_summary())
+                          for target in self.targets])
@@ -0,0 +1,178 @@
+# Logging setup for the FFF Simulator.
+#
+# At high lumisection rates, writing the log file on the thread that
+# publishes the files slows down the publication. Therefore the log records
+# can be handed over to a queue, from which a background thread writes them
+# to the (optionally rotating) log file. Handing over a record costs almost
+# nothing, and never blocks: if the writer cannot keep up and the queue is
+# full, records are dropped (and we log how many).
+#
+# The writer thread is started when the first record arrives in a process,
+# so that it also works after the daemon forked. When the handler is closed
+# (by logging.shutdown, at exit), we queue a sentinel behind the last record
+# and wait until the writer got to it, so that nothing queued is lost. A
+# process stopped with SIGTERM must therefore exit through sys.exit (see
+# exit_on_sigterm) rather than just die.
+
+import os
+import sys
+import Queue
+import signal
+import logging
+import threading
+import logging.handlers
+
+LOG_FORMAT = '%(asctime)s %(levelname)s: %(message)s'
+# In a process with a label (e.g. a worker of the supervisor):
+LABELLED_LOG_FORMAT = '%(asctime)s %(levelname)s: [%(label)s] %(message)s'
+
+# How long closing the handler waits for the queued records to be written:
+CLOSE_TIMEOUT = 30.
+
+class QueueHandler(logging.Handler):
+
+    def __init__(self, target_handler, queue_size=100000):
+        logging.Handler.__init__(self)
+        # The handler that actually writes the records:
+        self.target_handler = target_handler
+        self.queue = Queue.Queue(queue_size)
+        self.dropped_records = 0
+        self.writer_pid = None
+        self.writer = None
+        self.writer_lock = threading.Lock()
+
+    def emit(self, record):
+        if self.writer_pid != os.getpid():
+            self.start_writer()
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped_records += 1
+
+    def start_writer(self):
+        with self.writer_lock:
+            if self.writer_pid == os.getpid():
+                return
+            self.writer = threading.Thread(target=self.write_records,
+                                           name='LogWriter')
+            self.writer.daemon = True
+            self.writer.start()
+            self.writer_pid = os.getpid()
+
+    def write_records(self):
+        # Records, and events to set once everything before them is written
+        # (see flush). None ends the writer (see close).
+        while True:
+            record = self.queue.get()
+            if record is None:
+                self.target_handler.flush()
+                return
+            if isinstance(record, threading._Event):
+                self.target_handler.flush()
+                record.set()
+                continue
+            if self.dropped_records:
+                dropped_records, self.dropped_records = \
+                    self.dropped_records, 0
+                self.target_handler.handle(logging.makeLogRecord(
+                    {'levelno': logging.WARNING, 'levelname': 'WARNING',
+                     'msg': 'Dropped %d log records, the log writer could '
+                            'not keep up.' % dropped_records}))
+            self.target_handler.handle(record)
+
+    def has_writer(self):
+        return self.writer_pid == os.getpid() and self.writer.is_alive()
+
+    def flush(self, timeout=1.):
+        # Waits (at most the timeout) until everything queued so far is
+        # written.
+        if not self.has_writer():
+            self.target_handler.flush()
+            return
+        written = threading.Event()
+        try:
+            self.queue.put(written, timeout=timeout)
+        except Queue.Full:
+            return
+        written.wait(timeout)
+
+    def close(self):
+        # Ends the writer once it wrote everything queued so far.
+        if self.has_writer():
+            try:
+                self.queue.put(None, timeout=CLOSE_TIMEOUT)
+            except Queue.Full:
+                pass
+            self.writer.join(CLOSE_TIMEOUT)
+        self.target_handler.close()
+        logging.Handler.close(self)
+
+
+def configure_logging(log_file_name, level=logging.INFO, asynchronous=True,
+                      max_bytes=0, backup_count=5):
+    # With max_bytes, the log file is rotated when it gets bigger than that,
+    # keeping backup_count old log files. The log file is only created when
+    # the first record is written, so that a program that logs elsewhere
+    # (see redirect_logging) leaves no empty log file behind.
+    if max_bytes:
+        file_handler = logging.handlers.RotatingFileHandler(
+                           log_file_name, maxBytes=max_bytes,
+                           backupCount=backup_count, delay=True)
+    else:
+        file_handler = logging.FileHandler(log_file_name, delay=True)
+    file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    handler = file_handler
+    if asynchronous:
+        # Closed by logging.shutdown at exit.
+        handler = QueueHandler(file_handler)
+    root_logger = logging.getLogger('')
+    root_logger.addHandler(handler)
+    root_logger.setLevel(level)
+    return handler
+
+def redirect_logging(log_file_name, level=logging.INFO, asynchronous=True):
+    # Replaces the log file configured so far (e.g. the one fff_simulator
+    # configures when it is imported) by another one.
+    root_logger = logging.getLogger('')
+    for handler in root_logger.handlers[:]:
+        root_logger.removeHandler(handler)
+        handler.close()
+    return configure_logging(log_file_name, level, asynchronous)
+
+def reinitialize_after_fork(process_label=None):
+    # In a process forked from a process that logged already (e.g. a worker
+    # of the supervisor, or the daemon): we drop the records queued by the
+    # parent (it writes them itself) and start with fresh locks, which
+    # another thread of the parent might have held while forking. Our log
+    # lines are marked with the process label, if given.
+    for handler in logging.getLogger('').handlers:
+        handler.createLock()
+        if isinstance(handler, QueueHandler):
+            handler.queue = Queue.Queue(handler.queue.maxsize)
+            handler.writer_lock = threading.Lock()
+            handler.writer_pid = None
+            handler.writer = None
+            handler.target_handler.createLock()
+        if process_label:
+            formatter = logging.Formatter(LABELLED_LOG_FORMAT.replace(
+                            '%(label)s', process_label.replace('%', '%%')))
+            getattr(handler, 'target_handler', handler).setFormatter(
+                formatter)
+
+def exit_on_sigterm():
+    # SIGTERM ends the process through sys.exit, which writes out the log
+    # (see QueueHandler.close), instead of just killing it. The daemon is
+    # stopped by sending SIGTERM until it is gone, so we ignore the repeats
+    # while we exit.
+    def handle_sigterm(signal_number, frame):
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        sys.exit(0)
+    signal.signal(signal.SIGTERM, handle_sigterm)
+
+
+def get_log_file_name():
+    # The log file we write to, if any (also through a QueueHandler).
+    for handler in logging.getLogger('').handlers:
+        handler = getattr(handler, 'target_handler', handler)
+        if hasattr(handler, 'baseFilename'):
+            return handler.baseFilename
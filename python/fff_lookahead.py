@@ -0,0 +1,195 @@
+# Lookahead staging: instead of doing all the work for a lumisection at its
+# boundary and then idling until the next one, we prepare the next
+# lumisections in the background, in a hidden staging directory on the
+# ramdisk. At the boundary the prepared files only need to be renamed into
+# the run directory, which takes a few milliseconds whatever their size.
+#
+# The simulation decides which source entries each upcoming lumisection
+# publishes (see FFFSimulator.simulate_run) and hands them to the stager, at
+# most LookaheadDepth lumisections ahead. The stager prepares them in that
+# order: it publishes the data files into the staging directory (see
+# PublishMode) and writes the json files there, all under their final names.
+# It does not prepare more than LookaheadMaxMB of data files at a time
+# (except for one lumisection, so that we never stall), since the ramdisk is
+# memory.
+#
+# Renames are atomic, so consumers never see partial files either way. Each
+# stream still publishes its data file before its json file. A lumisection
+# that is needed while it is being prepared is waited for. One that is needed
+# before its preparation started, or whose preparation failed, is published
+# the normal way instead. Lumisections that are not published after all (e.g.
+# dropped, see OverrunPolicy) are deleted from the staging area.
+
+import os
+import shutil
+import logging
+import threading
+from collections import deque
+import fff_os_operations
+
+STAGING_DIR_NAME = '.fff_simulator_lookahead'
+
+class PreparedLumi(object):
+
+    def __init__(self, key, streams):
+        # The streams are, per stream, a list of (entry, staging data path,
+        # final data path, staging json path, final json path, json text).
+        self.key = key
+        self.streams = streams
+        self.data_bytes = sum([entry.data_size for stream in streams
+                               for entry, staging_data_path,
+                                   data_path, staging_json_path, json_path,
+                                   json_text in stream])
+        self.started = False
+        self.ready = threading.Event()
+        self.error = None
+
+    def get_staging_paths(self):
+        return [path for stream in self.streams
+                for entry, staging_data_path, data_path, staging_json_path,
+                    json_path, json_text in stream
+                for path in [staging_data_path, staging_json_path]]
+
+    def publish_stream(self, stream_number, fsync=False):
+        # Moves the prepared files of the stream to their final place and
+        # gives the amount of data bytes published.
+        bytes_written = 0
+        for entry, staging_data_path, data_path, staging_json_path, \
+            json_path, json_text in self.streams[stream_number]:
+            os.rename(staging_data_path, data_path)
+            os.rename(staging_json_path, json_path)
+            logging.debug('    Data:    %s', entry.data_path)
+            logging.debug('    Becomes: %s (staged)', data_path)
+            logging.debug('    Json:    %s', entry.json_path)
+            logging.debug('    Becomes: %s (staged)', json_path)
+            bytes_written += entry.data_size
+        if fsync and self.streams[stream_number]:
+            fff_os_operations.fsync_file(os.path.dirname(data_path))
+        return bytes_written
+
+
+class LookaheadStager(threading.Thread):
+
+    def __init__(self, ramdisk_dir, cfg, max_bytes=0):
+        # We read the publish and fsync modes from the configuration when we
+        # prepare a file (they can be reloaded, see fff_reload).
+        threading.Thread.__init__(self, name='LookaheadStager')
+        self.daemon = True
+        self.staging_dir = os.path.join(ramdisk_dir, STAGING_DIR_NAME)
+        self.cfg = cfg
+        self.max_bytes = max_bytes
+        self.condition = threading.Condition()
+        # The lumisections to prepare, in order, and all the ones we know
+        # of (prepared or not) per key:
+        self.queue = deque()
+        self.lumis = {}
+        self.staged_bytes = 0
+        self.stopped = False
+        # Whatever is left from an earlier simulation is useless:
+        shutil.rmtree(self.staging_dir, ignore_errors=True)
+        os.makedirs(self.staging_dir, 0755)
+        # Statistics:
+        self.prepared_lumis = 0
+        self.waited_lumis = 0
+
+    def prepare(self, key, streams):
+        # Queues the lumisection for preparation. The streams are, per
+        # stream, a list of (entry, final data path, final json path, json
+        # text).
+        prepared_streams = []
+        for stream in streams:
+            prepared_streams.append(
+                [(entry, self.get_staging_path(data_path), data_path,
+                  self.get_staging_path(json_path), json_path, json_text)
+                 for entry, data_path, json_path, json_text in stream])
+        prepared_lumi = PreparedLumi(key, prepared_streams)
+        with self.condition:
+            self.lumis[key] = prepared_lumi
+            self.queue.append(prepared_lumi)
+            self.condition.notify_all()
+
+    def get_staging_path(self, path):
+        return os.path.join(self.staging_dir, os.path.basename(path))
+
+    def take(self, key):
+        # Gives the prepared lumisection, once it is ready (None if it is not
+        # prepared). It does not count for the memory bound anymore.
+        with self.condition:
+            prepared_lumi = self.lumis.pop(key)
+            if not prepared_lumi.started:
+                self.queue.remove(prepared_lumi)
+                self.condition.notify_all()
+                return None
+        if not prepared_lumi.ready.is_set():
+            self.waited_lumis += 1
+            prepared_lumi.ready.wait()
+        with self.condition:
+            self.staged_bytes -= prepared_lumi.data_bytes
+            self.condition.notify_all()
+        if prepared_lumi.error:
+            logging.error('Could not prepare lumisection %s: %s'
+                          % (key, prepared_lumi.error))
+            self.remove_files(prepared_lumi)
+            return None
+        return prepared_lumi
+
+    def discard(self, key):
+        # The lumisection will not be published after all.
+        prepared_lumi = self.take(key)
+        if prepared_lumi:
+            self.remove_files(prepared_lumi)
+
+    def remove_files(self, prepared_lumi):
+        for path in prepared_lumi.get_staging_paths():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.stopped and not (self.queue and (
+                          not self.staged_bytes or not self.max_bytes or
+                          self.staged_bytes + self.queue[0].data_bytes <=
+                          self.max_bytes)):
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                prepared_lumi = self.queue.popleft()
+                prepared_lumi.started = True
+                self.staged_bytes += prepared_lumi.data_bytes
+            try:
+                self.prepare_files(prepared_lumi)
+                self.prepared_lumis += 1
+            except Exception, error:
+                prepared_lumi.error = error
+            prepared_lumi.ready.set()
+
+    def prepare_files(self, prepared_lumi):
+        fsync_data = self.cfg.fsync_mode in ['data', 'all']
+        fsync_json = self.cfg.fsync_mode == 'all'
+        for stream in prepared_lumi.streams:
+            for entry, staging_data_path, data_path, staging_json_path, \
+                json_path, json_text in stream:
+                entry.publish_data(staging_data_path, self.cfg.publish_mode)
+                if fsync_data:
+                    fff_os_operations.fsync_file(staging_data_path)
+                with open(staging_json_path, 'w') as json_file:
+                    json_file.write(json_text)
+                    if fsync_json:
+                        json_file.flush()
+                        os.fsync(json_file.fileno())
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        if self.is_alive():
+            self.join()
+        shutil.rmtree(self.staging_dir, ignore_errors=True)
+
+    def get_summary(self):
+        return ('%d lumisections prepared ahead, %d of them were needed '
+                'before they were ready' % (self.prepared_lumis,
+                                            self.waited_lumis))
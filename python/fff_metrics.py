@@ -0,0 +1,333 @@
+# Live metrics of the simulation, exposed over HTTP in the Prometheus text
+# format (e.g. http://localhost:9733/metrics), and used by
+# "service fff_simulator status".
+#
+# Most of the numbers are kept anyway by the scheduler, the rate controller
+# and the retention manager. We only look at them when somebody asks for the
+# metrics, so the simulation itself pays (almost) nothing for them: it only
+# sets the current run and lumisection and adds up the bytes and files per
+# stream.
+
+import os
+import time
+import socket
+import urllib2
+import logging
+import threading
+import BaseHTTPServer
+
+class SimulationMetrics(object):
+
+    def __init__(self, ramdisk_dir, scheduler=None, rate_controller=None,
+                 retention_manager=None, consumption_observer=None,
+                 replay=None, fanout=None, phases=None, profiler=None):
+        self.ramdisk_dir = ramdisk_dir
+        self.scheduler = scheduler
+        self.rate_controller = rate_controller
+        self.retention_manager = retention_manager
+        self.consumption_observer = consumption_observer
+        self.replay = replay
+        self.fanout = fanout
+        self.phases = phases
+        self.profiler = profiler
+        self.start_time = time.time()
+        self.run_number = 0
+        self.lumi_number = 0
+        # Per stream name:
+        self.stream_bytes = {}
+        self.stream_files = {}
+
+    def record_streams(self, stream_names, bytes_per_stream,
+                       files_per_stream=None):
+        # By default, a data file and a json file per stream.
+        if files_per_stream is None:
+            files_per_stream = [2] * len(stream_names)
+        for stream_name, bytes_written, files_written in \
+            zip(stream_names, bytes_per_stream, files_per_stream):
+            self.stream_bytes[stream_name] = \
+                self.stream_bytes.get(stream_name, 0) + bytes_written
+            self.stream_files[stream_name] = \
+                self.stream_files.get(stream_name, 0) + files_written
+
+    def get_samples(self):
+        # Gives (name, type, help, [(labels, value), ...]) for all metrics.
+        samples = []
+        def add(name, metric_type, help_text, values):
+            samples.append(('fff_simulator_' + name, metric_type, help_text,
+                            values))
+        add('uptime_seconds', 'gauge', 'Seconds since the simulation started.',
+            [('', time.time() - self.start_time)])
+        add('run_number', 'gauge', 'Run being simulated.',
+            [('', self.run_number)])
+        add('lumisection', 'gauge', 'Lumisection being simulated.',
+            [('', self.lumi_number)])
+        add('stream_bytes_total', 'counter', 'Data bytes written per stream.',
+            [('stream="%s"' % name, value)
+             for name, value in sorted(self.stream_bytes.items())])
+        add('stream_files_total', 'counter', 'Files written per stream.',
+            [('stream="%s"' % name, value)
+             for name, value in sorted(self.stream_files.items())])
+        if self.rate_controller:
+            emission_times = self.rate_controller.emission_times
+            add('lumisections_total', 'counter', 'Lumisections written.',
+                [('', self.rate_controller.lumis)])
+            add('last_emission_seconds', 'gauge',
+                'Seconds it took to write the last lumisection.',
+                [('', emission_times and emission_times[-1] or 0.)])
+        if self.scheduler:
+            add('late_lumisections_total', 'counter',
+                'Lumisections written after their deadline.',
+                [('', self.scheduler.late_lumis)])
+            add('dropped_lumisections_total', 'counter',
+                'Lumisections not written because their slot had passed.',
+                [('', self.scheduler.dropped_lumis)])
+            add('last_lateness_seconds', 'gauge',
+                'Lateness of the last lumisection.',
+                [('', self.scheduler.last_lateness)])
+            add('max_lateness_seconds', 'gauge',
+                'Maximum lateness of a lumisection.',
+                [('', self.scheduler.max_lateness)])
+        if self.retention_manager:
+            add('retention_reclaimed_bytes_total', 'counter',
+                'Bytes deleted from the ramdisk by the retention.',
+                [('', self.retention_manager.reclaimed_bytes)])
+        if self.consumption_observer:
+            observer = self.consumption_observer
+            with observer.condition:
+                labels = sorted(observer.consumed.keys())
+                add('backlog_lumisections', 'gauge',
+                    'Published lumisections not consumed yet.',
+                    [('', observer.get_backlog())])
+                add('consumed_lumisections_total', 'counter',
+                    'Lumisections consumed, per stream (or output).',
+                    [('stream="%s"' % label, observer.consumed[label])
+                     for label in labels])
+                add('consumption_latency_seconds_total', 'counter',
+                    'Total seconds from publication to consumption.',
+                    [('stream="%s"' % label, observer.total_latency[label])
+                     for label in labels])
+                add('consumption_latency_max_seconds', 'gauge',
+                    'Maximum seconds from publication to consumption.',
+                    [('stream="%s"' % label, observer.max_latency[label])
+                     for label in labels])
+                add('throttled_seconds_total', 'counter',
+                    'Seconds we waited for the consumers to catch up.',
+                    [('', observer.throttled_seconds)])
+        if self.replay:
+            add('replay_lumisections_total', 'counter',
+                'Lumisections of the trace replayed.',
+                [('', self.replay.replayed_lumis)])
+            add('replay_target_bytes_total', 'counter',
+                'Data bytes of the replayed lumisections in the trace.',
+                [('', self.replay.target_bytes)])
+            add('replay_bytes_total', 'counter',
+                'Data bytes written for the replayed lumisections.',
+                [('', self.replay.written_bytes)])
+            add('replay_max_lateness_seconds', 'gauge',
+                'Maximum seconds behind the trace timing.',
+                [('', self.replay.max_lateness)])
+        if self.fanout:
+            targets = self.fanout.targets
+            add('target_lumisections_total', 'counter',
+                'Lumisections written per extra target.',
+                [('target="%s"' % target.target_dir, target.lumis)
+                 for target in targets])
+            add('target_bytes_total', 'counter',
+                'Data bytes written per extra target.',
+                [('target="%s"' % target.target_dir, target.bytes)
+                 for target in targets])
+            add('target_dropped_lumisections_total', 'counter',
+                'Lumisections not written to an extra target, because it '
+                'was too far behind.',
+                [('target="%s"' % target.target_dir, target.dropped_lumis)
+                 for target in targets])
+            add('target_errors_total', 'counter',
+                'Steps that failed per extra target.',
+                [('target="%s"' % target.target_dir, target.errors)
+                 for target in targets])
+            add('target_last_lateness_seconds', 'gauge',
+                'Lateness of the last lumisection per extra target.',
+                [('target="%s"' % target.target_dir, target.last_lateness)
+                 for target in targets])
+            add('target_max_lateness_seconds', 'gauge',
+                'Maximum lateness of a lumisection per extra target.',
+                [('target="%s"' % target.target_dir, target.max_lateness)
+                 for target in targets])
+        if self.phases:
+            with self.phases.lock:
+                totals = dict(self.phases.totals)
+            add('phase_seconds_total', 'counter',
+                'Seconds spent per phase of the simulation.',
+                [('phase="%s"' % phase, totals[phase])
+                 for phase in sorted(totals)])
+        if self.profiler:
+            add('profiling', 'gauge', 'Whether a profile is being taken.',
+                [('', int(self.profiler.is_active()))])
+            add('profiles_total', 'counter', 'Profiles taken.',
+                [('', self.profiler.profiles)])
+        try:
+            statvfs = os.statvfs(self.ramdisk_dir)
+            add('ramdisk_free_bytes', 'gauge', 'Free space on the ramdisk.',
+                [('', statvfs.f_bavail * statvfs.f_frsize)])
+            add('ramdisk_size_bytes', 'gauge', 'Size of the ramdisk.',
+                [('', statvfs.f_blocks * statvfs.f_frsize)])
+        except OSError:
+            pass
+        return samples
+
+    def format_prometheus(self):
+        return format_samples(self.get_samples())
+
+
+def format_samples(samples):
+    lines = []
+    for name, metric_type, help_text, values in samples:
+        lines.append('# HELP %s %s' % (name, help_text))
+        lines.append('# TYPE %s %s' % (name, metric_type))
+        for labels, value in values:
+            if labels:
+                lines.append('%s{%s} %s' % (name, labels,
+                                            _format_value(value)))
+            else:
+                lines.append('%s %s' % (name, _format_value(value)))
+    return '\n'.join(lines) + '\n'
+
+def _format_value(value):
+    # No trailing L for longs, full precision for floats.
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class _MetricsRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ['/', '/metrics']:
+            self.send_error(404)
+            return
+        body = self.server.metrics.format_prometheus()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *arguments):
+        # No logging for every scrape.
+        pass
+
+
+def start_metrics_server(metrics, port, address='127.0.0.1'):
+    # Serves the metrics in a background thread. Returns the server, or None
+    # if we could not start it (the simulation goes on without).
+    try:
+        BaseHTTPServer.HTTPServer.allow_reuse_address = True
+        server = BaseHTTPServer.HTTPServer((address, port),
+                                           _MetricsRequestHandler)
+    except socket.error, error:
+        logging.error('Could not serve metrics on port %d: %s'
+                      % (port, error))
+        return None
+    server.metrics = metrics
+    thread = threading.Thread(target=server.serve_forever,
+                              name='MetricsServer')
+    thread.daemon = True
+    thread.start()
+    logging.info('Serving metrics on http://%s:%d/metrics' % (address, port))
+    return server
+
+def fetch_metrics(port, address='127.0.0.1', timeout=2):
+    # Gives the metrics of a running simulator as {(name, labels): value}.
+    response = urllib2.urlopen('http://%s:%d/metrics' % (address, port),
+                               timeout=timeout)
+    values = {}
+    for line in response.read().splitlines():
+        if not line or line.startswith('#'):
+            continue
+        name_and_labels, value = line.rsplit(' ', 1)
+        labels = ''
+        if '{' in name_and_labels:
+            name_and_labels, labels = name_and_labels.split('{', 1)
+            labels = labels.rstrip('}')
+        values[(name_and_labels.replace('fff_simulator_', '', 1),
+                labels)] = float(value)
+    return values
+
+def format_status(values):
+    # A human readable version of the metrics, for the status command.
+    def get(name, labels=''):
+        return values.get((name, labels), 0)
+    lines = ['Simulating run %d, lumisection %d (for %d s).'
+             % (get('run_number'), get('lumisection'),
+                get('uptime_seconds')),
+             'Written %d lumisections, last one in %.3f s.'
+             % (get('lumisections_total'), get('last_emission_seconds')),
+             'Late lumisections: %d, dropped: %d, last lateness %.3f s, '
+             'max lateness %.3f s.'
+             % (get('late_lumisections_total'),
+                get('dropped_lumisections_total'),
+                get('last_lateness_seconds'), get('max_lateness_seconds'))]
+    for (name, labels), value in sorted(values.items()):
+        if name == 'stream_bytes_total' and 'simulation=' not in labels:
+            stream_name = labels.split('"')[1]
+            lines.append('  %s: %.1f MB in %d files.'
+                         % (stream_name, value / 1e6,
+                            get('stream_files_total', labels)))
+    if ('backlog_lumisections', '') in values:
+        lines.append('Backlog: %d lumisections (throttled for %.1f s).'
+                     % (get('backlog_lumisections'),
+                        get('throttled_seconds_total')))
+    for (name, labels), value in sorted(values.items()):
+        if name == 'consumed_lumisections_total' and value and \
+           'simulation=' not in labels:
+            lines.append('  %s consumed %d, mean latency %.3f s, max %.3f s.'
+                         % (labels.split('"')[1], value,
+                            get('consumption_latency_seconds_total', labels) /
+                            value,
+                            get('consumption_latency_max_seconds', labels)))
+    if ('ramdisk_size_bytes', '') in values:
+        lines.append('Ramdisk: %.1f GB free of %.1f GB.'
+                     % (get('ramdisk_free_bytes') / 1e9,
+                        get('ramdisk_size_bytes') / 1e9))
+    for (name, labels), value in sorted(values.items()):
+        if name == 'target_lumisections_total' and \
+           'simulation=' not in labels:
+            lines.append('  Target %s: %d lumisections, %d dropped, %d '
+                         'errors, max lateness %.3f s.'
+                         % (labels.split('"')[1], value,
+                            get('target_dropped_lumisections_total', labels),
+                            get('target_errors_total', labels),
+                            get('target_max_lateness_seconds', labels)))
+    phase_seconds = [(value, labels.split('"')[1])
+                     for (name, labels), value in values.items()
+                     if name == 'phase_seconds_total' and value >= 0.05 and
+                        'simulation=' not in labels]
+    if phase_seconds:
+        lines.append('Time per phase: %s.'
+                     % ', '.join(['%s %.1f s' % (phase, seconds)
+                                  for seconds, phase
+                                  in sorted(phase_seconds, reverse=True)]))
+    if get('profiling'):
+        lines.append('Taking a profile.')
+    if ('replay_lumisections_total', '') in values:
+        lines.append('Replayed %d lumisections of the trace: %.1f MB of '
+                     '%.1f MB, at most %.3f s behind.'
+                     % (get('replay_lumisections_total'),
+                        get('replay_bytes_total') / 1e6,
+                        get('replay_target_bytes_total') / 1e6,
+                        get('replay_max_lateness_seconds')))
+    if ('retention_reclaimed_bytes_total', '') in values:
+        lines.append('Retention reclaimed %.1f MB.'
+                     % (get('retention_reclaimed_bytes_total') / 1e6))
+    # With multiple simulations (see fff_supervisor), the above are the
+    # totals, and these the simulations:
+    for (name, labels), value in sorted(values.items()):
+        if name == 'run_number' and labels.startswith('simulation='):
+            lines.append('Simulation %s: run %d, lumisection %d, %d '
+                         'lumisections written, %d late, %d dropped.'
+                         % (labels.split('"')[1], value,
+                            get('lumisection', labels),
+                            get('lumisections_total', labels),
+                            get('late_lumisections_total', labels),
+                            get('dropped_lumisections_total', labels)))
+    return '\n'.join(lines) + '\n'
@@ -4,30 +4,197 @@
 # to worry about it in the calling code.
 
 import os
+import re
+import time
+import errno
+import fcntl
+import ctypes
+import shutil
 import logging
+import threading
 from subprocess import Popen, PIPE
 
-def hltd_status(host=None):
-    command = ['service', 'hltd', 'status']
-    if host:
-        command[:0] = ['ssh', host]
-    process = Popen(command, stdout=PIPE, stderr=PIPE)
-    stdout, stderr = process.communicate()
+# The names of the run directories and of the files of a lumisection (e.g.
+# run247398 and run247398_ls0001_streamDQM_mrg-c2f12-22-01.jsn), for the
+# source runs as well as the simulated ones:
+RUN_DIR_PATTERN = re.compile(r'^run(\d+)$')
+LUMI_FILE_PATTERN = re.compile(r'^run(\d+)_ls(\d+)_')
+
+# Remote commands go over ssh. We let ssh keep one master connection per host
+# open in the background (ControlMaster/ControlPersist), so that the next
+# commands for the same host reuse it instead of setting up a new connection.
+# The sockets of the master connections are in a directory only we can access
+# (not in /tmp, where anybody could put a socket in their place). Until
+# configure_ssh is called at startup, there are no master connections.
+SSH_CONTROL_DIR = os.path.expanduser('~/.ssh')
+SSH_BASE_OPTIONS = ['-o', 'BatchMode=yes',
+                    '-o', 'ConnectTimeout=10',
+                    '-o', 'LogLevel=ERROR']
+
+def get_ssh_options(control_persist):
+    # With control_persist (seconds the master connection stays open after
+    # the last command), we use master connections.
+    if not control_persist:
+        return ['-o', 'ControlMaster=no'] + SSH_BASE_OPTIONS
+    return ['-o', 'ControlMaster=auto',
+            '-o', 'ControlPath=%s/cm-%%r@%%h:%%p' % SSH_CONTROL_DIR,
+            '-o', 'ControlPersist=%d' % control_persist] + SSH_BASE_OPTIONS
+
+SSH_OPTIONS = get_ssh_options(0)
+
+def configure_ssh(control_persist=600):
+    # Called once at startup: creates the directory of the sockets of the
+    # master connections, if needed. Without it, we do without them.
+    if control_persist and not os.path.isdir(SSH_CONTROL_DIR):
+        try:
+            os.makedirs(SSH_CONTROL_DIR, 0700)
+        except OSError, error:
+            if error.errno != errno.EEXIST:
+                logging.warning('Cannot create %s, not reusing ssh '
+                                'connections: %s' % (SSH_CONTROL_DIR, error))
+                control_persist = 0
+    SSH_OPTIONS[:] = get_ssh_options(control_persist)
+
+def ssh_command(host, command):
+    # Gives the command to execute the given command on the host (or locally
+    # if no host is given).
+    if not host:
+        return command
+    return ['ssh'] + SSH_OPTIONS + [host] + command
+
+def ssh_close(host, timeout=None):
+    # Closes the master connection to the host, if there is one.
+    if not host or 'ControlMaster=auto' not in SSH_OPTIONS:
+        return
+    run_command(['ssh'] + SSH_OPTIONS + ['-O', 'exit', host], timeout)
+
+def run_command(command, timeout=None, shell=False):
+    # Executes the command and gives back stdout and stderr. If it takes more
+    # than timeout seconds, the process is killed and we raise an exception.
+    process = Popen(command, shell=shell, stdout=PIPE, stderr=PIPE)
+    timed_out = []
+    timer = None
+    if timeout:
+        def kill():
+            timed_out.append(True)
+            try:
+                process.kill()
+            except OSError:
+                pass
+        timer = threading.Timer(timeout, kill)
+        timer.daemon = True
+        timer.start()
+    try:
+        stdout, stderr = process.communicate()
+    finally:
+        if timer:
+            timer.cancel()
+    if timed_out:
+        raise Exception('Timed out after %s seconds: %s' % (timeout, command))
+    return stdout, stderr
+
+def on_hosts(operation, hosts, *args, **kwargs):
+    # Executes operation(host, *args, **kwargs) for all the hosts at the same
+    # time (None meaning locally) and gives back the results per host. If it
+    # failed on any of the hosts, we raise one exception for all of them,
+    # after all the others finished.
+    results = {}
+    errors = {}
+    def execute(host):
+        try:
+            results[host] = operation(host, *args, **kwargs)
+        except Exception, error:
+            errors[host] = error
+    threads = [threading.Thread(target=execute, args=(host,))
+               for host in hosts]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise Exception('%s failed on %d of %d hosts:\n%s' % (
+            operation.__name__, len(errors), len(hosts),
+            '\n'.join(['%s: %s' % (host or 'localhost', error)
+                       for host, error in errors.items()])))
+    return results
+
+def in_parallel(calls):
+    # Executes all the calls, (function, args, kwargs), at the same time and
+    # gives back their results in the same order. If any of them failed, we
+    # raise one exception for all of them, after all the others finished.
+    results = [None] * len(calls)
+    errors = {}
+    def execute(call_number):
+        function, args, kwargs = calls[call_number]
+        try:
+            results[call_number] = function(*args, **kwargs)
+        except Exception, error:
+            errors[call_number] = error
+    threads = [threading.Thread(target=execute, args=(call_number,))
+               for call_number in range(len(calls))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise Exception('%d of %d operations failed:\n%s' % (
+            len(errors), len(calls),
+            '\n'.join(['%s: %s' % (calls[call_number][0].__name__, error)
+                       for call_number, error in sorted(errors.items())])))
+    return results
+
+def hltd_status(host=None, timeout=None):
+    command = ssh_command(host, ['service', 'hltd', 'status'])
+    stdout, stderr = run_command(command, timeout)
     if stderr:
         raise Exception(stderr)
     return stdout
 
-def hltd_running(host=None):
-    return 'hltd is running' in hltd_status(host)
+def hltd_running(host=None, timeout=None):
+    return 'hltd is running' in hltd_status(host, timeout)
+
+# Where the local hltd keeps its pid:
+HLTD_PID_FILE = '/var/run/hltd.pid'
+
+def get_hltd_pid():
+    # The pid of the local hltd, or None if we cannot tell.
+    try:
+        with open(HLTD_PID_FILE, 'r') as pid_file:
+            return int(pid_file.read().strip())
+    except (IOError, ValueError):
+        return None
+
+def wait_until_hltd_running(host=None, timeout=None, poll_interval=0.2):
+    # Polls the status of hltd until it runs, for at most timeout seconds.
+    # Gives False if it does not run, otherwise (locally) its pid if we can
+    # tell, or True.
+    target = ' locally' # For logging
+    if host:
+        target = ' on %s' % host # For logging
+    start_time = time.time()
+    while True:
+        try:
+            if hltd_running(host, timeout):
+                logging.info('hltd is running%s (after %.1f s).'
+                             % (target, time.time() - start_time))
+                if not host:
+                    return get_hltd_pid() or True
+                return True
+        except Exception, error:
+            logging.debug('Could not get the status of hltd%s: %s'
+                          % (target, error))
+        if timeout is not None and time.time() - start_time >= timeout:
+            logging.warning('hltd is not running%s after %.1f s, going on '
+                            'anyway.' % (target, timeout))
+            return False
+        time.sleep(poll_interval)
 
-def hltd_stop(host=None):
-    command = ['service', 'hltd', 'stop']
+def hltd_stop(host=None, timeout=None):
+    command = ssh_command(host, ['service', 'hltd', 'stop'])
     target = ' locally' # For logging
     if host:
-        command[:0] = ['ssh', host]
         target = ' on %s' % host # For logging
-    process = Popen(command, stdout=PIPE, stderr=PIPE)
-    stdout, stderr = process.communicate()
+    stdout, stderr = run_command(command, timeout)
     # Output should be:
     # If stopped successfully:
     # Stopping hltd instance main: o.o.          [  OK  ]
@@ -43,14 +210,12 @@ def hltd_stop(host=None):
     # If we didn't get the expected results, we raise an exception
     raise Exception('\n'.join([stdout, stderr]))
 
-def hltd_start(host=None):
-    command = ['service', 'hltd', 'start']
+def hltd_start(host=None, timeout=None):
+    command = ssh_command(host, ['service', 'hltd', 'start'])
     target = ' locally' # For logging
     if host:
-        command[:0] = ['ssh', host]
         target = ' on %s' % host # For logging
-    process = Popen(command, stdout=PIPE, stderr=PIPE)
-    stdout, stderr = process.communicate()
+    stdout, stderr = run_command(command, timeout)
     # Output should be:
     # If started successfully:
     # Starting hltd instance main :              [  OK  ]
@@ -67,29 +232,283 @@ def hltd_start(host=None):
     # If we didn't get the expected results, we raise an exception
     raise Exception('\n'.join([stdout, stderr]))
 
-def execute_literal_shell_command(command):
-    # Using direct shell interpretation here. Don't like it, but given the
-    # non-functional constraints, this is best now.
-    process = Popen(command, shell=True, stdout=PIPE, stderr=PIPE)
-    stdout, stderr = process.communicate()
-    if stderr:
-        raise Exception(stderr)
+# Readiness of inotify watches:
+# hltd picks up new runs (and their files) with inotify. Instead of waiting a
+# fixed time after creating a directory, we can find out whether somebody
+# watches it: every inotify watch is listed (with the inode and the device
+# it watches) in /proc/<pid>/fdinfo/<fd> of the inotify file descriptor.
+# We only look at hltd (and the processes it started), whose pid we get from
+# wait_until_hltd_running: a watch of anybody else (e.g. our own consumption
+# observer) does not tell us that hltd is ready. (This only sees local
+# processes, and we need to be allowed to look at them, i.e. be root.)
+
+def _get_process_tree(pid):
+    # The pid and those of all its descendants that are still there (only
+    # the pid itself if the kernel does not list the children).
+    pids = [str(pid)]
+    for parent_pid in pids:
+        task_dir = os.path.join('/proc', parent_pid, 'task')
+        try:
+            task_ids = os.listdir(task_dir)
+        except OSError:
+            continue
+        for task_id in task_ids:
+            try:
+                with open(os.path.join(task_dir, task_id, 'children'),
+                          'r') as children:
+                    pids += [child for child in children.read().split()
+                             if child not in pids]
+            except IOError:
+                continue
+    return pids
+
+def _find_inotify_fds(pid):
+    # Gives the /proc/<pid>/fdinfo/<fd> paths of the inotify instances of
+    # the process and its descendants, or None if we cannot look at them at
+    # all.
+    if not pid or not os.path.isdir('/proc/self/fdinfo'):
+        return None
+    fdinfo_paths = []
+    for pid in _get_process_tree(pid):
+        fd_dir = os.path.join('/proc', pid, 'fd')
+        try:
+            fds = os.listdir(fd_dir)
+        except OSError:
+            continue
+        for fd in fds:
+            try:
+                if os.readlink(os.path.join(fd_dir, fd)) == \
+                   'anon_inode:inotify':
+                    fdinfo_paths.append(os.path.join('/proc', pid, 'fdinfo',
+                                                     fd))
+            except OSError:
+                continue
+    return fdinfo_paths
+
+def _get_watch_key(path):
+    # How fdinfo shows a watch on the path: the inode and the device (in the
+    # kernel's own encoding of the device number), both in hex.
+    path_stat = os.stat(path)
+    device = (os.major(path_stat.st_dev) << 20) | os.minor(path_stat.st_dev)
+    return 'ino:%x sdev:%x ' % (path_stat.st_ino, device)
+
+def is_watched(path, fdinfo_paths):
+    watch_key = _get_watch_key(path)
+    for fdinfo_path in fdinfo_paths:
+        try:
+            with open(fdinfo_path, 'r') as fdinfo:
+                if watch_key in fdinfo.read():
+                    return True
+        except IOError:
+            continue
+    return False
+
+def wait_until_watched(path, timeout, pid, poll_interval=0.02):
+    # Waits until the process with the pid (hltd, see wait_until_hltd_running)
+    # watches the path with inotify, for at most timeout seconds. Gives the
+    # seconds we waited, or None if we cannot tell whether the path is
+    # watched, e.g. without a pid (then we did not wait).
+    start_time = time.time()
+    fdinfo_paths = _find_inotify_fds(pid)
+    if fdinfo_paths is None:
+        return None
+    last_scan_time = start_time
+    while not is_watched(path, fdinfo_paths):
+        now = time.time()
+        if now - start_time >= timeout:
+            if timeout:
+                logging.info('Nobody watches %s after %.1f s, going on '
+                             'anyway.' % (path, timeout))
+            return now - start_time
+        time.sleep(min(poll_interval, timeout - (now - start_time)))
+        # Looking for the inotify instances costs more than looking at them,
+        # so we only look for new ones (e.g. of a starting hltd) now and then:
+        if now - last_scan_time >= 0.2:
+            fdinfo_paths = _find_inotify_fds(pid) or []
+            last_scan_time = now
+    return time.time() - start_time
+
+# Publishing data files:
+# The data files we put on the ramdisk are never modified afterwards, so there
+# is no need to make a full user space copy of them for every lumisection.
+# We support the following ways of publishing a file, from cheapest to most
+# expensive:
+# - hardlink:   A new name for the same inode (source and target need to be on
+#               the same filesystem). Costs nothing, not even memory.
+# - reflink:    A copy-on-write clone (only on filesystems that support it,
+#               e.g. btrfs or xfs).
+# - kernelcopy: An in-kernel copy with copy_file_range or sendfile, which
+#               avoids moving the data through user space.
+# - copy:       A plain shutil.copyfile, which always works.
+PUBLISH_MODES = ['hardlink', 'reflink', 'kernelcopy', 'copy']
+
+# The ioctl request number for a reflink clone (FICLONE from linux/fs.h)
+FICLONE = 0x40049409
+
+# Error numbers that tell us that a publish mode is not possible between a
+# given source and target, as opposed to a real problem with the files.
+_UNSUPPORTED_ERRNOS = [errno.EXDEV, errno.EPERM, errno.EMLINK, errno.EINVAL,
+                       errno.ENOSYS, errno.ENOTTY, errno.EOPNOTSUPP,
+                       errno.EBADF]
+
+# In auto mode we remember, per (source device, target device), which modes
+# are still worth trying. This way we only pay for a failing attempt once.
+# The emission workers publish at the same time, so the modes are kept as
+# tuples that are only replaced under the lock.
+_auto_publish_modes = {}
+_auto_publish_lock = threading.Lock()
+
+def publish_file(source_path, target_path, mode='auto'):
+    # Makes the content of source_path available as target_path and returns
+    # the mode that was actually used.
+    if mode != 'auto':
+        _PUBLISHERS[mode](source_path, target_path)
+        return mode
+    source_device = os.stat(source_path).st_dev
+    target_device = os.stat(os.path.dirname(target_path)).st_dev
+    key = (source_device, target_device)
+    with _auto_publish_lock:
+        if key not in _auto_publish_modes:
+            if source_device == target_device:
+                _auto_publish_modes[key] = tuple(PUBLISH_MODES)
+            else:
+                # Hardlinks and reflinks never work across filesystems
+                _auto_publish_modes[key] = ('kernelcopy', 'copy')
+        candidates = _auto_publish_modes[key]
+    while True:
+        mode = candidates[0]
+        try:
+            _PUBLISHERS[mode](source_path, target_path)
+            return mode
+        except (OSError, IOError), error:
+            if mode == 'copy' or error.errno not in _UNSUPPORTED_ERRNOS:
+                raise
+            _remove_if_exists(target_path)
+            candidates = candidates[1:]
+            with _auto_publish_lock:
+                # Another worker may have given up on the mode already.
+                if mode in _auto_publish_modes[key]:
+                    _auto_publish_modes[key] = tuple(
+                        [candidate for candidate in _auto_publish_modes[key]
+                         if candidate != mode])
+                    logging.info('Cannot publish with %s (%s), falling back '
+                                 'to %s.' % (mode, error, candidates[0]))
+
+def _publish_hardlink(source_path, target_path):
+    try:
+        os.link(source_path, target_path)
+    except OSError, error:
+        if error.errno != errno.EEXIST:
+            raise
+        # Same behaviour as a copy: we overwrite what was there.
+        os.remove(target_path)
+        os.link(source_path, target_path)
+
+def _publish_reflink(source_path, target_path):
+    with open(source_path, 'rb') as source_file:
+        with open(target_path, 'wb') as target_file:
+            fcntl.ioctl(target_file.fileno(), FICLONE, source_file.fileno())
+
+def _publish_kernelcopy(source_path, target_path):
+    kernel_copies = _get_kernel_copy_functions()
+    if not kernel_copies:
+        raise OSError(errno.ENOSYS, 'No in-kernel copy available')
+    with open(source_path, 'rb') as source_file:
+        with open(target_path, 'wb') as target_file:
+            remaining = os.fstat(source_file.fileno()).st_size
+            # Older kernels refuse copy_file_range across filesystems, in
+            # which case sendfile is next in line (only before the first
+            # byte was copied, of course).
+            started = False
+            while remaining > 0:
+                copied = kernel_copies[0](source_file.fileno(),
+                                          target_file.fileno(),
+                                          min(remaining, 1 << 30))
+                if copied < 0:
+                    error_number = ctypes.get_errno()
+                    if error_number == errno.EINTR:
+                        # Interrupted by a signal (e.g. a reload): nothing
+                        # was copied, so we just try again.
+                        continue
+                    if started or len(kernel_copies) == 1 or \
+                            error_number not in _UNSUPPORTED_ERRNOS:
+                        raise OSError(error_number, os.strerror(error_number))
+                    kernel_copies = kernel_copies[1:]
+                    continue
+                if copied == 0:
+                    break
+                started = True
+                remaining -= copied
+
+def _publish_copy(source_path, target_path):
+    shutil.copyfile(source_path, target_path)
+
+_PUBLISHERS = {'hardlink': _publish_hardlink,
+               'reflink': _publish_reflink,
+               'kernelcopy': _publish_kernelcopy,
+               'copy': _publish_copy}
+
+_kernel_copy_functions = []
+
+def _get_kernel_copy_functions():
+    # Python 2 has no os.copy_file_range or os.sendfile, so we look them up in
+    # the C library ourselves (only once). We prefer copy_file_range, which
+    # can even be offloaded by the filesystem, over sendfile.
+    if not _kernel_copy_functions:
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+        except OSError:
+            libc = None
+        if libc is not None and hasattr(libc, 'copy_file_range'):
+            copy_file_range = libc.copy_file_range
+            copy_file_range.restype = ctypes.c_ssize_t
+            copy_file_range.argtypes = [ctypes.c_int, ctypes.c_void_p,
+                                        ctypes.c_int, ctypes.c_void_p,
+                                        ctypes.c_size_t, ctypes.c_uint]
+            _kernel_copy_functions.append(
+                lambda source_fd, target_fd, count:
+                    copy_file_range(source_fd, None, target_fd, None,
+                                    count, 0))
+        if libc is not None and hasattr(libc, 'sendfile'):
+            sendfile = libc.sendfile
+            sendfile.restype = ctypes.c_ssize_t
+            sendfile.argtypes = [ctypes.c_int, ctypes.c_int,
+                                 ctypes.c_void_p, ctypes.c_size_t]
+            _kernel_copy_functions.append(
+                lambda source_fd, target_fd, count:
+                    sendfile(target_fd, source_fd, None, count))
+    return _kernel_copy_functions
+
+# Atomic publishing:
+# Files are first written under a hidden temporary name in the same directory
+# and then renamed to their final name. A rename within a filesystem is
+# atomic, so whoever watches the directory (e.g. hltd with inotify) only ever
+# sees complete files.
+
+def get_temporary_path(path):
+    directory, name = os.path.split(path)
+    return os.path.join(directory, '.%s.tmp' % name)
+
+def commit_file(temporary_path, path, fsync=False):
+    # Renames the temporary file to its final name. With fsync, the content
+    # is on disk before the file appears, and the rename itself afterwards.
+    if fsync:
+        fsync_file(temporary_path)
+    os.rename(temporary_path, path)
+    if fsync:
+        fsync_file(os.path.dirname(path))
+
+def fsync_file(path):
+    # Works for directories as well.
+    file_descriptor = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(file_descriptor)
+    finally:
+        os.close(file_descriptor)
 
-def clean_ramdisk(ramdisk_dir):
-    # Deletes the old run* directories from the ramdisk.
-    logging.info('Deleting old runs from ramdisk.')
-    # We implement this in a very simple way, by just passing the rm
-    # command to the os.
-    runs_path = os.path.join(ramdisk_dir, 'run{,[0-9]}'+'[0-9]'*6)
-    keys_path = os.path.join(ramdisk_dir, '.run{,[0-9]}'+'[0-9]'*6+'.global')
-    command = 'rm -rf %s %s' % (runs_path, keys_path)
-    execute_literal_shell_command(command)
-
-def clean_fu_data_dir(fu_host_name, fu_data_dir):
-    # Deletes the old run* directories from the ramdisk.
-    logging.info('Deleting old runs from fu data dir.')
-    # We implement this in a very simple way, by just passing the rm
-    # command to the os.
-    runs_path = os.path.join(fu_data_dir, 'run{,[0-9]}'+'[0-9]'*6)
-    command = 'ssh %s rm -rf %s' % (fu_host_name, runs_path)
-    execute_literal_shell_command(command)
+def _remove_if_exists(path):
+    try:
+        os.remove(path)
+    except OSError, error:
+        if error.errno != errno.ENOENT:
+            raise
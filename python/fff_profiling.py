@@ -0,0 +1,302 @@
+# Hot path instrumentation, to find out where the time goes when lumisections
+# are late, without restarting the daemon under a profiler.
+#
+# The phase timers are always on. The simulation adds up how long it spends
+# in each phase of the emission (two readings of the monotonic clock per
+# step):
+# - sleep:        waiting for the deadline of the next step (see
+#                 fff_scheduler),
+# - start:        starting a run, until hltd watches its directory,
+# - backpressure: waiting for the consumers (see fff_consumption),
+# - reload:       applying a reloaded configuration (see fff_reload),
+# - plan:         choosing the source entries of a lumisection, or waiting
+#                 for the lookahead to prepare them (see fff_lookahead),
+# - render:       naming the output files and rendering their json,
+# - data:         publishing the data files,
+# - json:         writing the json files,
+# - logging:      the log line of every lumisection,
+# - checkpoint:   saving the checkpoint (see fff_checkpoint).
+# The data, json and render phases are added up over the emission workers, so
+# with more than one worker they can take longer than the lumisections did.
+# Only what is written to the RamdiskDir counts, the extra targets (see
+# fff_fanout) and the lookahead work at their own pace. The totals are in the
+# metrics and logged after every run, and when a lumisection is late we log
+# how the time since the previous lumisection was spent.
+#
+# On SIGUSR1 ("service fff_simulator profile"), the next Lumis lumisections
+# of [Profiling] are profiled, and the profile is written next to the log
+# file. Another SIGUSR1 ends the profile early. The signal handler only takes
+# note of the request: the profile starts and ends at lumisection boundaries,
+# so the simulation goes on as usual (only a bit slower while profiling).
+# There are two ways to profile (Mode):
+# - cprofile: Every function call of the simulation thread, with cProfile.
+#             Gives <log>.profile_<pid>_run<run>_ls<lumi>.prof (for pstats)
+#             and a .txt with the functions that took the most time. The
+#             emission workers and other threads are not in it.
+# - sampling: Every SampleInterval seconds, we take the stacks of all the
+#             threads. Gives a .stacks file with the collapsed stacks (for
+#             flamegraph.pl) and a .txt with the functions seen most.
+
+import os
+import sys
+import signal
+import pstats
+import logging
+import cProfile
+import tempfile
+import threading
+import StringIO
+import fff_logging
+from fff_scheduler import monotonic
+
+PHASES = ['sleep', 'start', 'backpressure', 'reload', 'plan', 'render', 'data',
+          'json', 'logging', 'checkpoint']
+
+PROFILE_MODES = ['cprofile', 'sampling']
+
+# Lines in the text summary of a profile:
+SUMMARY_LINES = 40
+
+class PhaseTimer(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.totals = dict.fromkeys(PHASES, 0.)
+        # Since the last lumisection boundary (see take_recent):
+        self.recent = dict.fromkeys(PHASES, 0.)
+
+    def add(self, phase, seconds):
+        with self.lock:
+            self.totals[phase] += seconds
+            self.recent[phase] += seconds
+
+    def measure(self, phase):
+        # Usage: with phases.measure('data'): ...
+        return _Measurement(self, phase)
+
+    def take_recent(self):
+        # Gives the seconds per phase since the last call.
+        with self.lock:
+            recent = self.recent
+            self.recent = dict.fromkeys(PHASES, 0.)
+        return recent
+
+    def get_summary(self, seconds_per_phase=None):
+        # The phases that took any time, the longest first.
+        if seconds_per_phase is None:
+            with self.lock:
+                seconds_per_phase = dict(self.totals)
+        phases = sorted([phase for phase in PHASES
+                         if seconds_per_phase[phase] >= 0.0005],
+                        key=lambda phase: -seconds_per_phase[phase])
+        return ', '.join(['%s %.3f s' % (phase, seconds_per_phase[phase])
+                          for phase in phases]) or 'nothing measured'
+
+
+class _UntimedPhases(PhaseTimer):
+    # For work that does not count (see above).
+
+    def add(self, phase, seconds):
+        pass
+
+
+class _Measurement(object):
+
+    def __init__(self, phase_timer, phase):
+        self.phase_timer = phase_timer
+        self.phase = phase
+
+    def __enter__(self):
+        self.start = monotonic()
+
+    def __exit__(self, exception_type, exception, traceback):
+        self.phase_timer.add(self.phase, monotonic() - self.start)
+
+
+# The phases of the simulation in this process (with multiple simulations,
+# each has its own process, see fff_supervisor):
+phases = PhaseTimer()
+untimed = _UntimedPhases()
+
+
+class Profiler(object):
+
+    def __init__(self, cfg):
+        # The settings of [Profiling] are taken from the configuration when
+        # a profile starts, so that they can be reloaded.
+        self.cfg = cfg
+        self.requested = threading.Event()
+        self.profile = None
+        self.sampler = None
+        self.remaining_lumis = 0
+        self.base_path = None
+        self.profiles = 0
+
+    def install(self):
+        signal.signal(signal.SIGUSR1, self.handle_signal)
+
+    def handle_signal(self, signal_number, frame):
+        self.requested.set()
+
+    def is_active(self):
+        return bool(self.profile or self.sampler)
+
+    def at_lumi_boundary(self, run_number, lumi_number):
+        # Called before every lumisection we write: starts or ends the
+        # profile if that was requested, and ends it after Lumis
+        # lumisections.
+        if self.requested.is_set():
+            self.requested.clear()
+            if self.is_active():
+                logging.info('Profile ended early.')
+                self.stop()
+            else:
+                self.start(run_number, lumi_number)
+        elif self.is_active():
+            self.remaining_lumis -= 1
+            if self.remaining_lumis <= 0:
+                self.stop()
+
+    def start(self, run_number, lumi_number):
+        mode = self.cfg.profile_mode
+        self.remaining_lumis = max(self.cfg.profile_lumis, 1)
+        self.base_path = self.get_base_path(run_number, lumi_number)
+        logging.info('Profiling the next %d lumisections (%s).'
+                     % (self.remaining_lumis, mode))
+        if mode == 'sampling':
+            self.sampler = _StackSampler(self.cfg.profile_interval)
+            self.sampler.start()
+        else:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+
+    def stop(self, wait=False):
+        # The profile is written in the background (unless we wait for it,
+        # e.g. before the simulation ends).
+        if self.profile:
+            self.profile.disable()
+            writer = threading.Thread(target=self.write_profile,
+                                      name='ProfileWriter',
+                                      args=(self.profile, self.base_path))
+            self.profile = None
+        elif self.sampler:
+            self.sampler.stop()
+            writer = threading.Thread(target=self.write_samples,
+                                      name='ProfileWriter',
+                                      args=(self.sampler, self.base_path))
+            self.sampler = None
+        else:
+            return
+        self.profiles += 1
+        writer.daemon = True
+        writer.start()
+        if wait:
+            writer.join()
+
+    def get_base_path(self, run_number, lumi_number):
+        # Next to the log file, unless configured otherwise.
+        log_file_name = fff_logging.get_log_file_name() or 'fff_simulator'
+        profile_dir = self.cfg.profile_dir or \
+                      os.path.dirname(os.path.abspath(log_file_name))
+        if not os.path.isdir(profile_dir):
+            profile_dir = tempfile.gettempdir()
+        base_name = os.path.splitext(os.path.basename(log_file_name))[0]
+        return os.path.join(profile_dir, '%s.profile_%d_run%d_ls%04d'
+                            % (base_name, os.getpid(), run_number,
+                               lumi_number))
+
+    def write_profile(self, profile, base_path):
+        try:
+            profile.dump_stats(base_path + '.prof')
+            summary = StringIO.StringIO()
+            stats = pstats.Stats(profile, stream=summary)
+            stats.sort_stats('cumulative').print_stats(SUMMARY_LINES)
+            stats.sort_stats('time').print_stats(SUMMARY_LINES)
+            with open(base_path + '.txt', 'w') as summary_file:
+                summary_file.write(summary.getvalue())
+        except (IOError, OSError), error:
+            logging.error('Could not write the profile %s: %s'
+                          % (base_path, error))
+            return
+        logging.info('Wrote the profile to %s.prof and %s.txt.'
+                     % (base_path, base_path))
+
+    def write_samples(self, sampler, base_path):
+        try:
+            with open(base_path + '.stacks', 'w') as stacks_file:
+                for stack, count in sorted(sampler.stacks.items()):
+                    stacks_file.write('%s %d\n' % (stack, count))
+            with open(base_path + '.txt', 'w') as summary_file:
+                summary_file.write(sampler.get_summary())
+        except (IOError, OSError), error:
+            logging.error('Could not write the profile %s: %s'
+                          % (base_path, error))
+            return
+        logging.info('Wrote the profile (%d samples) to %s.stacks and %s.txt.'
+                     % (sampler.samples, base_path, base_path))
+
+
+class _StackSampler(threading.Thread):
+
+    def __init__(self, interval):
+        threading.Thread.__init__(self, name='ProfileSampler')
+        self.daemon = True
+        self.interval = max(interval, 0.001)
+        self.stop_event = threading.Event()
+        self.samples = 0
+        # Per collapsed stack (the thread name, then the functions from the
+        # outermost to the innermost, separated by ;), how often we saw it:
+        self.stacks = {}
+        # Per function: how often it was running, and how often it was on
+        # the stack:
+        self.running = {}
+        self.on_stack = {}
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            self.take_sample()
+
+    def take_sample(self):
+        thread_names = dict([(thread.ident, thread.name)
+                             for thread in threading.enumerate()])
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == self.ident:
+                continue
+            functions = []
+            while frame:
+                code = frame.f_code
+                functions.append('%s (%s:%d)'
+                                 % (code.co_name,
+                                    os.path.basename(code.co_filename),
+                                    code.co_firstlineno))
+                frame = frame.f_back
+            if not functions:
+                continue
+            functions.reverse()
+            stack = ';'.join([thread_names.get(thread_id, str(thread_id))] +
+                             functions)
+            self.stacks[stack] = self.stacks.get(stack, 0) + 1
+            self.running[functions[-1]] = \
+                self.running.get(functions[-1], 0) + 1
+            for function in set(functions):
+                self.on_stack[function] = self.on_stack.get(function, 0) + 1
+        self.samples += 1
+
+    def stop(self):
+        self.stop_event.set()
+        self.join()
+
+    def get_summary(self):
+        lines = ['%d samples, every %.3f s, of all the threads.'
+                 % (self.samples, self.interval), '']
+        for title, counts in [('Running (samples, over all threads):',
+                               self.running),
+                              ('On the stack (samples, over all threads):',
+                               self.on_stack)]:
+            lines.append(title)
+            for function, count in sorted(counts.items(),
+                                          key=lambda item: -item[1])[
+                                              :SUMMARY_LINES]:
+                lines.append('%8d  %s' % (count, function))
+            lines.append('')
+        return '\n'.join(lines)
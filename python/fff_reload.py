@@ -0,0 +1,145 @@
+# Hot reconfiguration: on SIGHUP ("service fff_simulator reload") the
+# configuration file is read again and the changes are applied while we keep
+# simulating, without restarting hltd or cleaning the ramdisk.
+#
+# The signal handler only takes note of the request, the configuration is
+# read at the next lumisection boundary. The changes are applied:
+# - at the next lumisection: the rate and the run shape within the run
+#   (LUMI_SETTINGS), the retention, the backpressure and the settings of the
+#   next profile (see fff_profiling),
+# - at the next run: everything that decides what a run looks like
+#   (RUN_SETTINGS), like the run key and the source run. A new source run is
+#   only used if it is available (it is staged first if needed) and usable,
+#   otherwise we keep the old one.
+# Other changes (e.g. the RamdiskDir, the FUs, the streams or the
+# MetricsPort) need a restart, for those we only log that they are ignored.
+
+import signal
+import logging
+import threading
+
+LUMI_SETTINGS = ['seconds_per_lumi', 'seconds_per_skipped_lumi',
+                 'lumis_to_skip', 'overrun_policy', 'stress_mode',
+                 'target_mb_per_second', 'report_interval', 'publish_mode',
+                 'atomic_publish', 'fsync_mode', 'profile_lumis',
+                 'profile_mode', 'profile_interval', 'profile_dir']
+
+RETENTION_SETTINGS = [('keep_runs', 'keep_runs'),
+                      ('keep_lumis', 'keep_lumis'),
+                      ('max_bytes', 'max_bytes'),
+                      ('max_usage_percent', 'max_usage_percent'),
+                      ('retention_interval', 'check_interval'),
+                      ('retention_wait_for_consumption',
+                       'wait_for_consumption'),
+                      ('max_unconsumed_seconds', 'max_unconsumed_seconds')]
+
+BACKPRESSURE_SETTINGS = [('max_backlog', 'max_backlog'),
+                         ('backpressure_timeout', 'backpressure_timeout')]
+
+RUN_SETTINGS = ['run_key', 'lumis_per_run', 'seconds_before_first_lumi',
+                'seconds_between_runs', 'number_of_runs', 'replay',
+                'replay_trace_file', 'replay_time_scale',
+                'replay_volume_scale']
+
+# Changing any of these means simulating another source:
+SOURCE_SETTINGS = ['source_run', 'source_dir', 'alternative_source_dirs',
+                   'staging_workers', 'staging_initial_lumis']
+
+# The streams need a restart, since the replay (see fff_trace) and the
+# checkpoint (see fff_checkpoint) keep state per stream.
+RESTART_SETTINGS = ['ramdisk_dir', 'fu_data_dir', 'fu_host_names',
+                    'host_timeout', 'ssh_control_persist', 'metrics_port',
+                    'emission_workers', 'lookahead_depth', 'lookahead_max_mb',
+                    'observe_consumption', 'synthetic', 'simulation_files',
+                    'checkpoint_file', 'cleanup_workers',
+                    'background_cleanup', 'extra_targets', 'stream_specs']
+
+class ConfigurationReloader(object):
+
+    def __init__(self, load_configuration, scheduler=None,
+                 rate_controller=None, retention_manager=None,
+                 consumption_observer=None):
+        # load_configuration() gives the new configuration.
+        self.load_configuration = load_configuration
+        self.scheduler = scheduler
+        self.rate_controller = rate_controller
+        self.retention_manager = retention_manager
+        self.consumption_observer = consumption_observer
+        self.reload_requested = threading.Event()
+        # The new configuration, until the next run boundary:
+        self.pending_cfg = None
+        self.reloads = 0
+
+    def install(self):
+        # Signal handlers can only be installed from the main thread.
+        signal.signal(signal.SIGHUP, self.handle_signal)
+
+    def handle_signal(self, signal_number, frame):
+        self.reload_requested.set()
+
+    def apply_lumi_settings(self, cfg):
+        # Called at every lumisection boundary. Reads the configuration if
+        # that was requested and applies what can change within a run.
+        if not self.reload_requested.is_set():
+            return
+        self.reload_requested.clear()
+        try:
+            new_cfg = self.load_configuration()
+        except Exception, error:
+            logging.error('Could not reload the configuration, keeping the '
+                          'current one: %s' % error)
+            return
+        self.reloads += 1
+        for name in RESTART_SETTINGS:
+            if getattr(new_cfg, name) != getattr(cfg, name):
+                logging.warning('Reload: %s changed, this needs a restart.'
+                                % name)
+        for name in LUMI_SETTINGS:
+            self.apply_setting(cfg, new_cfg, name)
+        if self.scheduler:
+            self.scheduler.set_overrun_policy(cfg.overrun_policy)
+        if self.rate_controller:
+            self.rate_controller.set_targets(cfg.seconds_per_lumi,
+                                             cfg.target_mb_per_second,
+                                             cfg.report_interval)
+        for name, attribute in RETENTION_SETTINGS:
+            self.apply_setting(cfg, new_cfg, name)
+            if self.retention_manager:
+                setattr(self.retention_manager, attribute, getattr(cfg, name))
+        if self.retention_manager and self.retention_manager.is_enabled() \
+           and self.retention_manager.ident is None:
+            # It was not enabled before, so it never started:
+            self.retention_manager.start()
+        for name, attribute in BACKPRESSURE_SETTINGS:
+            self.apply_setting(cfg, new_cfg, name)
+            if self.consumption_observer:
+                setattr(self.consumption_observer, attribute,
+                        getattr(cfg, name))
+        # The rest waits for the next run:
+        self.pending_cfg = new_cfg
+
+    def apply_run_settings(self, cfg):
+        # Called before every run. Applies the rest of the reloaded
+        # configuration and gives the previous values of the run settings
+        # that changed: the caller still needs to apply a new source (and can
+        # go back to the previous one if the new one cannot be used).
+        self.apply_lumi_settings(cfg)
+        if not self.pending_cfg:
+            return {}
+        new_cfg, self.pending_cfg = self.pending_cfg, None
+        previous_values = {}
+        for name in RUN_SETTINGS + SOURCE_SETTINGS:
+            previous_value = getattr(cfg, name)
+            if self.apply_setting(cfg, new_cfg, name):
+                previous_values[name] = previous_value
+        return previous_values
+
+    def apply_setting(self, cfg, new_cfg, name):
+        old_value = getattr(cfg, name)
+        new_value = getattr(new_cfg, name)
+        if new_value == old_value:
+            return False
+        logging.info('Reload: %s changed from %s to %s.'
+                     % (name, old_value, new_value))
+        setattr(cfg, name, new_value)
+        return True
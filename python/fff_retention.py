@@ -0,0 +1,247 @@
+# The retention manager removes old simulated data from the ramdisk while the
+# simulation is running, so that we can keep simulating for days without
+# filling up the (RAM backed) ramdisk.
+#
+# It runs in a background thread and regularly looks at the run directories
+# on the ramdisk. Depending on the configuration it
+# - only keeps the newest KeepRuns runs,
+# - only keeps the newest KeepLumis lumisections (over all runs),
+# - deletes the oldest lumisections as long as the simulated runs take more
+#   than MaxBytes, or the ramdisk is more than MaxUsagePercent full.
+# The newest lumisection and the run in progress are never deleted (only old
+# lumisections of the run in progress are).
+#
+# With WaitForConsumption, lumisections that were not consumed yet (see
+# fff_consumption) are not deleted either, nor the runs they are in, until
+# MaxUnconsumedSeconds after they were published. Without that limit, a
+# consumer that stops reading (or reads over NFS, where we cannot see it)
+# would keep everything on the ramdisk, so we warn when this holds up the
+# retention.
+#
+# Sizes only count what deleting a file actually frees: a file that is
+# hardlinked to the source run (see PublishMode) takes no extra space. For
+# the watermarks, we work out how many bytes are over the limit and delete
+# lumisections until they freed that much, skipping the lumisections that
+# deleting would not free anything of. Deleting hardlinked lumisections can
+# never bring the ramdisk usage down, so we leave them alone and warn if we
+# cannot get under the limit.
+
+import os
+import shutil
+import logging
+import threading
+from fff_os_operations import RUN_DIR_PATTERN, LUMI_FILE_PATTERN
+
+class RetentionManager(threading.Thread):
+
+    def __init__(self, ramdisk_dir, keep_runs=0, keep_lumis=0, max_bytes=0,
+                 max_usage_percent=0., check_interval=10.,
+                 consumption_observer=None, wait_for_consumption=False,
+                 max_unconsumed_seconds=0.):
+        threading.Thread.__init__(self, name='RetentionManager')
+        self.daemon = True
+        self.ramdisk_dir = ramdisk_dir
+        self.keep_runs = keep_runs
+        self.keep_lumis = keep_lumis
+        self.max_bytes = max_bytes
+        self.max_usage_percent = max_usage_percent
+        self.check_interval = check_interval
+        self.consumption_observer = consumption_observer
+        self.wait_for_consumption = wait_for_consumption
+        self.max_unconsumed_seconds = max_unconsumed_seconds
+        self.stop_event = threading.Event()
+        # What we reclaimed so far:
+        self.reclaimed_bytes = 0
+        self.reclaimed_files = 0
+        self.deleted_runs = 0
+        self.deleted_lumis = 0
+        # Whether we are over a limit without anything left to delete, and
+        # whether that is because of lumisections that were not consumed:
+        self.stuck = False
+        self.waiting = False
+        self.unobserved = False
+
+    def is_enabled(self):
+        return bool(self.keep_runs or self.keep_lumis or self.max_bytes or
+                    self.max_usage_percent)
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                self.apply()
+            except Exception, error:
+                # Files can disappear under our feet (e.g. deleted by hltd),
+                # that should not stop the retention.
+                logging.error('Retention failed: %s' % error)
+            self.stop_event.wait(self.check_interval)
+
+    def stop(self):
+        self.stop_event.set()
+
+    def get_summary(self):
+        return ('reclaimed %.1f MB in %d files (%d runs, %d lumisections)'
+                % (self.reclaimed_bytes / 1e6, self.reclaimed_files,
+                   self.deleted_runs, self.deleted_lumis))
+
+    def scan(self):
+        # Gives the run numbers (oldest first) and, per run, the lumisections
+        # with their files and sizes: {run: {lumi: [(path, size), ...]}}.
+        # Files that don't belong to a lumisection (e.g. the EoR file) are
+        # listed as lumisection 0.
+        runs = {}
+        for name in os.listdir(self.ramdisk_dir):
+            match = RUN_DIR_PATTERN.match(name)
+            if not match:
+                continue
+            run_number = int(match.group(1))
+            run_dir = os.path.join(self.ramdisk_dir, name)
+            lumis = {}
+            for file_name in os.listdir(run_dir):
+                full_name = os.path.join(run_dir, file_name)
+                try:
+                    size = get_reclaimable_size(full_name)
+                except OSError:
+                    continue
+                lumi_match = LUMI_FILE_PATTERN.match(file_name)
+                lumi_number = 0
+                if lumi_match:
+                    lumi_number = int(lumi_match.group(2))
+                lumis.setdefault(lumi_number, []).append((full_name, size))
+            runs[run_number] = lumis
+        return sorted(runs.keys()), runs
+
+    def apply(self):
+        run_numbers, runs = self.scan()
+        if not run_numbers:
+            return
+        reclaimed_before = self.reclaimed_bytes
+        unconsumed_lumis = self.get_unconsumed_lumis()
+        unconsumed_runs = set([run_number for run_number, lumi_number
+                               in unconsumed_lumis])
+        # 1. Whole runs:
+        excess_runs = 0
+        if self.keep_runs:
+            for run_number in run_numbers[:-max(self.keep_runs, 1)]:
+                if run_number in unconsumed_runs:
+                    excess_runs += 1
+                else:
+                    run_numbers.remove(run_number)
+                    self.delete_run(run_number)
+        # All the remaining lumisections that we may delete, oldest first
+        # (without the EoR and the newest lumisection):
+        lumis = []
+        for run_number in run_numbers:
+            for lumi_number in sorted(runs[run_number].keys()):
+                if lumi_number:
+                    lumis.append((run_number, lumi_number))
+        excess_lumis = len(lumis) - max(self.keep_lumis, 1)
+        lumis = [lumi for lumi in lumis[:-1] if lumi not in unconsumed_lumis]
+        # 2. Lumisections:
+        if self.keep_lumis:
+            while excess_lumis > 0 and lumis:
+                run_number, lumi_number = lumis.pop(0)
+                self.delete_lumi(runs[run_number].pop(lumi_number))
+                excess_lumis -= 1
+        # 3. Watermarks:
+        total_bytes = sum([size for run_number in run_numbers
+                           for files in runs[run_number].values()
+                           for path, size in files])
+        excess_bytes = self.get_excess_bytes(total_bytes)
+        lumis = [(run_number, lumi_number) for run_number, lumi_number in lumis
+                 if [size for path, size in runs[run_number][lumi_number]
+                     if size]]
+        while excess_bytes > 0 and lumis:
+            run_number, lumi_number = lumis.pop(0)
+            excess_bytes -= self.delete_lumi(
+                                runs[run_number].pop(lumi_number))
+        waiting = bool(unconsumed_lumis) and \
+                  (excess_runs > 0 or excess_lumis > 0 or excess_bytes > 0)
+        if waiting and not self.waiting:
+            logging.warning('Retention: over the limits, but waiting for %d '
+                            'lumisections to be consumed (see '
+                            'MaxUnconsumedSeconds).' % len(unconsumed_lumis))
+        elif excess_bytes > 0 and not waiting and not self.stuck:
+            logging.warning('Retention: %.1f MB over the limit, but no '
+                            'lumisection is left that would free any space.'
+                            % (excess_bytes / 1e6))
+        self.waiting = waiting
+        self.stuck = excess_bytes > 0
+        # Finished runs that have no lumisections left can go as well:
+        for run_number in run_numbers[:-1]:
+            if not [lumi for lumi in runs[run_number] if lumi] and \
+               run_number not in unconsumed_runs:
+                self.delete_run(run_number)
+        if self.reclaimed_bytes != reclaimed_before:
+            logging.info('Retention: %s' % self.get_summary())
+
+    def get_unconsumed_lumis(self):
+        # The (run, lumi) that we may not delete yet.
+        if not self.wait_for_consumption:
+            return set()
+        if not self.consumption_observer:
+            # E.g. when WaitForConsumption was only enabled by a reload.
+            if not self.unobserved:
+                logging.warning('Retention: cannot wait for the consumption, '
+                                'it is not observed (this needs a '
+                                'restart).')
+                self.unobserved = True
+            return set()
+        return self.consumption_observer.get_unconsumed_lumis(
+                   self.max_unconsumed_seconds)
+
+    def get_excess_bytes(self, total_bytes):
+        # How many bytes we are over the watermarks (0 or less if we are
+        # not).
+        excess_bytes = 0
+        if self.max_bytes:
+            excess_bytes = total_bytes - self.max_bytes
+        if self.max_usage_percent:
+            statvfs = os.statvfs(self.ramdisk_dir)
+            used = (statvfs.f_blocks - statvfs.f_bfree) * statvfs.f_frsize
+            allowed = statvfs.f_blocks * statvfs.f_frsize * \
+                      self.max_usage_percent / 100.
+            excess_bytes = max(excess_bytes, used - allowed)
+        return excess_bytes
+
+    def delete_lumi(self, files):
+        # Gives the bytes this freed.
+        freed_bytes = 0
+        for path, size in files:
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            freed_bytes += size
+            self.reclaimed_files += 1
+        self.reclaimed_bytes += freed_bytes
+        self.deleted_lumis += 1
+        return freed_bytes
+
+    def delete_run(self, run_number):
+        run_dir = os.path.join(self.ramdisk_dir, 'run%d' % run_number)
+        for dir_path, dir_names, file_names in os.walk(run_dir):
+            for file_name in file_names:
+                try:
+                    self.reclaimed_bytes += get_reclaimable_size(
+                        os.path.join(dir_path, file_name))
+                    self.reclaimed_files += 1
+                except OSError:
+                    pass
+        shutil.rmtree(run_dir, ignore_errors=True)
+        if self.consumption_observer:
+            self.consumption_observer.forget_run(run_number)
+        global_file = os.path.join(self.ramdisk_dir,
+                                   '.run%d.global' % run_number)
+        if os.path.exists(global_file):
+            os.remove(global_file)
+        self.deleted_runs += 1
+        logging.info('Retention: deleted run directory %s' % run_dir)
+
+
+def get_reclaimable_size(path, stat=None):
+    # The lstat result of the path can be given if we have it already.
+    if stat is None:
+        stat = os.lstat(path)
+    if stat.st_nlink > 1:
+        return 0
+    return stat.st_size
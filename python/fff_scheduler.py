@@ -0,0 +1,282 @@
+# The scheduler decides when the next step of the simulation (a new run, a
+# lumisection, the end of a run) is due.
+#
+# All deadlines are absolute: they are computed from the start of the
+# simulation by adding up the durations of all the steps so far, on a
+# monotonic clock. This way the time spent writing the files does not add up
+# over the lumisections and the simulation does not drift away from the
+# intended rate.
+#
+# When we are late anyway (e.g. because copying took longer than a
+# lumisection), the overrun policy decides what happens:
+# - catchup: The late lumisections are written immediately, one after the
+#            other, until we are back on schedule.
+# - skip:    Lumisections for which the whole slot already passed are not
+#            written at all, just like lumisections lost by the DAQ.
+# - stretch: The schedule is shifted by the lateness, so the following
+#            lumisections keep their normal spacing.
+#
+# The rate controller compares the rate we actually achieve (lumisections and
+# megabytes per second) with the rate of the schedule. This is what we look
+# at in stress tests, to find out where the throughput ceiling is.
+
+import time
+import ctypes
+import logging
+from collections import deque
+
+OVERRUN_POLICIES = ['catchup', 'skip', 'stretch']
+
+# From linux/time.h
+CLOCK_MONOTONIC = 1
+
+class _Timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+_clock_gettime = []
+
+def monotonic():
+    # CLOCK_MONOTONIC from the C library. If that is not possible, we fall
+    # back to the wall clock.
+    if not _clock_gettime:
+        try:
+            function = ctypes.CDLL(None, use_errno=True).clock_gettime
+            function.argtypes = [ctypes.c_int, ctypes.POINTER(_Timespec)]
+        except (OSError, AttributeError):
+            logging.error('No monotonic clock available, using time.time.')
+            function = None
+        _clock_gettime.append(function)
+    if not _clock_gettime[0]:
+        return time.time()
+    timespec = _Timespec()
+    if _clock_gettime[0](CLOCK_MONOTONIC, ctypes.byref(timespec)) != 0:
+        return time.time()
+    return timespec.tv_sec + timespec.tv_nsec * 1e-9
+
+
+class LumiScheduler(object):
+
+    def __init__(self, overrun_policy='catchup'):
+        self.set_overrun_policy(overrun_policy)
+        self.next_deadline = monotonic()
+        # Lateness bookkeeping. We keep the totals and the most recent values.
+        self.lumis = 0
+        self.late_lumis = 0
+        self.dropped_lumis = 0
+        self.total_lateness = 0.
+        self.max_lateness = 0.
+        self.last_lateness = 0.
+        self.recent_lateness = deque(maxlen=1000)
+
+    def set_overrun_policy(self, overrun_policy):
+        if overrun_policy not in OVERRUN_POLICIES:
+            logging.error('Unknown OverrunPolicy %s, using catchup instead.'
+                          % overrun_policy)
+            overrun_policy = 'catchup'
+        self.overrun_policy = overrun_policy
+
+    def start(self):
+        self.next_deadline = monotonic()
+
+    def get_deadline_time(self):
+        # The next deadline as a time.time(), which (unlike the monotonic
+        # clock) still means something after a restart (see fff_checkpoint).
+        return time.time() + self.next_deadline - monotonic()
+
+    def set_deadline_time(self, deadline_time):
+        self.next_deadline = monotonic() + deadline_time - time.time()
+
+    def advance(self, seconds):
+        # The next step is due the given amount of seconds after the current
+        # one.
+        self.next_deadline += seconds
+
+    def wait(self):
+        # Sleeps until the next deadline and returns how late we are (0 if we
+        # are on time).
+        remaining = self.next_deadline - monotonic()
+        if remaining > 0:
+            # A signal (e.g. SIGHUP, see fff_reload) ends the sleep early.
+            while remaining > 0:
+                time.sleep(remaining)
+                remaining = self.next_deadline - monotonic()
+            return 0.
+        lateness = -remaining
+        if self.overrun_policy == 'stretch':
+            self.next_deadline += lateness
+        return lateness
+
+    def get_current_deadline(self):
+        # When the current step was due (after wait, before advance).
+        return self.next_deadline
+
+    def wait_for_lumi(self, seconds_per_lumi):
+        # Same as wait, but also records the lateness of the lumisection and
+        # tells whether it should still be written (which is only not the
+        # case with the skip policy, when the whole slot passed already).
+        lateness = self.wait()
+        self.lumis += 1
+        self.last_lateness = lateness
+        self.recent_lateness.append(lateness)
+        self.total_lateness += lateness
+        self.max_lateness = max(self.max_lateness, lateness)
+        if lateness > 0:
+            self.late_lumis += 1
+        if self.overrun_policy == 'skip' and lateness >= seconds_per_lumi:
+            self.dropped_lumis += 1
+            return lateness, False
+        return lateness, True
+
+    def get_summary(self):
+        mean_lateness = 0.
+        if self.lumis:
+            mean_lateness = self.total_lateness / self.lumis
+        return ('%d lumisections, %d late, %d dropped, mean lateness %.3f s, '
+                'max lateness %.3f s' % (self.lumis, self.late_lumis,
+                                         self.dropped_lumis, mean_lateness,
+                                         self.max_lateness))
+
+
+class RateController(object):
+    # The target rate is the one of the schedule itself: the lumisections we
+    # wrote, over the time the schedule covered meanwhile. That includes the
+    # skipped lumisections, the wait for the first lumisection and the time
+    # between runs, which a plain 1 / SecondsPerLumi does not. We follow how
+    # far behind its deadline the latest lumisection was written: as long as
+    # that does not grow, we keep up with the schedule.
+
+    def __init__(self, seconds_per_lumi, target_mb_per_second=0.,
+                 report_interval=60.):
+        self.set_targets(seconds_per_lumi, target_mb_per_second,
+                         report_interval)
+        self.start_time = monotonic()
+        self.lumis = 0
+        self.bytes = 0
+        self.files = 0
+        # Per lumisection, the most recent time it took to write it and how
+        # late it was written:
+        self.emission_times = deque(maxlen=100000)
+        self.lateness = deque(maxlen=100000)
+        # How far behind the schedule we were, when the first lumisection
+        # was written and after the latest one (see get_lag):
+        self.first_lag = None
+        self.first_bytes = 0
+        self.last_deadline = None
+        # When the latest lumisection was written:
+        self.last_time = None
+        # The same, for the current reporting window:
+        self.window_start_time = self.start_time
+        self.window_start_lag = None
+        self.window_lumis = 0
+        self.window_bytes = 0
+
+    def set_targets(self, seconds_per_lumi, target_mb_per_second=0.,
+                    report_interval=60.):
+        # Only used until the first lumisection tells us more (0 means as
+        # fast as possible, without a target):
+        self.seconds_per_lumi = seconds_per_lumi
+        # Without an explicit target for the throughput, we derive it from
+        # the average lumisection size and the target lumisection rate.
+        self.target_mb_per_second = target_mb_per_second
+        self.report_interval = report_interval
+
+    def record_lumi(self, bytes_written, files_written=0, emission_time=0.,
+                    lateness=0., deadline=None):
+        # The deadline is the (monotonic) time the lumisection was due (see
+        # LumiScheduler.get_current_deadline).
+        self.lumis += 1
+        self.bytes += bytes_written
+        self.files += files_written
+        self.emission_times.append(emission_time)
+        self.lateness.append(lateness)
+        self.window_lumis += 1
+        self.window_bytes += bytes_written
+        if deadline is not None:
+            self.last_deadline = deadline
+            self.last_time = monotonic()
+            if self.first_lag is None:
+                self.first_lag = self.get_lag(self.last_time)
+                self.first_bytes = bytes_written
+                self.start_time = self.last_time
+                self.window_start_time = self.start_time
+                self.window_start_lag = self.first_lag
+                # The first lumisection only starts the measurement:
+                self.window_lumis = 0
+                self.window_bytes = 0
+
+    def get_lag(self, now=None):
+        if now is None:
+            now = monotonic()
+        return now - self.last_deadline
+
+    def get_target_lumis_per_second(self, lumis, seconds, start_lag,
+                                    end_lag=None):
+        # The lumisections written in the given seconds, over the part of
+        # them the schedule covered (by default up to now).
+        if start_lag is None:
+            if self.seconds_per_lumi <= 0:
+                return 0.
+            return 1. / self.seconds_per_lumi
+        if end_lag is None:
+            end_lag = self.get_lag()
+        scheduled_seconds = seconds - (end_lag - start_lag)
+        if scheduled_seconds <= 1e-6:
+            # Everything was due at once (e.g. SecondsPerLumi = 0).
+            return 0.
+        return lumis / scheduled_seconds
+
+    def get_target_mb_per_second(self, target_lumis_per_second):
+        if self.target_mb_per_second:
+            return self.target_mb_per_second
+        if not self.lumis:
+            return 0.
+        return (self.bytes / 1e6 / self.lumis) * target_lumis_per_second
+
+    def format_rate(self, lumis, bytes_written, seconds,
+                    target_lumis_per_second):
+        seconds = max(seconds, 1e-9)
+        return ('%.3f lumis/s (target %s), %.2f MB/s (target %.2f)'
+                % (lumis / seconds,
+                   '%.3f' % target_lumis_per_second
+                   if target_lumis_per_second else 'none',
+                   bytes_written / 1e6 / seconds,
+                   self.get_target_mb_per_second(target_lumis_per_second)))
+
+    def report_if_due(self):
+        now = monotonic()
+        window = now - self.window_start_time
+        if window < self.report_interval:
+            return
+        target = self.get_target_lumis_per_second(self.window_lumis, window,
+                                                  self.window_start_lag)
+        logging.info('Achieved rate: %s' % self.format_rate(
+                         self.window_lumis, self.window_bytes, window,
+                         target))
+        achieved = self.window_lumis / window
+        if target and achieved < 0.95 * target:
+            logging.warning('Achieved lumisection rate is %.1f%% below '
+                            'target.' % (100. * (1. - achieved / target)))
+        self.window_start_time = now
+        if self.last_deadline is not None:
+            self.window_start_lag = self.get_lag()
+        self.window_lumis = 0
+        self.window_bytes = 0
+
+    def get_summary(self):
+        # Up to the latest lumisection, so that the wait after it (e.g. for
+        # the end of the run) does not count.
+        seconds = monotonic() - self.start_time
+        lumis = self.lumis
+        end_lag = None
+        if self.first_lag is not None:
+            seconds = self.last_time - self.start_time
+            end_lag = self.get_lag(self.last_time)
+            # Without the first lumisection, which started the measurement:
+            lumis -= 1
+        return '%d lumisections, %.1f MB, %s' % (
+                   self.lumis, self.bytes / 1e6,
+                   self.format_rate(lumis, self.bytes - self.first_bytes,
+                                    seconds,
+                                    self.get_target_lumis_per_second(
+                                        lumis, seconds, self.first_lag,
+                                        end_lag)))
@@ -7,6 +7,12 @@
 # The FFF Simulator is started as a daemon by the root user on the BU.
 # This way anyone can start and stop the simulation at any time.
 # Do: "service fff_simulator start|stop|restart"
+# Most changes of the configuration can also be applied while running,
+# without restarting hltd (see fff_reload).
+# Do: "service fff_simulator reload"
+# Where the time goes is always measured per phase, and a profile of the next
+# lumisections can be taken while running (see fff_profiling).
+# Do: "service fff_simulator profile"
 # It also allows users to easily check the status of the daemon.
 # Do: "service fff_simulator status"
 #
@@ -25,14 +31,34 @@ import os
 import re
 import sys
 import time
-import glob
-import json
-import shutil
+import signal
 import logging
 import ConfigParser
 import fff_os_operations
+import fff_staging
+import fff_metrics
+import fff_logging
+import fff_source_index
+import fff_trace
+import fff_reload
+import fff_cleanup
+import fff_archive
+import fff_profiling
+import fff_synthetic
+from fff_source_index import SourceRunIndex
+from fff_scheduler import LumiScheduler, RateController, monotonic
+from fff_retention import RetentionManager
+from fff_consumption import ConsumptionObserver
+from fff_supervisor import SimulationSupervisor
+from fff_synthetic import SyntheticSource
+from fff_trace import TraceReplay
+from fff_reload import ConfigurationReloader
+from fff_lookahead import LookaheadStager
+from fff_checkpoint import Checkpoint
+from fff_fanout import Fanout
+from fff_profiling import Profiler
 from daemon import Daemon
-from subprocess import Popen, PIPE
+from multiprocessing.pool import ThreadPool
 
 # Logging configuration:
 # We try to determine the location of the log file from the config file
@@ -46,40 +72,243 @@ except:
 # Otherwise we take just the program name + .log as a fallback
 if not log_file_name:
     log_file_name = sys.argv[0] + ".log"
+# How much we log: DEBUG logs every file we write, INFO one line per
+# lumisection. By default the log file is written by a background thread, so
+# that logging does not slow down the simulation (see fff_logging). With
+# MaxBytes the log file is rotated, keeping BackupCount old ones.
+log_level = 'INFO'
+async_logging = True
+log_max_bytes = 0
+log_backup_count = 5
+try:
+    if config.has_option('Logging', 'LogLevel'):
+        log_level = config.get('Logging', 'LogLevel').upper()
+    if config.has_option('Logging', 'AsyncLogging'):
+        async_logging = config.getboolean('Logging', 'AsyncLogging')
+    if config.has_option('Logging', 'MaxBytes'):
+        log_max_bytes = config.getint('Logging', 'MaxBytes')
+    if config.has_option('Logging', 'BackupCount'):
+        log_backup_count = config.getint('Logging', 'BackupCount')
+except:
+    print "Invalid logging config in %s" % CONFIGURATION_FILE
 # Configure the actual logging:
-logging.basicConfig(filename=log_file_name,
-                    format='%(asctime)s %(levelname)s: %(message)s',
-                    level=logging.DEBUG)
+fff_logging.configure_logging(log_file_name,
+                              getattr(logging, log_level, logging.INFO),
+                              async_logging, log_max_bytes, log_backup_count)
+
+class Simulation(object):
+    # What a simulation works with, besides its configuration: the source
+    # index and the components that publish, time and follow the
+    # lumisections (see FFFSimulator.create_simulation). The steps of the
+    # simulation get it as a whole, instead of each of its parts. The
+    # components that are not configured are None.
+
+    def __init__(self, cfg, source_index):
+        self.cfg = cfg
+        self.source_index = source_index
+        # All the timing is done by one scheduler, so that the runs follow
+        # each other without drifting:
+        self.scheduler = LumiScheduler(cfg.overrun_policy)
+        self.emission_pool = None
+        self.lookahead = None
+        self.fanout = None
+        self.rate_controller = None
+        self.retention_manager = None
+        self.consumption_observer = None
+        self.replay = None
+        self.checkpoint = None
+        self.profiler = None
+        self.metrics = None
+        self.metrics_server = None
+        self.reloader = None
+
 
 class FFFSimulator(Daemon):
 
+    # Set by "service fff_simulator resume" (see fff_checkpoint):
+    resume_requested = False
+
     def run(self):
         # Load config variables to local variables for easy usage
         cfg = FFFSimulator.load_configuration()
+        fff_os_operations.configure_ssh(cfg.ssh_control_persist)
+        if self.resume_requested:
+            cfg.resume = True
+        # Until we are ready to reload the configuration (or to profile), a
+        # reload (or profile) request should not end the daemon. Being
+        # stopped should not lose what we logged (see fff_logging):
+        fff_logging.exit_on_sigterm()
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+        if cfg.simulation_files:
+            FFFSimulator.supervise(cfg)
+        else:
+            FFFSimulator.simulate(cfg)
+
+    @staticmethod
+    def simulate(cfg):
+        # Returns the rate controller with the statistics of the simulation,
+        # if it ever ends (see NumberOfRuns).
+        if FFFSimulator.prepare_simulations([cfg]):
+            return FFFSimulator.start_simulating(cfg)
 
+    @staticmethod
+    def supervise(cfg):
+        # Runs all the simulations of [Simulations] at the same time, each in
+        # its own process (see fff_supervisor).
+        simulations = FFFSimulator.load_simulation_configurations(cfg)
+        for name, simulation_cfg in simulations:
+            simulation_cfg.resume = simulation_cfg.resume or cfg.resume
+        if FFFSimulator.prepare_simulations([simulation_cfg for name,
+                                             simulation_cfg in simulations]):
+            supervisor = SimulationSupervisor(simulations, cfg.metrics_port,
+                                              cfg.restart_delay,
+                                              cfg.supervisor_report_interval)
+            supervisor.run(FFFSimulator.start_simulating)
+
+    @staticmethod
+    def prepare_simulations(cfgs):
         # Here we start the actual program flow:
-        FFFSimulator.assert_run_is_available(cfg.source_run,
-                                             cfg.source_dir,
-                                             cfg.alternative_source_dirs)
-        if FFFSimulator.assert_data_can_be_used(cfg.source_run,
-                                                cfg.source_dir):
-          fff_os_operations.hltd_stop()
-          fff_os_operations.hltd_stop(cfg.fu_host_name)
-          fff_os_operations.clean_ramdisk(cfg.ramdisk_dir)
-          fff_os_operations.clean_fu_data_dir(cfg.fu_host_name,
-                                              cfg.fu_data_dir)
-          fff_os_operations.hltd_start()
-          fff_os_operations.hltd_start(cfg.fu_host_name)
-          # After the start of hltd, we wait 5 seconds before creating our
-          # first run, otherwise hltd is no way fast enough to pick it up.
-          time.sleep(5)
-          FFFSimulator.start_simulating(cfg.source_run, cfg.source_dir,
-                                        cfg.ramdisk_dir, cfg.run_key,
-                                        cfg.seconds_per_lumi)
+        # (A synthetic source does not need a source run)
+        for cfg in cfgs:
+            if cfg.synthetic:
+                continue
+            FFFSimulator.assert_run_is_available(cfg.source_run,
+                                                 cfg.source_dir,
+                                                 cfg.alternative_source_dirs,
+                                                 cfg.staging_workers,
+                                                 cfg.staging_initial_lumis)
+            if not FFFSimulator.assert_data_can_be_used(cfg.source_run,
+                                                        cfg.source_dir,
+                                                        cfg.stream_specs):
+                return False
+        # hltd is stopped and started on all the hosts at the same time
+        # (None stands for the local host).
+        all_hosts = FFFSimulator.get_all_hosts(cfgs)
+        # Unless we resume runs that are still on the ramdisk: then we keep
+        # the ramdisks and hltd as they are (see fff_checkpoint).
+        if FFFSimulator.can_resume_in_place(cfgs):
+            logging.info('Resuming from the checkpoints, without cleaning '
+                         'the ramdisk or restarting hltd.')
+            running = fff_os_operations.on_hosts(
+                          fff_os_operations.wait_until_hltd_running,
+                          all_hosts, timeout=cfgs[0].readiness_timeout)
+            stopped_hosts = [host for host in all_hosts if not running[host]]
+            if stopped_hosts:
+                fff_os_operations.on_hosts(fff_os_operations.hltd_start,
+                                           stopped_hosts,
+                                           timeout=cfgs[0].host_timeout)
+            return True
+        fff_os_operations.on_hosts(fff_os_operations.hltd_stop, all_hosts,
+                                   timeout=cfgs[0].host_timeout)
+        # The ramdisks and the FU data dirs are cleaned at the same time (see
+        # fff_cleanup):
+        fff_os_operations.in_parallel(
+            [(fff_cleanup.clean_ramdisk, (cfg.ramdisk_dir,),
+              {'workers': cfg.cleanup_workers,
+               'background': cfg.background_cleanup}) for cfg in cfgs] +
+            [(FFFSimulator.clean_extra_target, (target_dir,),
+              {'workers': cfg.cleanup_workers,
+               'background': cfg.background_cleanup}) for cfg in cfgs
+             for target_dir in cfg.extra_targets] +
+            [(fff_cleanup.clean_fu_data_dirs,
+              (cfg.fu_host_names, cfg.fu_data_dir),
+              {'timeout': cfg.host_timeout,
+               'background': cfg.background_cleanup}) for cfg in cfgs])
+        fff_os_operations.on_hosts(fff_os_operations.hltd_start, all_hosts,
+                                   timeout=cfgs[0].host_timeout)
+        # After the start of hltd, we wait before creating our first run,
+        # otherwise hltd is no way fast enough to pick it up: until hltd runs
+        # everywhere and watches the ramdisk (at most ReadinessTimeout).
+        readiness_timeout = cfgs[0].readiness_timeout
+        fff_os_operations.in_parallel(
+            [(fff_os_operations.on_hosts,
+              (fff_os_operations.wait_until_hltd_running,
+               [host for host in all_hosts if host]),
+              {'timeout': readiness_timeout}),
+             (FFFSimulator.wait_until_ramdisks_watched,
+              ([cfg.ramdisk_dir for cfg in cfgs], readiness_timeout), {})])
+        return True
+
+    @staticmethod
+    def load_checkpoint(cfg):
+        # Gives the checkpoint of the simulation (None if it does not save
+        # one) and the state to resume from (None if we don't resume).
+        if not cfg.checkpoint_file:
+            return None, None
+        checkpoint = Checkpoint(cfg.checkpoint_file, cfg.source_run,
+                                [stream_name for stream_name, pattern
+                                 in cfg.stream_specs])
+        if not cfg.resume:
+            return checkpoint, None
+        return checkpoint, checkpoint.load()
+
+    @staticmethod
+    def can_resume_in_place(cfgs):
+        # Tells whether all the simulations resume a run that is still on
+        # the ramdisk.
+        for cfg in cfgs:
+            checkpoint, state = FFFSimulator.load_checkpoint(cfg)
+            if not state or not os.path.exists(FFFSimulator.format_dir_name(
+                                   state['run_number'], cfg.ramdisk_dir)):
+                return False
+        return True
+
+    @staticmethod
+    def clean_extra_target(target_dir, workers=4, background=False):
+        # A broken extra target should not keep us from simulating (see
+        # fff_fanout).
+        try:
+            fff_cleanup.clean_ramdisk(target_dir, workers, background)
+        except Exception, error:
+            logging.error('Could not clean up target %s: %s'
+                          % (target_dir, error))
+
+    @staticmethod
+    def wait_until_ramdisks_watched(ramdisk_dirs, timeout):
+        # Until the local hltd runs and watches all the ramdisks, for at most
+        # the timeout. If we cannot tell whether it watches them, we wait the
+        # whole timeout.
+        start_time = time.time()
+        hltd_pid = fff_os_operations.wait_until_hltd_running(None, timeout)
+        for ramdisk_dir in ramdisk_dirs:
+            remaining = max(timeout - (time.time() - start_time), 0.)
+            if hltd_pid is True or fff_os_operations.wait_until_watched(
+                   ramdisk_dir, remaining, hltd_pid) is None:
+                time.sleep(remaining)
+
+    @staticmethod
+    def get_all_hosts(cfgs):
+        # The local host (None) and the FUs of all the simulations.
+        all_hosts = [None]
+        for cfg in cfgs:
+            all_hosts += [host for host in cfg.fu_host_names
+                          if host not in all_hosts]
+        return all_hosts
 
     @staticmethod
     def assert_run_is_available(source_run, source_dir,
-                                alternative_source_dirs):
+                                alternative_source_dirs, staging_workers=4,
+                                staging_initial_lumis=0):
+        # If we cannot find the source run in either the source dir or any
+        # of the aternative source dirs, there is nothing we can do and we
+        # exit.
+        if not FFFSimulator.make_run_available(source_run, source_dir,
+                                               alternative_source_dirs,
+                                               staging_workers,
+                                               staging_initial_lumis):
+            logging.error("Could not get source run. Exiting.")
+            sys.exit(0)
+
+    @staticmethod
+    def make_run_available(source_run, source_dir, alternative_source_dirs,
+                           staging_workers=4, staging_initial_lumis=0):
+        # Tells whether the source run is (now) in the source dir. A
+        # compressed source run (see fff_archive) is used where it is.
+        if fff_archive.find_archive(os.path.join(source_dir, source_run)):
+            logging.info("Found compressed source %s in %s" % (source_run,
+                                                               source_dir))
+            return True
         if not FFFSimulator.is_source_run_in_source_dir(source_run,
                                                         source_dir):
             # Try each of the alternative source dirs to find the run:
@@ -90,17 +319,13 @@ class FFFSimulator(Daemon):
                     # If we cannot find the source run in the source dir, but
                     # we did find it in an alternative source dir, then we can
                     # copy it from the alterative source dir to the source dir
-                    FFFSimulator.copy_run(source_run,
+                    found_the_run = FFFSimulator.copy_run(source_run,
                                           alternative_source_dir,
-                                          source_dir)
-                    found_the_run = True
+                                          source_dir, staging_workers,
+                                          staging_initial_lumis)
                     break
-            # If we cannot find the source run in either the source dir or any
-            # of the aternative source dirs, there is nothing we can do and we
-            # exit.
-            if not found_the_run:
-                logging.error("Could not get source run. Exiting.")
-                sys.exit(0)
+            return found_the_run
+        return True
 
     @staticmethod
     def is_source_run_in_source_dir(source_run, source_dir):
@@ -109,8 +334,15 @@ class FFFSimulator(Daemon):
             os.makedirs(source_dir, 0755)
         # We assume that if the directory for the run exists, it's actually
         # there. We don't care whether it's empty or not. This will be handled
-        # later.
-        if os.path.exists(os.path.join(source_dir, source_run)):
+        # later. Only if we know that we did not finish copying it (see
+        # copy_run), it's not there.
+        run_path = os.path.join(source_dir, source_run)
+        if os.path.exists(run_path) and \
+           not fff_staging.is_staging_complete(run_path):
+            logging.info("Found incomplete source %s in %s" % (source_run,
+                                                               source_dir))
+            return False
+        if os.path.exists(run_path):
             logging.info("Found source %s in %s" % (source_run,
                                                     source_dir))
             return True
@@ -120,23 +352,38 @@ class FFFSimulator(Daemon):
             return False
 
     @staticmethod
-    def copy_run(run_dir, from_dir, to_dir):
+    def copy_run(run_dir, from_dir, to_dir, workers=4, initial_lumis=0):
         # This method is intended to copy the playback run data from the
         # fff/output disk to the fff/ramdisk if it's not there, e.g. after
         # a restart of the machine.
+        # The copying is done in the background by a stager (see
+        # fff_staging). We only wait for the first initial_lumis
+        # lumisections (or for everything, with 0), the rest follows while
+        # we simulate. An interrupted copy is resumed.
         logging.info("Copying %s from %s to %s" % (run_dir, from_dir, to_dir))
         logging.info("For big runs this can take a while.")
-        shutil.copytree(os.path.join(from_dir, run_dir),
-                        os.path.join(to_dir, run_dir))
-        logging.info("Finished copying.")
+        stager = fff_staging.RunStager(run_dir, from_dir, to_dir, workers)
+        stager.start()
+        if not stager.wait_until_ready(initial_lumis):
+            logging.error("Copying failed.")
+            return False
+        if initial_lumis:
+            logging.info("Copied the first %d lumisections, copying the rest "
+                         "in the background." % initial_lumis)
+        else:
+            logging.info("Finished copying.")
+        return True
 
     @staticmethod
-    def assert_data_can_be_used(source_run, source_dir):
-        streams = FFFSimulator.get_streams(source_run, source_dir)
+    def assert_data_can_be_used(source_run, source_dir,
+                                stream_specs=fff_source_index.
+                                             DEFAULT_STREAM_SPECS):
+        streams = FFFSimulator.get_streams(source_run, source_dir,
+                                           stream_specs)
         # If there is a stream with no data, we shouldn't continue.
         if [stream for stream in streams if len(stream) == 0]:
-            logging.error('Not all the streams have data. Need data in all 3 '
-                          'of the streams.')
+            logging.error('Not all the streams have data. Need data in all %d '
+                          'of the streams.' % len(streams))
             return False
         # We need to be able to decide on the run number, otherwise we shouldn't
         # continue either.
@@ -147,27 +394,15 @@ class FFFSimulator(Daemon):
         return True
 
     @staticmethod
-    def get_streams(source_run, source_dir):
-        # We basically need to simulate 3 streams.
-        # So we look at all the files and see for each stream what we can find.
-        streamDQM = []
-        streamDQMHistograms = []
-        streamDQMCalibration = []
-        # We, in fact, look primarily at the .jsn files first.
-        full_search_path = os.path.join(source_dir, source_run, '*.jsn')
-        for json_file in glob.glob(full_search_path):
-            # We explicitely don't use any fancy regular expressions here:
-            # (In fact later on we don't care about the file name at all)
-            if '_streamDQM_' in json_file  or '_streamLookArea_' in json_file:
-                streamDQM.append(json_file)
-            elif '_streamDQMHistograms_' in json_file:
-                streamDQMHistograms.append(json_file)
-            elif '_streamDQMCalibration_' in json_file:
-                streamDQMCalibration.append(json_file)
-        streams = [sorted(streamDQM),
-                   sorted(streamDQMHistograms),
-                   sorted(streamDQMCalibration)]
-        return streams
+    def get_streams(source_run, source_dir,
+                    stream_specs=fff_source_index.DEFAULT_STREAM_SPECS):
+        # We basically need to simulate the configured streams (see [Streams]).
+        # So we look at all the .jsn files and see for each stream what we can
+        # find. This is a single pass over the run directory, however many
+        # streams and files there are.
+        return fff_source_index.scan_streams(os.path.join(source_dir,
+                                                          source_run),
+                                             stream_specs)
 
     @staticmethod
     def get_run_number_from_streams(streams):
@@ -186,128 +421,795 @@ class FFFSimulator(Daemon):
             return int(re.search('(run)(\d+)', file_name).group(2))
 
     @staticmethod
-    def start_simulating(source_run, source_dir, ramdisk_dir, run_key,
-                         seconds_per_lumi):
-        # First get what we have as streams from the source (input) data.
-        # We basically need to simulate 3 new streams, given this source data.
-        streams = FFFSimulator.get_streams(source_run, source_dir)
-        # We decide on the initial run number of the run we will simulate:
-        run_number = FFFSimulator.get_run_number_from_streams(streams)
-        # We need to decide how many lumi sections to simulate, we take the
-        # stream with the highest number of files and use that number:
-        lumi_amount = max([len(stream) for stream in streams])
-        # We will also skip the first 2 lumisections...
-        # ...and leave "a hole" of 3 lumisections after the 10th
-        lumis_to_skip = [1, 2, 11, 12, 13]
-        # So the total length of the run we can simulate is a bit longer:
-        lumi_amount += len(lumis_to_skip)
-        # To make sure we actually simulate the gap, we ensure that the minimum
-        # run lenght is always 15, even if the amount of input files is too
-        # small.
-        lumi_amount = max(lumi_amount, 15)
-        # We start simulation runs forever:
-        while True:
+    def start_simulating(cfg, report_metrics=None):
+        # If given, report_metrics is called with the live metrics once they
+        # exist (see fff_supervisor).
+        source_index, run_number = FFFSimulator.load_source(cfg)
+        simulation = FFFSimulator.create_simulation(cfg, source_index,
+                                                    report_metrics)
+        run_number, resume_after_lumi = FFFSimulator.get_first_run(
+                                            simulation, run_number)
+        # We start simulation runs forever (unless configured otherwise):
+        simulated_runs = 0
+        while not cfg.number_of_runs or simulated_runs < cfg.number_of_runs:
+            lumi_amount = FFFSimulator.prepare_run(simulation)
             logging.info('Starting simulation of new run %d.' % run_number)
-            FFFSimulator.simulate_run(run_number, lumi_amount, lumis_to_skip,
-                               streams, ramdisk_dir, run_key, seconds_per_lumi)
+            FFFSimulator.simulate_run(simulation, run_number, lumi_amount,
+                                      resume_after_lumi)
+            resume_after_lumi = None
+            FFFSimulator.finish_run(simulation, run_number, lumi_amount)
             # After the run we increment the run number for the next run to
             # simulate:
             run_number += 1
-        pass
+            simulated_runs += 1
+        FFFSimulator.stop_simulation(simulation)
+        return simulation.rate_controller
+
+    @staticmethod
+    def load_source(cfg):
+        # Gives the index of the source data and the run number it suggests.
+        if cfg.synthetic:
+            # We generate the source data ourselves:
+            source_index = FFFSimulator.create_synthetic_source(cfg)
+            run_number = source_index.run_number
+        else:
+            # First get what we have as streams from the source (input) data.
+            # We basically need to simulate the configured streams, given this
+            # source data.
+            streams = FFFSimulator.get_streams(cfg.source_run, cfg.source_dir,
+                                               cfg.stream_specs)
+            # We read the source data only once and keep it in an index:
+            source_index = SourceRunIndex(cfg.source_run, cfg.source_dir,
+                                          streams)
+            # We decide on the initial run number of the run we will
+            # simulate:
+            run_number = FFFSimulator.get_run_number_from_streams(streams)
+        if cfg.first_run_number:
+            run_number = cfg.first_run_number
+        return source_index, run_number
+
+    @staticmethod
+    def create_simulation(cfg, source_index, report_metrics=None):
+        # Creates (and starts) the configured components of the simulation
+        # (see Simulation).
+        simulation = Simulation(cfg, source_index)
+        # With more than one worker, the streams of a lumisection are written
+        # concurrently. The pool is created here, after the daemon forked.
+        if cfg.emission_workers > 1:
+            simulation.emission_pool = ThreadPool(cfg.emission_workers)
+        # The upcoming lumisections are prepared in the background, if
+        # configured:
+        if cfg.lookahead_depth:
+            simulation.lookahead = LookaheadStager(
+                                       cfg.ramdisk_dir, cfg,
+                                       int(cfg.lookahead_max_mb * 1e6))
+            simulation.lookahead.start()
+        # The runs are published to the extra targets as well, if configured
+        # (see fff_fanout):
+        if cfg.extra_targets:
+            simulation.fanout = Fanout(cfg.extra_targets)
+            simulation.fanout.start()
+        # The rate controller keeps track of the rate we actually achieve:
+        simulation.rate_controller = RateController(cfg.seconds_per_lumi,
+                                                    cfg.target_mb_per_second,
+                                                    cfg.report_interval)
+        # Old runs are cleaned up in the background, if configured:
+        simulation.retention_manager = RetentionManager(
+                                cfg.ramdisk_dir, cfg.keep_runs,
+                                cfg.keep_lumis, cfg.max_bytes,
+                                cfg.max_usage_percent, cfg.retention_interval,
+                                None, cfg.retention_wait_for_consumption,
+                                cfg.max_unconsumed_seconds)
+        # We observe whether the published lumisections are consumed, and
+        # throttle if they are not, if configured. The retention can wait
+        # for the consumption as well:
+        if cfg.observe_consumption or cfg.max_backlog or \
+           cfg.retention_wait_for_consumption:
+            simulation.consumption_observer = ConsumptionObserver(
+                                       cfg.fu_data_dir, cfg.max_backlog,
+                                       cfg.backpressure_timeout,
+                                       [stream_name for stream_name, pattern
+                                        in cfg.stream_specs])
+            simulation.consumption_observer.start()
+        simulation.retention_manager.consumption_observer = \
+            simulation.consumption_observer
+        if simulation.retention_manager.is_enabled():
+            simulation.retention_manager.start()
+        # We replay the timing and sizes of a trace, if configured:
+        if cfg.replay:
+            simulation.replay = TraceReplay(
+                                    FFFSimulator.load_trace(source_index,
+                                                            cfg),
+                                    source_index.streams,
+                                    cfg.replay_time_scale,
+                                    cfg.replay_volume_scale)
+        # The live metrics, served over HTTP if configured:
+        # On SIGUSR1 we profile the next lumisections (see fff_profiling):
+        simulation.profiler = Profiler(cfg)
+        simulation.metrics = fff_metrics.SimulationMetrics(
+                                 cfg.ramdisk_dir, simulation.scheduler,
+                                 simulation.rate_controller,
+                                 simulation.retention_manager,
+                                 simulation.consumption_observer,
+                                 simulation.replay, simulation.fanout,
+                                 fff_profiling.phases, simulation.profiler)
+        # If somebody else reports the metrics, they also serve them:
+        if report_metrics:
+            report_metrics(simulation.metrics)
+        elif cfg.metrics_port:
+            simulation.metrics_server = fff_metrics.start_metrics_server(
+                                            simulation.metrics,
+                                            cfg.metrics_port)
+        # On SIGHUP we reload the configuration and apply it at the next
+        # lumisection or run (see fff_reload):
+        simulation.reloader = ConfigurationReloader(
+                       lambda: FFFSimulator.load_configuration(
+                                   cfg.configuration_file),
+                       simulation.scheduler, simulation.rate_controller,
+                       simulation.retention_manager,
+                       simulation.consumption_observer)
+        simulation.reloader.install()
+        simulation.profiler.install()
+        return simulation
+
+    @staticmethod
+    def get_first_run(simulation, run_number):
+        # Gives the run to start with and, if we go on with a run that was
+        # started already, the lumisection after which we go on (otherwise
+        # None). When resuming, we go on with the run of the checkpoint if
+        # it is still on the ramdisk, otherwise with the run after it (see
+        # fff_checkpoint).
+        cfg = simulation.cfg
+        checkpoint, state = FFFSimulator.load_checkpoint(cfg)
+        if checkpoint and checkpoint.prepare():
+            simulation.checkpoint = checkpoint
+        resume_after_lumi = None
+        if state:
+            run_number = state['run_number']
+            in_place = os.path.exists(FFFSimulator.format_dir_name(
+                                          run_number, cfg.ramdisk_dir))
+            if in_place and not state['run_ended']:
+                resume_after_lumi = state['lumi_number']
+                logging.info('Resuming run %d after lumisection %d.'
+                             % (run_number, resume_after_lumi))
+            else:
+                run_number += 1
+                logging.info('Resuming with run %d.' % run_number)
+            # The streams (and the schedule, if nothing was cleaned) go on
+            # where they were:
+            checkpoint.restore(state, simulation.source_index.streams,
+                               simulation.replay)
+            if in_place:
+                checkpoint.restore_schedule(state, simulation.scheduler)
+        # We never reuse a run that is still on the ramdisk (e.g. when a
+        # crashed simulation is restarted without resuming):
+        if resume_after_lumi is None:
+            while os.path.exists(FFFSimulator.format_dir_name(
+                                     run_number, cfg.ramdisk_dir)):
+                run_number += 1
+        return run_number, resume_after_lumi
 
     @staticmethod
-    def simulate_run(run_number, lumi_amount, lumis_to_skip,
-                     streams, ramdisk_dir, run_key, seconds_per_lumi):
-        # A. We Start the run:
-        FFFSimulator.create_global_file(run_number, ramdisk_dir, run_key)
-        FFFSimulator.create_run_directory(run_number, ramdisk_dir)
+    def prepare_run(simulation):
+        # Applies what changed since the previous run (the configuration or
+        # the source run) and gives the amount of lumisections of the next
+        # run.
+        cfg = simulation.cfg
+        changes = simulation.reloader.apply_run_settings(cfg)
+        source_switched = False
+        if set(changes) & set(fff_reload.SOURCE_SETTINGS):
+            new_source_index = FFFSimulator.switch_source_run(cfg, changes)
+            if new_source_index:
+                simulation.source_index = new_source_index
+                source_switched = True
+                # Staging the new source can take a while, we don't want to
+                # catch up on that:
+                simulation.scheduler.start()
+        source_index = simulation.source_index
+        if [name for name in changes if name.startswith('replay')]:
+            simulation.replay = None
+            if cfg.replay:
+                simulation.replay = TraceReplay(
+                                        FFFSimulator.load_trace(source_index,
+                                                                cfg),
+                                        source_index.streams,
+                                        cfg.replay_time_scale,
+                                        cfg.replay_volume_scale)
+            simulation.metrics.replay = simulation.replay
+        elif simulation.replay and source_switched:
+            simulation.replay.update(FFFSimulator.load_trace(source_index,
+                                                             cfg),
+                                     source_index.streams)
+        # If somebody changed the source run in the meantime, we pick up the
+        # changes before starting the next run.
+        if source_index.is_outdated():
+            logging.info('Source run changed on disk, updating the index.')
+            source_index.rebuild(FFFSimulator.get_streams(
+                cfg.source_run, cfg.source_dir, cfg.stream_specs))
+            if simulation.replay:
+                simulation.replay.update(FFFSimulator.load_trace(source_index,
+                                                                 cfg),
+                                         source_index.streams)
+        if simulation.replay:
+            return simulation.replay.get_lumi_amount()
+        return FFFSimulator.get_lumi_amount(source_index.streams, cfg)
+
+    @staticmethod
+    def finish_run(simulation, run_number, lumi_amount):
+        # After the run: we log how it went, leave the configured gap before
+        # the next run and save the checkpoint.
+        logging.info('Schedule so far: %s'
+                     % simulation.scheduler.get_summary())
+        logging.info('Time per phase so far: %s'
+                     % fff_profiling.phases.get_summary())
+        logging.info('Rate so far: %s'
+                     % simulation.rate_controller.get_summary())
+        if simulation.replay:
+            logging.info('Replay so far: %s'
+                         % simulation.replay.get_summary())
+        if simulation.consumption_observer:
+            logging.info('Consumption so far: %s'
+                         % simulation.consumption_observer.get_summary())
+        if simulation.fanout:
+            logging.info('Extra targets so far: %s'
+                         % simulation.fanout.get_summary())
+        simulation.scheduler.advance(simulation.cfg.seconds_between_runs)
+        if simulation.checkpoint:
+            with fff_profiling.phases.measure('checkpoint'):
+                FFFSimulator.save_checkpoint(simulation, run_number,
+                                             lumi_amount, {}, True)
+
+    @staticmethod
+    def stop_simulation(simulation):
+        # Stops the components of the simulation, after its last run.
+        simulation.profiler.stop(wait=True)
+        if simulation.emission_pool:
+            simulation.emission_pool.close()
+        if simulation.lookahead:
+            simulation.lookahead.stop()
+            logging.info('Lookahead: %s'
+                         % simulation.lookahead.get_summary())
+        if simulation.fanout:
+            simulation.fanout.stop(simulation.cfg.host_timeout)
+            logging.info('Extra targets: %s'
+                         % simulation.fanout.get_summary())
+        if simulation.metrics_server:
+            simulation.metrics_server.shutdown()
+            simulation.metrics_server.server_close()
+        if simulation.retention_manager.is_alive():
+            simulation.retention_manager.stop()
+            logging.info('Retention: %s'
+                         % simulation.retention_manager.get_summary())
+        if simulation.consumption_observer:
+            simulation.consumption_observer.stop()
+
+    @staticmethod
+    def switch_source_run(cfg, previous_values):
+        # After a reload changed the source: gives the index of the new
+        # source run. If we cannot use it, we go back to the previous source
+        # (and give None).
+        if cfg.synthetic:
+            logging.warning('Reload: the synthetic source is only changed by '
+                            'a restart.')
+        elif FFFSimulator.make_run_available(cfg.source_run, cfg.source_dir,
+                                             cfg.alternative_source_dirs,
+                                             cfg.staging_workers,
+                                             cfg.staging_initial_lumis) and \
+             FFFSimulator.assert_data_can_be_used(cfg.source_run,
+                                                  cfg.source_dir,
+                                                  cfg.stream_specs):
+            source_index = SourceRunIndex(cfg.source_run, cfg.source_dir,
+                                          FFFSimulator.get_streams(
+                                              cfg.source_run, cfg.source_dir,
+                                              cfg.stream_specs))
+            # (Files that cannot be used are left out of the index.)
+            if not [stream for stream in source_index.streams
+                    if not len(stream)]:
+                logging.info('Reload: switching to source run %s.'
+                             % cfg.source_run)
+                return source_index
+            logging.error('Reload: not all the streams of source run %s '
+                          'have usable data.' % cfg.source_run)
+        else:
+            logging.error('Reload: cannot use source run %s.'
+                          % cfg.source_run)
+        for name in fff_reload.SOURCE_SETTINGS:
+            if name in previous_values:
+                setattr(cfg, name, previous_values[name])
+        logging.info('Reload: keeping source run %s.' % cfg.source_run)
+        return None
+
+    @staticmethod
+    def get_lumi_amount(streams, cfg):
+        # We need to decide how many lumi sections to simulate. Unless it is
+        # configured, we take the stream with the highest number of files and
+        # use that number (this can grow while the source run is being
+        # copied):
+        if cfg.lumis_per_run:
+            return cfg.lumis_per_run
+        lumi_amount = max([len(stream) for stream in streams])
+        # By default we will skip the first 2 lumisections...
+        # ...and leave "a hole" of 3 lumisections after the 10th
+        # So the total length of the run we can simulate is a bit longer:
+        lumi_amount += len(cfg.lumis_to_skip)
+        # To make sure we actually simulate the gap, we ensure that the
+        # minimum run lenght is always 15, even if the amount of input files
+        # is too small.
+        return max(lumi_amount, 15)
+
+    @staticmethod
+    def load_trace(source_index, cfg):
+        # The trace to replay (see fff_trace), from the source run or from a
+        # CSV file.
+        if cfg.replay == 'csv':
+            return fff_trace.load_csv_trace(cfg.replay_trace_file,
+                                            [stream_name for stream_name,
+                                             pattern in cfg.stream_specs])
+        return fff_trace.build_source_trace(source_index.streams,
+                                            cfg.seconds_per_lumi)
+
+    @staticmethod
+    def create_synthetic_source(cfg):
+        stream_specs = []
+        for stream_name, pattern in cfg.stream_specs:
+            # Per stream: size of the data files in MB, amount of
+            # lumisections and extension (see fff_synthetic):
+            spec = FFFSimulator.get_optional(cfg, 'Synthetic', stream_name,
+                                             None)
+            if spec is None:
+                logging.info('No synthetic spec for %s, using the defaults.'
+                             % stream_name)
+            stream_specs.append(fff_synthetic.parse_stream_spec(stream_name,
+                                                                spec))
+        return SyntheticSource(cfg.synthetic_dir, cfg.synthetic_run_number,
+                               stream_specs, cfg.synthetic_generation,
+                               cfg.synthetic_template_file,
+                               cfg.synthetic_events_per_lumi)
+
+    @staticmethod
+    def simulate_run(simulation, run_number, lumi_amount,
+                     resume_after_lumi=None):
+        # Every step below happens at its deadline, given by the scheduler.
+        # When replaying a trace, the lumisections come from the trace
+        # instead of the configured run shape. After every lumisection we
+        # save a checkpoint, if configured. When resuming the run, we go on
+        # after the given lumisection (see fff_checkpoint). Every step is
+        # handed to the extra targets as well (see fff_fanout). The time of
+        # every phase is measured, and a profile is taken when requested
+        # (see fff_profiling).
+        cfg = simulation.cfg
+        streams = simulation.source_index.streams
+        scheduler = simulation.scheduler
+        rate_controller = simulation.rate_controller
+        metrics = simulation.metrics
+        consumption_observer = simulation.consumption_observer
+        replay = simulation.replay
+        reloader = simulation.reloader
+        lookahead = simulation.lookahead
+        checkpoint = simulation.checkpoint
+        fanout = simulation.fanout
+        profiler = simulation.profiler
+        phases = fff_profiling.phases
+        # A. We Start the run (unless it was started already):
+        if resume_after_lumi is None:
+            with phases.measure('sleep'):
+                scheduler.wait()
+            with phases.measure('start'):
+                FFFSimulator.create_global_file(run_number, cfg.ramdisk_dir,
+                                                cfg.run_key)
+                FFFSimulator.create_run_directory(run_number,
+                                                  cfg.ramdisk_dir)
+            if fanout:
+                run_key = cfg.run_key
+                def start_run(target_dir):
+                    FFFSimulator.create_global_file(run_number, target_dir,
+                                                    run_key)
+                    FFFSimulator.create_run_directory(run_number, target_dir)
+                fanout.add_step('start run %d' % run_number, start_run)
+        if consumption_observer:
+            consumption_observer.watch_run(FFFSimulator.format_dir_name(
+                                               run_number, cfg.ramdisk_dir),
+                                           run_number)
+        if metrics:
+            metrics.run_number = run_number
+        # Now the famous Atanas hack to give inotify time to work correctly:
+        # we wait until hltd watches the run directory, for at most
+        # SecondsBeforeFirstLumi (or exactly that long, if we cannot tell).
+        # hltd may have been restarted since we started, so we look up its
+        # pid again.
+        if resume_after_lumi is None:
+            with phases.measure('start'):
+                waited = fff_os_operations.wait_until_watched(
+                             FFFSimulator.format_dir_name(run_number,
+                                                          cfg.ramdisk_dir),
+                             cfg.seconds_before_first_lumi,
+                             fff_os_operations.get_hltd_pid())
+            if waited is None:
+                scheduler.advance(cfg.seconds_before_first_lumi)
+            else:
+                scheduler.advance(waited)
         # B. We loop over all the lumisections we simulate:
-        for lumi_number in range(1, lumi_amount + 1):
-            logging.info('Simulating run %s, lumisection %s' % (run_number,
-                                                                lumi_number))
-            if lumi_number in lumis_to_skip:
+        # (With lookahead, the entries of the lumisections are planned, and
+        # prepared, ahead of time. We keep the planning state from before
+        # each of them, for the checkpoints.)
+        planned_lumis = {}
+        for lumi_number in range((resume_after_lumi or 0) + 1,
+                                 lumi_amount + 1):
+            if lookahead:
+                FFFSimulator.plan_ahead(simulation, run_number, lumi_number,
+                                        lumi_amount, planned_lumis)
+            trace_lumi = None
+            seconds_per_lumi = cfg.seconds_per_lumi
+            if replay:
+                trace_lumi = replay.get_lumi(lumi_number)
+                if not trace_lumi:
+                    # Not in the trace: its time is part of the lumisection
+                    # before it.
+                    continue
+                seconds_per_lumi = replay.get_seconds(trace_lumi)
+            if (replay and not trace_lumi.has_files()) or \
+               (not replay and lumi_number in cfg.lumis_to_skip):
+                with phases.measure('sleep'):
+                    scheduler.wait()
+                if reloader:
+                    with phases.measure('reload'):
+                        reloader.apply_lumi_settings(cfg)
+                # (Only if LumisToSkip was reloaded after we planned it.)
+                if planned_lumis.pop(lumi_number, None):
+                    lookahead.discard((run_number, lumi_number))
+                logging.info('Simulating run %s, lumisection %s'
+                             % (run_number, lumi_number))
                 logging.info('  Skipping this lumisection on purpose.')
-                # If we're skipping the lumis, we sleep a bit less long:
-                time.sleep(2)
+                # If we're skipping the lumis, we wait a bit less long:
+                if not replay:
+                    seconds_per_lumi = cfg.seconds_per_skipped_lumi
+                scheduler.advance(seconds_per_lumi)
+                if checkpoint:
+                    with phases.measure('checkpoint'):
+                        FFFSimulator.save_checkpoint(simulation, run_number,
+                                                     lumi_number,
+                                                     planned_lumis)
+                continue
+            # If the consumers don't keep up, we wait for them first (which
+            # makes this lumisection late):
+            if consumption_observer:
+                with phases.measure('backpressure'):
+                    consumption_observer.wait_for_backlog()
+            with phases.measure('sleep'):
+                lateness, on_time = scheduler.wait_for_lumi(seconds_per_lumi)
+            if profiler:
+                profiler.at_lumi_boundary(run_number, lumi_number)
+            recent_phases = phases.take_recent()
+            if lateness > 0:
+                logging.info('Run %s, lumisection %s is %.3f s late, time '
+                             'since the previous lumisection: %s',
+                             run_number, lumi_number, lateness,
+                             phases.get_summary(recent_phases))
+            # A reloaded configuration is applied from this lumisection on
+            # (see fff_reload):
+            if reloader:
+                with phases.measure('reload'):
+                    reloader.apply_lumi_settings(cfg)
+                if not replay:
+                    seconds_per_lumi = cfg.seconds_per_lumi
+            logging.debug('Simulating run %s, lumisection %s (%.3f s late)',
+                          run_number, lumi_number, lateness)
+            if metrics:
+                metrics.lumi_number = lumi_number
+            entries_per_stream = None
+            if lumi_number in planned_lumis:
+                planning_state, entries_per_stream = planned_lumis.pop(
+                                                         lumi_number)
+            if on_time:
+                prepared_lumi = None
+                with phases.measure('plan'):
+                    if entries_per_stream is None:
+                        entries_per_stream = FFFSimulator.plan_lumisection(
+                                                 streams, cfg, replay,
+                                                 trace_lumi)
+                    else:
+                        prepared_lumi = lookahead.take((run_number,
+                                                        lumi_number))
+                emission_start = monotonic()
+                bytes_written = FFFSimulator.simulate_lumisection(
+                                    simulation, run_number, lumi_number,
+                                    entries_per_stream, prepared_lumi)
+                emission_time = monotonic() - emission_start
+                # A json and a data file for every published entry:
+                files_written = 2 * sum([len(entries) for entries
+                                         in entries_per_stream])
+                if replay:
+                    replay.record_lumi(trace_lumi, bytes_written, lateness)
+                if rate_controller:
+                    rate_controller.record_lumi(
+                        bytes_written, files_written, emission_time, lateness,
+                        scheduler.get_current_deadline())
+                # One line per lumisection, the files are logged with DEBUG:
+                with phases.measure('logging'):
+                    logging.info('Run %s, lumisection %s: %d files, %.1f MB '
+                                 'in %.3f s (%.3f s late)', run_number,
+                                 lumi_number, files_written,
+                                 bytes_written / 1e6, emission_time, lateness)
             else:
-                FFFSimulator.simulate_lumisection(run_number, lumi_number,
-                                                  streams, ramdisk_dir)
-                time.sleep(seconds_per_lumi)
+                if entries_per_stream is not None:
+                    lookahead.discard((run_number, lumi_number))
+                logging.warning('Run %s, lumisection %s: dropped, its slot '
+                                'passed already (%.3f s late).', run_number,
+                                lumi_number, lateness)
+            if rate_controller and cfg.stress_mode:
+                rate_controller.report_if_due()
+            scheduler.advance(seconds_per_lumi)
+            if checkpoint:
+                with phases.measure('checkpoint'):
+                    FFFSimulator.save_checkpoint(simulation, run_number,
+                                                 lumi_number, planned_lumis)
         # C. We finalize the run:
-        FFFSimulator.write_EoR_file(run_number, ramdisk_dir)
+        with phases.measure('sleep'):
+            scheduler.wait()
+        FFFSimulator.write_EoR_file(run_number, cfg.ramdisk_dir)
+        if fanout:
+            fanout.add_step('end run %d' % run_number,
+                            lambda target_dir: FFFSimulator.write_EoR_file(
+                                                   run_number, target_dir))
 
     @staticmethod
-    def simulate_lumisection(run_number, lumi_number, streams, ramdisk_dir):
-        FFFSimulator.simulate_stream(run_number, lumi_number,
-                                     'streamDQM',
-                                     streams[0], ramdisk_dir)
-        FFFSimulator.simulate_stream(run_number, lumi_number,
-                                     'streamDQMHistograms',
-                                     streams[1], ramdisk_dir)
-        FFFSimulator.simulate_stream(run_number, lumi_number,
-                                     'streamDQMCalibration',
-                                     streams[2], ramdisk_dir)
+    def plan_lumisection(streams, cfg, replay=None, trace_lumi=None):
+        # Decides which source entries each stream publishes in a
+        # lumisection: the ones of the trace lumisection, when replaying (see
+        # fff_trace), otherwise the next entry of each stream.
+        if replay:
+            return replay.plan_lumi(trace_lumi)
+        entries_per_stream = []
+        for (stream_name, pattern), stream in zip(cfg.stream_specs, streams):
+            if not len(stream):
+                logging.error('    No source files left for %s.'
+                              % stream_name)
+                entries_per_stream.append([])
+                continue
+            # We take the next entry of the stream from the source index
+            # (the stream rotates: after the last entry we start with the
+            # first again)
+            entries_per_stream.append([stream.next_entry()])
+        return entries_per_stream
 
     @staticmethod
-    def simulate_stream(run_number, lumi_number, stream_name, stream,
-                        ramdisk_dir):
-        logging.info('  For %s:' % stream_name)
+    def get_planning_state(streams, replay=None):
+        # What planning a lumisection changes: the positions of the streams
+        # and the volume the replay still owes the trace.
+        carry = None
+        if replay:
+            carry = list(replay.carry)
+        return [stream.position for stream in streams], carry
 
-        # The input - We always have a json file and a data file
-        # We take the first file in the stream
-        input_json_full_path = stream[0]
-        input_dir = os.path.dirname(input_json_full_path)
-        json_info = FFFSimulator.get_info_from_json(input_json_full_path)
-        input_data_name = json_info['data'][3]
-        input_data_full_path = os.path.join(input_dir, input_data_name)
-        input_data_extention = os.path.splitext(input_data_name)[1]
+    @staticmethod
+    def save_checkpoint(simulation, run_number, lumi_number, planned_lumis,
+                        run_ended=False):
+        # Lumisections planned ahead are not published yet, so we save the
+        # planning state from before the first of them.
+        if planned_lumis:
+            positions, carry = planned_lumis[min(planned_lumis)][0]
+        else:
+            positions, carry = FFFSimulator.get_planning_state(
+                                   simulation.source_index.streams,
+                                   simulation.replay)
+        simulation.checkpoint.save(run_number, lumi_number, run_ended,
+                                   positions, carry, simulation.scheduler)
 
-        # The output - We again have a json file and a data file
-        output_base_name = FFFSimulator.format_base_name(run_number,
-                                                   lumi_number, stream_name)
-        output_json_name = output_base_name + '.jsn'
-        output_data_name = output_base_name + input_data_extention
-        output_dir = FFFSimulator.format_dir_name(run_number, ramdisk_dir)
-        output_json_full_path = os.path.join(output_dir, output_json_name)
-        output_data_full_path = os.path.join(output_dir, output_data_name)
+    @staticmethod
+    def plan_ahead(simulation, run_number, lumi_number, lumi_amount,
+                   planned_lumis):
+        # Plans the lumisections up to LookaheadDepth ahead of this one (that
+        # were not planned yet) and hands them to the lookahead stager, to
+        # prepare them.
+        cfg = simulation.cfg
+        streams = simulation.source_index.streams
+        replay = simulation.replay
+        lookahead = simulation.lookahead
+        last_lumi_number = min(lumi_number + cfg.lookahead_depth, lumi_amount)
+        for ahead in range(lumi_number, last_lumi_number + 1):
+            if ahead in planned_lumis:
+                continue
+            trace_lumi = None
+            if replay:
+                trace_lumi = replay.get_lumi(ahead)
+                if not trace_lumi or not trace_lumi.has_files():
+                    continue
+            elif ahead in cfg.lumis_to_skip:
+                continue
+            planning_state = FFFSimulator.get_planning_state(streams, replay)
+            entries_per_stream = FFFSimulator.plan_lumisection(streams, cfg,
+                                                               replay,
+                                                               trace_lumi)
+            planned_lumis[ahead] = (planning_state, entries_per_stream)
+            lookahead.prepare((run_number, ahead),
+                              [[(entry,) + FFFSimulator.get_output_files(
+                                    run_number, ahead, stream_name, entry,
+                                    copy_number, cfg)
+                                for copy_number, entry in enumerate(entries)]
+                               for (stream_name, pattern), entries
+                               in zip(cfg.stream_specs, entries_per_stream)])
+
+    @staticmethod
+    def simulate_lumisection(simulation, run_number, lumi_number,
+                             entries_per_stream=None, prepared_lumi=None):
+        # Returns the amount of data bytes written for the lumisection. If
+        # given, entries_per_stream tells which source entries each stream
+        # publishes (see plan_lumisection). If the lumisection was prepared
+        # already (see fff_lookahead), we only need to move its files. The
+        # extra targets get the lumisection first, so that they write it at
+        # the same time (see fff_fanout).
+        cfg = simulation.cfg
+        streams = simulation.source_index.streams
+        emission_pool = simulation.emission_pool
+        metrics = simulation.metrics
+        consumption_observer = simulation.consumption_observer
+        fanout = simulation.fanout
+        stream_names = [stream_name
+                        for stream_name, pattern in cfg.stream_specs]
+        if entries_per_stream is None:
+            entries_per_stream = FFFSimulator.plan_lumisection(streams, cfg)
+        if fanout:
+            def publish_lumi(target_dir):
+                return sum([FFFSimulator.simulate_stream(run_number,
+                                                         lumi_number,
+                                                         stream_name, entries,
+                                                         cfg, target_dir)
+                            for stream_name, entries
+                            in zip(stream_names, entries_per_stream)])
+            fanout.add_step('publish run %d, lumisection %d'
+                            % (run_number, lumi_number), publish_lumi, True)
+        def simulate_stream_number(stream_number):
+            if prepared_lumi:
+                logging.debug('  For %s:', stream_names[stream_number])
+                return prepared_lumi.publish_stream(stream_number,
+                                                    cfg.fsync_mode != 'none')
+            return FFFSimulator.simulate_stream(run_number, lumi_number,
+                                                stream_names[stream_number],
+                                                entries_per_stream[
+                                                    stream_number], cfg)
+        # The streams that will have files in this lumisection:
+        published_stream_names = [stream_names[stream_number]
+                                  for stream_number in range(len(streams))
+                                  if entries_per_stream[stream_number]]
+        if consumption_observer:
+            consumption_observer.expect_lumi(run_number, lumi_number,
+                                             published_stream_names)
+        try:
+            if emission_pool:
+                # Each stream is written by one worker, which still writes
+                # the data file before the json file. We only return when all
+                # the streams are done (exceptions are raised here as well).
+                bytes_per_stream = emission_pool.map(simulate_stream_number,
+                                                     range(len(streams)))
+            else:
+                bytes_per_stream = [simulate_stream_number(stream_number)
+                                    for stream_number in range(len(streams))]
+        except Exception:
+            if consumption_observer:
+                consumption_observer.forget_lumi(run_number, lumi_number)
+            raise
+        if consumption_observer:
+            consumption_observer.record_publication(run_number, lumi_number,
+                                                    published_stream_names)
+        if metrics:
+            metrics.record_streams(stream_names, bytes_per_stream,
+                                   [2 * len(entries)
+                                    for entries in entries_per_stream])
+        return sum(bytes_per_stream)
+
+    @staticmethod
+    def simulate_stream(run_number, lumi_number, stream_name, entries, cfg,
+                        target_dir=None):
+        # Publishes the given source entries for the stream, normally just
+        # one, to the ramdisk (or the given target directory). Returns the
+        # amount of data bytes written.
+        logging.debug('  For %s:', stream_name)
+        bytes_written = 0
+        for copy_number, entry in enumerate(entries):
+            FFFSimulator.publish_entry(run_number, lumi_number, stream_name,
+                                       entry, copy_number, cfg, target_dir)
+            bytes_written += entry.data_size
+        return bytes_written
+
+    @staticmethod
+    def publish_entry(run_number, lumi_number, stream_name, entry,
+                      copy_number, cfg, target_dir=None):
+        # (Only the ramdisk counts for the phases, see fff_profiling.)
+        phases = fff_profiling.phases
+        if target_dir:
+            phases = fff_profiling.untimed
 
-        # Modify the data file path in the json info:
-        json_info['data'][3] = output_data_name
+        # The input - We always have a json file and a data file
+        input_json_full_path = entry.json_path
 
-        # Write the output:
-        FFFSimulator.copy_data(input_data_full_path, output_data_full_path)
-        FFFSimulator.copy_json(input_json_full_path, output_json_full_path,
-                                                                    json_info)
+        # The output - We again have a json file and a data file
+        with phases.measure('render'):
+            output_data_full_path, output_json_full_path, json_text = \
+                FFFSimulator.get_output_files(run_number, lumi_number,
+                                              stream_name, entry, copy_number,
+                                              cfg, target_dir)
 
-        # Rotate the stream list (in place): First element goes to the end.
-        stream.append(stream.pop(0))
+        # Write the output (the data file always comes first):
+        with phases.measure('data'):
+            FFFSimulator.copy_data(entry, output_data_full_path,
+                                   cfg.publish_mode, cfg.atomic_publish,
+                                   cfg.fsync_mode in ['data', 'all'])
+        with phases.measure('json'):
+            FFFSimulator.copy_json(input_json_full_path,
+                                   output_json_full_path, json_text,
+                                   cfg.atomic_publish, cfg.fsync_mode == 'all')
 
     @staticmethod
-    def get_info_from_json(input_json_full_path):
-        with open(input_json_full_path, 'r') as input_json_file:
-            json_data = json.load(input_json_file)
-        return json_data
+    def get_output_files(run_number, lumi_number, stream_name, entry,
+                         copy_number, cfg, target_dir=None):
+        # Gives the data file and the json file an entry is published as (on
+        # the ramdisk, unless another target directory is given), and the
+        # content of the json file.
+        output_base_name = FFFSimulator.format_base_name(run_number,
+                                                   lumi_number, stream_name,
+                                                   copy_number)
+        output_json_name = output_base_name + '.jsn'
+        output_data_name = output_base_name + entry.data_extension
+        output_dir = FFFSimulator.format_dir_name(run_number,
+                                                  target_dir or
+                                                  cfg.ramdisk_dir)
+        # The json with the data file name modified, from the template:
+        json_text = entry.render_json(output_data_name)
+        return (os.path.join(output_dir, output_data_name),
+                os.path.join(output_dir, output_json_name), json_text)
 
     @staticmethod
-    def copy_json(input_json_full_path, output_json_full_path, json_info):
-        with open(output_json_full_path, 'w') as output_json_file:
-            output_json_file.write(json.dumps(json_info))
-        logging.info('    Json:    %s' % input_json_full_path)
-        logging.info('    Becomes: %s' % output_json_full_path)
+    def copy_json(input_json_full_path, output_json_full_path, json_text,
+                  atomic=False, fsync=False):
+        # With atomic publishing, we write to a hidden temporary file first
+        # and rename it, so that nobody ever sees a partial json file.
+        write_path = output_json_full_path
+        if atomic:
+            write_path = fff_os_operations.get_temporary_path(
+                                                       output_json_full_path)
+        with open(write_path, 'w') as output_json_file:
+            output_json_file.write(json_text)
+            if fsync:
+                output_json_file.flush()
+                os.fsync(output_json_file.fileno())
+        if atomic:
+            fff_os_operations.commit_file(write_path, output_json_full_path,
+                                          fsync)
+        logging.debug('    Json:    %s', input_json_full_path)
+        logging.debug('    Becomes: %s', output_json_full_path)
 
     @staticmethod
-    def copy_data(input_data_full_path, output_data_full_path):
-        shutil.copyfile(input_data_full_path, output_data_full_path)
-        logging.info('    Data:    %s' % input_data_full_path)
-        logging.info('    Becomes: %s' % output_data_full_path)
+    def copy_data(entry, output_data_full_path, publish_mode='auto',
+                  atomic=False, fsync=False):
+        # Depending on the publish mode, this is not necessarily a real copy.
+        # See fff_os_operations.publish_file for the details (and
+        # fff_archive for compressed source runs).
+        write_path = output_data_full_path
+        if atomic:
+            write_path = fff_os_operations.get_temporary_path(
+                                                       output_data_full_path)
+        used_mode = entry.publish_data(write_path, publish_mode)
+        if atomic:
+            fff_os_operations.commit_file(write_path, output_data_full_path,
+                                          fsync)
+        elif fsync:
+            fff_os_operations.fsync_file(output_data_full_path)
+        logging.debug('    Data:    %s', entry.data_path)
+        logging.debug('    Becomes: %s (%s)', output_data_full_path, used_mode)
 
     @staticmethod
-    def format_base_name(run_number, lumi_number, stream_name):
+    def format_base_name(run_number, lumi_number, stream_name, copy_number=0):
         # Method intended to format the output file name for the file that
         # we will eventually put on the ramdisk - without extension
+        # (Further copies of a file in the same lumisection, see fff_trace,
+        # are numbered.)
         run_part = 'run%d' % run_number
         lumi_part = 'ls%04d' % lumi_number
-        return '%s_%s_%s_mrg-FFFSimulator' % (run_part, lumi_part, stream_name)
+        base_name = '%s_%s_%s_mrg-FFFSimulator' % (run_part, lumi_part,
+                                                   stream_name)
+        if copy_number:
+            base_name += '%02d' % copy_number
+        return base_name
 
     @staticmethod
     def format_dir_name(run_number, ramdisk_dir):
@@ -330,8 +1232,6 @@ class FFFSimulator(Daemon):
         # No need to check if it already exists, since we cleaned first.
         os.makedirs(dir_name, 0755)
         logging.info('Created run directory: %s' % dir_name)
-        # Now the famous Atanas hack to give inotify time to work correctly
-        time.sleep(1)
 
     @staticmethod
     def write_EoR_file(run_number, ramdisk_dir):
@@ -341,20 +1241,53 @@ class FFFSimulator(Daemon):
         open(full_name, 'a').close()
         logging.info('Wrote EoR (end of run) file: %s' % full_name)
 
+    def resume(self):
+        # Starts the daemon, going on from the checkpoint (see
+        # fff_checkpoint).
+        self.resume_requested = True
+        self.start()
+
     def halt(self):
         # Load config variables to local variables for easy usage
         cfg = FFFSimulator.load_configuration()
+        fff_os_operations.configure_ssh(cfg.ssh_control_persist)
         # To stop processing, we try to write an End-of-Run file
         logging.info("Simulator received request to stop.")
-        fff_os_operations.hltd_stop()
-        fff_os_operations.hltd_stop(cfg.fu_host_name)
-        fff_os_operations.hltd_start()
-        fff_os_operations.hltd_start(cfg.fu_host_name)
+        cfgs = [cfg]
+        if cfg.simulation_files:
+            cfgs = [simulation_cfg for name, simulation_cfg in
+                    FFFSimulator.load_simulation_configurations(cfg)]
+        all_hosts = FFFSimulator.get_all_hosts(cfgs)
+        fff_os_operations.on_hosts(fff_os_operations.hltd_stop, all_hosts,
+                                   timeout=cfg.host_timeout)
+        fff_os_operations.on_hosts(fff_os_operations.hltd_start, all_hosts,
+                                   timeout=cfg.host_timeout)
+        # We are done with the hosts, so we close the ssh connections we
+        # kept open to them:
+        fff_os_operations.on_hosts(fff_os_operations.ssh_close, all_hosts,
+                                   timeout=cfg.host_timeout)
+
+    def status(self):
+        # Besides the default status, we show the live metrics (if the
+        # simulator is running and serving them).
+        Daemon.status(self)
+        cfg = FFFSimulator.load_configuration()
+        if not cfg.metrics_port:
+            return
+        try:
+            values = fff_metrics.fetch_metrics(cfg.metrics_port)
+        except Exception, error:
+            sys.stdout.write("Could not get the metrics: %s\n" % error)
+            return
+        sys.stdout.write(fff_metrics.format_status(values))
 
     @staticmethod
-    def load_configuration():
+    def load_configuration(configuration_file=CONFIGURATION_FILE):
+        # The configuration file can also be a list of files, each overriding
+        # the settings of the ones before (see [Simulations]).
         config = ConfigParser.RawConfigParser()
-        config.read(CONFIGURATION_FILE)
+        config.read(configuration_file)
+        config.configuration_file = configuration_file
         # We like to simplify things by promoting all settings to local
         # variables:
         config.source_run = config.get('General', 'SourceRun')
@@ -364,6 +1297,211 @@ class FFFSimulator(Daemon):
         config.ramdisk_dir = config.get('General', 'RamdiskDir')
         config.fu_data_dir = config.get('General', 'FUDataDir')
         config.fu_host_name = config.get('General', 'FUHostName')
+        # There can be multiple FUs, separated by ;
+        config.fu_host_names = [host.strip()
+                                for host in config.fu_host_name.split(';')
+                                if host.strip()]
+        config.host_timeout = FFFSimulator.get_optional(config, 'General',
+                                                        'HostTimeout', 120.)
+        # Seconds to keep the ssh connection to a host open after the last
+        # command (0 for a new connection per command):
+        config.ssh_control_persist = FFFSimulator.get_optional(config,
+                                   'General', 'SSHControlPersist', 600)
+        config.readiness_timeout = FFFSimulator.get_optional(config,
+                                   'General', 'ReadinessTimeout', 5.)
+        # More directories the runs are published to (separated by ;):
+        config.extra_targets = [target_dir.strip() for target_dir
+                                in FFFSimulator.get_optional(config,
+                                    'General', 'ExtraTargets', '').split(';')
+                                if target_dir.strip()]
+        config.cleanup_workers = FFFSimulator.get_optional(config,
+                                   'General', 'CleanupWorkers', 4)
+        config.background_cleanup = FFFSimulator.get_optional(config,
+                                   'General', 'BackgroundCleanup', False)
         config.run_key = config.get('General', 'RunKey')
         config.seconds_per_lumi = config.getfloat('General', 'SecondsPerLumi')
+        if config.seconds_per_lumi < 0:
+            logging.error('SecondsPerLumi cannot be negative, using 0 (as '
+                          'fast as possible) instead.')
+            config.seconds_per_lumi = 0.
+        # The shape of the runs:
+        config.lumis_to_skip = [int(lumi) for lumi in
+                                FFFSimulator.get_optional(config, 'General',
+                                    'LumisToSkip', '1,2,11,12,13').split(',')
+                                if lumi.strip()]
+        config.seconds_per_skipped_lumi = FFFSimulator.get_optional(config,
+                                   'General', 'SecondsPerSkippedLumi', 2.)
+        config.lumis_per_run = FFFSimulator.get_optional(config, 'General',
+                                                         'LumisPerRun', 0)
+        config.seconds_before_first_lumi = FFFSimulator.get_optional(config,
+                                   'General', 'SecondsBeforeFirstLumi', 1.)
+        config.seconds_between_runs = FFFSimulator.get_optional(config,
+                                   'General', 'SecondsBetweenRuns', 0.)
+        config.first_run_number = FFFSimulator.get_optional(config,
+                                   'General', 'FirstRunNumber', 0)
+        config.number_of_runs = FFFSimulator.get_optional(config, 'General',
+                                                          'NumberOfRuns', 0)
+        # Profiling on request (see fff_profiling):
+        config.profile_lumis = FFFSimulator.get_optional(config, 'Profiling',
+                                                         'Lumis', 10)
+        config.profile_mode = FFFSimulator.get_optional(config, 'Profiling',
+                                                        'Mode', 'cprofile')
+        if config.profile_mode not in fff_profiling.PROFILE_MODES:
+            logging.error('Unknown profiling Mode %s, using cprofile '
+                          'instead.' % config.profile_mode)
+            config.profile_mode = 'cprofile'
+        config.profile_interval = FFFSimulator.get_optional(config,
+                                   'Profiling', 'SampleInterval', 0.01)
+        config.profile_dir = FFFSimulator.get_optional(config, 'Profiling',
+                                                       'OutputDir', '')
+        # Checkpoints to resume from after a restart (see fff_checkpoint):
+        config.checkpoint_file = FFFSimulator.get_optional(config,
+                                   'General', 'CheckpointFile', '')
+        config.resume = FFFSimulator.get_optional(config, 'General', 'Resume',
+                                                  False)
+        # Stress testing:
+        config.stress_mode = FFFSimulator.get_optional(config, 'Stress',
+                                                       'StressMode', False)
+        config.target_mb_per_second = FFFSimulator.get_optional(config,
+                                   'Stress', 'TargetMBPerSecond', 0.)
+        config.report_interval = FFFSimulator.get_optional(config, 'Stress',
+                                                  'ReportInterval', 60.)
+        # Copying the source run from an alternative source dir:
+        config.staging_workers = FFFSimulator.get_optional(config, 'General',
+                                                   'StagingWorkers', 4)
+        config.staging_initial_lumis = FFFSimulator.get_optional(config,
+                                   'General', 'StagingInitialLumis', 0)
+        # The streams we simulate, in order, each with the pattern of the
+        # source files that belong to it (by default the stream name itself):
+        config.stream_specs = fff_source_index.DEFAULT_STREAM_SPECS
+        if config.has_option('Streams', 'Streams'):
+            config.stream_specs = []
+            for stream_name in config.get('Streams', 'Streams').split(','):
+                stream_name = stream_name.strip()
+                if stream_name:
+                    config.stream_specs.append((stream_name,
+                        FFFSimulator.get_optional(config, 'Streams',
+                                                  stream_name, stream_name)))
+        # Synthetic source data:
+        config.synthetic = FFFSimulator.get_optional(config, 'Synthetic',
+                                                     'Synthetic', False)
+        if config.synthetic:
+            config.synthetic_dir = FFFSimulator.get_optional(config,
+                                       'Synthetic', 'SyntheticDir',
+                                       os.path.join(config.source_dir,
+                                                    'synthetic'))
+            config.synthetic_run_number = FFFSimulator.get_optional(config,
+                                       'Synthetic', 'RunNumber', 100000)
+            config.synthetic_generation = FFFSimulator.get_optional(config,
+                                       'Synthetic', 'Generation', 'sparse')
+            config.synthetic_template_file = FFFSimulator.get_optional(config,
+                                       'Synthetic', 'TemplateFile', '')
+            config.synthetic_events_per_lumi = FFFSimulator.get_optional(
+                               config, 'Synthetic', 'EventsPerLumi', 1000)
+        # Port to serve the live metrics on (0 to not serve them):
+        config.metrics_port = FFFSimulator.get_optional(config, 'General',
+                                                        'MetricsPort', 9733)
+        # Retention of the simulated data on the ramdisk:
+        config.keep_runs = FFFSimulator.get_optional(config, 'Retention',
+                                                     'KeepRuns', 0)
+        config.keep_lumis = FFFSimulator.get_optional(config, 'Retention',
+                                                      'KeepLumis', 0)
+        config.max_bytes = FFFSimulator.get_optional(config, 'Retention',
+                                                     'MaxBytes', 0)
+        config.max_usage_percent = FFFSimulator.get_optional(config,
+                                   'Retention', 'MaxUsagePercent', 0.)
+        config.retention_interval = FFFSimulator.get_optional(config,
+                                   'Retention', 'CheckInterval', 10.)
+        config.retention_wait_for_consumption = FFFSimulator.get_optional(
+                          config, 'Retention', 'WaitForConsumption', False)
+        config.max_unconsumed_seconds = FFFSimulator.get_optional(config,
+                                   'Retention', 'MaxUnconsumedSeconds', 600.)
+        # Observing the consumption of what we publish (and backpressure):
+        config.observe_consumption = FFFSimulator.get_optional(config,
+                                   'Consumption', 'ObserveConsumption', False)
+        config.max_backlog = FFFSimulator.get_optional(config, 'Consumption',
+                                                       'MaxBacklog', 0)
+        config.backpressure_timeout = FFFSimulator.get_optional(config,
+                                   'Consumption', 'BackpressureTimeout', 0.)
+        config.emission_workers = FFFSimulator.get_optional(config,
+                                           'General', 'EmissionWorkers', 1)
+        config.lookahead_depth = FFFSimulator.get_optional(config, 'General',
+                                                           'LookaheadDepth', 0)
+        config.lookahead_max_mb = FFFSimulator.get_optional(config,
+                                   'General', 'LookaheadMaxMB', 1000.)
+        config.overrun_policy = FFFSimulator.get_optional(config, 'General',
+                                                   'OverrunPolicy', 'catchup')
+        config.atomic_publish = FFFSimulator.get_optional(config, 'General',
+                                                      'AtomicPublish', True)
+        config.fsync_mode = FFFSimulator.get_optional(config, 'General',
+                                                      'FsyncMode', 'none')
+        if config.fsync_mode not in ['none', 'data', 'all']:
+            logging.error('Unknown FsyncMode %s, using none instead.'
+                          % config.fsync_mode)
+            config.fsync_mode = 'none'
+        config.publish_mode = FFFSimulator.get_optional(config, 'General',
+                                                        'PublishMode', 'auto')
+        if config.publish_mode not in (['auto'] +
+                                       fff_os_operations.PUBLISH_MODES):
+            logging.error('Unknown PublishMode %s, using auto instead.'
+                          % config.publish_mode)
+            config.publish_mode = 'auto'
+        # Multiple simulations at the same time, each overriding this
+        # configuration with its own file (separated by ;):
+        config.simulation_files = [simulation_file.strip() for simulation_file
+                                   in FFFSimulator.get_optional(config,
+                                       'Simulations', 'Simulations',
+                                       '').split(';')
+                                   if simulation_file.strip()]
+        config.restart_delay = FFFSimulator.get_optional(config,
+                                   'Simulations', 'RestartDelay', 10.)
+        config.supervisor_report_interval = FFFSimulator.get_optional(config,
+                                   'Simulations', 'ReportInterval', 60.)
+        # Replaying the timing and sizes of a trace (none, source or csv):
+        config.replay = FFFSimulator.get_optional(config, 'Replay', 'Replay',
+                                                  'none')
+        if config.replay not in ['none'] + fff_trace.TRACE_SOURCES:
+            logging.error('Unknown Replay %s, using none instead.'
+                          % config.replay)
+            config.replay = 'none'
+        if config.replay == 'none':
+            config.replay = None
+        config.replay_trace_file = FFFSimulator.get_optional(config,
+                                   'Replay', 'TraceFile', '')
+        config.replay_time_scale = FFFSimulator.get_optional(config,
+                                   'Replay', 'TimeScale', 1.)
+        config.replay_volume_scale = FFFSimulator.get_optional(config,
+                                   'Replay', 'VolumeScale', 1.)
         return config
+
+    @staticmethod
+    def load_simulation_configurations(cfg):
+        # Gives (name, configuration) for each simulation of [Simulations].
+        # The name is the name of its configuration file.
+        simulations = []
+        for simulation_file in cfg.simulation_files:
+            name = os.path.splitext(os.path.basename(simulation_file))[0]
+            simulation_cfg = FFFSimulator.load_configuration(
+                                 [cfg.configuration_file, simulation_file])
+            # Each simulation needs a checkpoint of its own:
+            if simulation_cfg.checkpoint_file and \
+               simulation_cfg.checkpoint_file == cfg.checkpoint_file:
+                root, extension = os.path.splitext(cfg.checkpoint_file)
+                simulation_cfg.checkpoint_file = '%s_%s%s' % (root, name,
+                                                              extension)
+            simulations.append((name, simulation_cfg))
+        return simulations
+
+    @staticmethod
+    def get_optional(config, section, option, default):
+        # Newer settings are optional, so that existing configuration files
+        # keep working. The type of the default decides how we parse it.
+        if not config.has_option(section, option):
+            return default
+        if isinstance(default, bool):
+            return config.getboolean(section, option)
+        if isinstance(default, int):
+            return config.getint(section, option)
+        if isinstance(default, float):
+            return config.getfloat(section, option)
+        return config.get(section, option)
@@ -0,0 +1,209 @@
+# The source run index keeps everything we need to know about the source run
+# in memory, so that we don't have to read and parse the source .jsn files
+# again for every stream of every lumisection we simulate.
+#
+# For each source .jsn file we keep the location, size and extension of its
+# data file, together with the output json, already rendered, in which only
+# the name of the data file still needs to be filled in.
+#
+# The index remembers the state of the source run directory when it was
+# built, so that it can tell when the source run changed on disk and needs to
+# be rebuilt.
+#
+# Which source files belong to which stream is decided by the stream specs:
+# (stream name, pattern) for each stream we simulate, in order. The pattern
+# is a regular expression for the stream part of the source file names (the
+# part between the lumisection and the rest, e.g. "streamDQM" in
+# run247398_ls0001_streamDQM_mrg-c2f12-22-01.jsn). All the patterns are
+# compiled into one regular expression, so that we can sort all the files of
+# the source run into their streams in a single pass over the directory.
+#
+# The source run can also be a compressed archive instead of a directory (see
+# fff_archive). The paths of its files are then the paths they would have in
+# the run directory, the index keeps the archive open and the data files are
+# decompressed when they are published (see SourceEntry.publish_data).
+
+import os
+import re
+import json
+import logging
+import fff_archive
+import fff_os_operations
+
+# Placeholder for the data file name while pre-rendering the output json.
+DATA_FILE_PLACEHOLDER = '@@FFF_SIMULATOR_DATA_FILE@@'
+
+# The streams we simulate if nothing else is configured:
+DEFAULT_STREAM_SPECS = [('streamDQM', 'streamDQM|streamLookArea'),
+                        ('streamDQMHistograms', 'streamDQMHistograms'),
+                        ('streamDQMCalibration', 'streamDQMCalibration')]
+
+# The compiled regular expression per tuple of stream specs:
+_stream_patterns = {}
+
+def get_stream_pattern(stream_specs):
+    # The name of the group that matched tells the stream number, e.g.
+    # "stream2". The first stream that matches wins.
+    stream_specs = tuple(stream_specs)
+    if stream_specs not in _stream_patterns:
+        alternatives = ['(?P<stream%d>%s)' % (stream_number, pattern)
+                        for stream_number, (stream_name, pattern)
+                        in enumerate(stream_specs)]
+        _stream_patterns[stream_specs] = re.compile(
+                          r'_(?:%s)_.*\.jsn$' % '|'.join(alternatives))
+    return _stream_patterns[stream_specs]
+
+def scan_streams(run_path, stream_specs=DEFAULT_STREAM_SPECS):
+    # Gives, for each stream, the sorted list of its source .jsn files.
+    streams = [[] for stream_spec in stream_specs]
+    if os.path.isdir(run_path):
+        file_names = os.listdir(run_path)
+    elif fff_archive.find_archive(run_path):
+        file_names = fff_archive.list_members(
+                         fff_archive.get_archive_path(run_path))
+    else:
+        return streams
+    stream_pattern = get_stream_pattern(stream_specs)
+    for file_name in file_names:
+        match = stream_pattern.search(file_name)
+        if match:
+            streams[int(match.lastgroup[len('stream'):])].append(
+                                         os.path.join(run_path, file_name))
+    return [sorted(stream) for stream in streams]
+
+class SourceEntry(object):
+
+    def __init__(self, json_path, json_info=None, data_path=None,
+                 archive=None):
+        # Normally we read the json file, but the json info and the data file
+        # can also be given directly (e.g. for synthetic data). With an
+        # archive, both files are read from there.
+        self.json_path = json_path
+        self.json_mtime = None
+        self.archive = archive
+        if json_info is None and archive:
+            json_name = os.path.basename(json_path)
+            self.json_mtime = archive.get_mtime(json_name)
+            json_info = json.loads(archive.read(json_name))
+        elif json_info is None:
+            self.json_mtime = os.stat(json_path).st_mtime
+            with open(json_path, 'r') as json_file:
+                json_info = json.load(json_file)
+        self.data_name = json_info['data'][3]
+        self.data_path = data_path
+        if not self.data_path:
+            self.data_path = os.path.join(os.path.dirname(json_path),
+                                          self.data_name)
+        self.data_extension = os.path.splitext(self.data_name)[1]
+        if archive:
+            self.data_size = archive.get_size(self.data_name)
+        else:
+            self.data_size = os.path.getsize(self.data_path)
+        # We render the json once, with a placeholder for the data file name,
+        # and keep the parts before and after it.
+        json_info['data'][3] = DATA_FILE_PLACEHOLDER
+        rendered = json.dumps(json_info)
+        self.json_prefix, self.json_suffix = rendered.split(
+                                     json.dumps(DATA_FILE_PLACEHOLDER), 1)
+
+    def render_json(self, output_data_name):
+        # Gives exactly what json.dumps would give for the source json with
+        # the data file name replaced.
+        return self.json_prefix + json.dumps(output_data_name) + \
+               self.json_suffix
+
+    def publish_data(self, target_path, publish_mode='auto'):
+        # Writes the data file as target_path and returns the mode that was
+        # used (see fff_os_operations.publish_file). From an archive, the
+        # data file is always decompressed.
+        if self.archive:
+            self.archive.extract(self.data_name, target_path)
+            return 'decompress'
+        return fff_os_operations.publish_file(self.data_path, target_path,
+                                              publish_mode)
+
+
+class SourceStream(object):
+    # The entries of one stream, with a cursor telling which entry is used
+    # for the next lumisection. After the last entry we start over.
+
+    def __init__(self, entries):
+        self.entries = entries
+        self.position = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def next_entry(self):
+        entry = self.entries[self.position]
+        self.position = (self.position + 1) % len(self.entries)
+        return entry
+
+
+class SourceRunIndex(object):
+
+    def __init__(self, source_run, source_dir, streams):
+        # The streams are lists of source .jsn files (see
+        # FFFSimulator.get_streams).
+        self.source_run = source_run
+        self.source_dir = source_dir
+        self.streams = []
+        self.signature = None
+        self.archive = None
+        self.rebuild(streams)
+
+    def get_run_path(self):
+        return os.path.join(self.source_dir, self.source_run)
+
+    def get_signature(self):
+        # Of the run directory, or of the archive if there is only that.
+        run_path = self.get_run_path()
+        archive_path = fff_archive.find_archive(run_path)
+        run_stat = os.stat(archive_path or run_path)
+        return (archive_path, run_stat.st_mtime, run_stat.st_size)
+
+    def is_outdated(self):
+        try:
+            return self.get_signature() != self.signature
+        except OSError:
+            return True
+
+    def rebuild(self, streams):
+        # Entries for files that did not change since the last build are
+        # reused, so rebuilding a big source run is cheap. The cursors are
+        # kept where possible. A changed archive is indexed anew, since its
+        # members may have moved.
+        self.signature = self.get_signature()
+        archive_path = self.signature[0]
+        self.archive = None
+        if archive_path:
+            self.archive = fff_archive.SourceArchive(archive_path)
+        known_entries = {}
+        for stream in self.streams:
+            for entry in stream.entries:
+                if not archive_path and not entry.archive:
+                    known_entries[entry.json_path] = entry
+        new_streams = []
+        for stream_number, json_paths in enumerate(streams):
+            entries = []
+            for json_path in json_paths:
+                entry = known_entries.get(json_path)
+                try:
+                    if not entry or \
+                       entry.json_mtime != os.stat(json_path).st_mtime:
+                        entry = SourceEntry(json_path, archive=self.archive)
+                except (OSError, IOError, ValueError, KeyError,
+                        IndexError), error:
+                    logging.error('Ignoring unusable source file %s: %s'
+                                  % (json_path, error))
+                    continue
+                entries.append(entry)
+            new_stream = SourceStream(entries)
+            if stream_number < len(self.streams) and entries:
+                new_stream.position = (self.streams[stream_number].position %
+                                       len(entries))
+            new_streams.append(new_stream)
+        self.streams = new_streams
+        logging.info('Indexed %d source files of %s.'
+                     % (sum([len(stream) for stream in self.streams]),
+                        self.source_run))
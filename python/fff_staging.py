@@ -0,0 +1,161 @@
+# The run stager copies a source run from an alternative source dir (e.g. on
+# /fff/output) to the source dir (normally on the ramdisk).
+#
+# - The files are copied by multiple workers at the same time.
+# - The first lumisections are copied first (data files before their json
+#   files), so that the simulation can start as soon as the first few
+#   lumisections are there. The rest is copied in the background.
+# - Every file is copied under a temporary name and renamed when complete.
+# - A manifest in the staged run tells whether the staging is complete. If
+#   the staging was interrupted (e.g. by a reboot), the next staging only
+#   copies the files that are missing.
+
+import os
+import json
+import Queue
+import logging
+import threading
+import fff_os_operations
+
+MANIFEST_NAME = '.fff_staging_manifest.json'
+
+def is_staging_complete(run_path):
+    # Runs without a manifest were not staged by us (or staged before we had
+    # manifests), so we assume they are complete.
+    manifest_path = os.path.join(run_path, MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        return True
+    try:
+        with open(manifest_path, 'r') as manifest_file:
+            return json.load(manifest_file).get('complete', False)
+    except (IOError, ValueError):
+        return False
+
+
+class RunStager(object):
+
+    def __init__(self, run_dir, from_dir, to_dir, workers=4):
+        self.source_path = os.path.join(from_dir, run_dir)
+        self.target_path = os.path.join(to_dir, run_dir)
+        self.workers = max(workers, 1)
+        self.condition = threading.Condition()
+        self.work_queue = Queue.Queue()
+        # Files still to copy, in total and per lumisection:
+        self.pending = 0
+        self.pending_per_lumi = {}
+        self.failures = 0
+        self.copied_bytes = 0
+        self.files = {}
+
+    def start(self):
+        if not os.path.exists(self.target_path):
+            os.makedirs(self.target_path, 0755)
+        # All the files of the run, as (lumi number, is json, relative path):
+        work = []
+        for dir_path, dir_names, file_names in os.walk(self.source_path):
+            for file_name in file_names:
+                full_name = os.path.join(dir_path, file_name)
+                relative_name = os.path.relpath(full_name, self.source_path)
+                self.files[relative_name] = os.path.getsize(full_name)
+                lumi_match = fff_os_operations.LUMI_FILE_PATTERN.match(
+                                 file_name)
+                lumi_number = 0
+                if lumi_match:
+                    lumi_number = int(lumi_match.group(2))
+                work.append((lumi_number, file_name.endswith('.jsn'),
+                             relative_name))
+        self.write_manifest(False)
+        # We only copy what is not there yet:
+        work = [item for item in sorted(work) if not self.is_staged(item[2])]
+        for lumi_number, is_json, relative_name in work:
+            self.pending_per_lumi[lumi_number] = \
+                self.pending_per_lumi.get(lumi_number, 0) + 1
+            self.work_queue.put((lumi_number, relative_name))
+        self.pending = len(work)
+        logging.info('Staging %d of %d files of %s to %s with %d workers.'
+                     % (self.pending, len(self.files), self.source_path,
+                        self.target_path, self.workers))
+        if not self.pending:
+            self.write_manifest(True)
+            return
+        for worker_number in range(self.workers):
+            worker = threading.Thread(target=self.work,
+                                      name='Stager-%d' % worker_number)
+            worker.daemon = True
+            worker.start()
+
+    def is_staged(self, relative_name):
+        target = os.path.join(self.target_path, relative_name)
+        return (os.path.exists(target) and
+                os.path.getsize(target) == self.files[relative_name])
+
+    def work(self):
+        while True:
+            try:
+                lumi_number, relative_name = self.work_queue.get_nowait()
+            except Queue.Empty:
+                return
+            source = os.path.join(self.source_path, relative_name)
+            target = os.path.join(self.target_path, relative_name)
+            failed = False
+            try:
+                target_dir = os.path.dirname(target)
+                if not os.path.isdir(target_dir):
+                    try:
+                        os.makedirs(target_dir, 0755)
+                    except OSError:
+                        # Another worker might have been faster
+                        if not os.path.isdir(target_dir):
+                            raise
+                temporary_path = fff_os_operations.get_temporary_path(target)
+                fff_os_operations.publish_file(source, temporary_path)
+                fff_os_operations.commit_file(temporary_path, target)
+            except Exception, error:
+                logging.error('Could not stage %s: %s' % (source, error))
+                failed = True
+            with self.condition:
+                self.pending -= 1
+                self.pending_per_lumi[lumi_number] -= 1
+                if failed:
+                    self.failures += 1
+                else:
+                    self.copied_bytes += self.files[relative_name]
+                if not self.pending:
+                    self.finish()
+                self.condition.notify_all()
+
+    def finish(self):
+        if self.failures:
+            logging.error('Staging of %s incomplete: %d files failed. The '
+                          'next staging will retry them.' % (self.target_path,
+                                                             self.failures))
+            return
+        self.write_manifest(True)
+        logging.info('Finished staging %s (%.1f MB copied).'
+                     % (self.target_path, self.copied_bytes / 1e6))
+
+    def wait_until_ready(self, initial_lumis=0):
+        # Waits until the first initial_lumis lumisections are staged (or the
+        # whole run, with 0). Returns False if something failed on the way.
+        lumi_numbers = sorted(self.pending_per_lumi.keys())
+        if initial_lumis:
+            # Lumisection 0 holds the files that are not part of a
+            # lumisection, we always need those.
+            lumi_numbers = [lumi for lumi in lumi_numbers if lumi == 0] + \
+                           [lumi for lumi in lumi_numbers if lumi][
+                                                              :initial_lumis]
+        with self.condition:
+            while not self.failures and \
+                  [lumi for lumi in lumi_numbers
+                   if self.pending_per_lumi[lumi]]:
+                self.condition.wait(1)
+        return not self.failures
+
+    def write_manifest(self, complete):
+        manifest_path = os.path.join(self.target_path, MANIFEST_NAME)
+        temporary_path = fff_os_operations.get_temporary_path(manifest_path)
+        with open(temporary_path, 'w') as manifest_file:
+            json.dump({'source': self.source_path,
+                       'complete': complete,
+                       'files': self.files}, manifest_file)
+        fff_os_operations.commit_file(temporary_path, manifest_path)
@@ -0,0 +1,255 @@
+# The supervisor runs several independent simulations at the same time (e.g.
+# to simulate the aggregate load of multiple BUs), each in its own worker
+# process, so that they scale over the CPU cores.
+#
+# Each simulation is configured by the main configuration file, overridden by
+# its own configuration file (see [Simulations]), so it can have its own
+# source run, run numbers, ramdisk and rate. hltd is restarted and the
+# ramdisks are cleaned once, for all the simulations together.
+#
+# The workers regularly send their metrics to the supervisor, which logs a
+# summary and serves all of them together on the MetricsPort. If a worker
+# crashes, it is restarted after RestartDelay seconds, continuing with the
+# run after the last one it reported. Workers that simulated all their runs
+# (see NumberOfRuns) are not restarted.
+
+import os
+import sys
+import time
+import Queue
+import signal
+import logging
+import threading
+import multiprocessing
+import fff_logging
+import fff_metrics
+
+# Seconds between two reports of a worker to the supervisor. Frequent enough
+# that a restarted worker knows where to continue.
+WORKER_REPORT_INTERVAL = 1.
+
+class SimulationSupervisor(object):
+
+    def __init__(self, simulations, metrics_port=0, restart_delay=10.,
+                 report_interval=60.):
+        # The simulations are (name, configuration) pairs.
+        self.simulations = simulations
+        self.metrics_port = metrics_port
+        self.restart_delay = restart_delay
+        self.report_interval = report_interval
+        self.report_queue = multiprocessing.Queue()
+        self.stop_event = threading.Event()
+        # Per simulation name:
+        self.workers = {}
+        self.restart_times = {}
+        self.restarts = {}
+        self.finished = set()
+        self.metrics = AggregatedMetrics()
+
+    def run(self, simulate):
+        # Starts a worker for each simulation, which calls simulate(cfg,
+        # report), and watches them until they all finished (or we are
+        # stopped).
+        signal.signal(signal.SIGTERM, self.handle_signal)
+        signal.signal(signal.SIGHUP, self.handle_reload)
+        signal.signal(signal.SIGUSR1, self.handle_profile)
+        metrics_server = None
+        if self.metrics_port:
+            metrics_server = fff_metrics.start_metrics_server(
+                                 self.metrics, self.metrics_port)
+        for name, cfg in self.simulations:
+            self.restarts[name] = 0
+            self.start_worker(name, cfg, simulate)
+        last_report = time.time()
+        while not self.stop_event.is_set() and \
+              len(self.finished) < len(self.simulations):
+            try:
+                name, samples = self.report_queue.get(timeout=1)
+                self.metrics.update(name, samples)
+            except Queue.Empty:
+                pass
+            self.check_workers(simulate)
+            if time.time() - last_report >= self.report_interval:
+                self.log_summary()
+                last_report = time.time()
+        self.stop_workers()
+        self.log_summary()
+        if metrics_server:
+            metrics_server.shutdown()
+            metrics_server.server_close()
+
+    def start_worker(self, name, cfg, simulate):
+        worker = multiprocessing.Process(target=run_worker,
+                                         name='Simulation-%s' % name,
+                                         args=(name, cfg, simulate,
+                                               self.report_queue))
+        worker.daemon = True
+        worker.start()
+        self.workers[name] = worker
+        logging.info('Started simulation %s (pid %d).' % (name, worker.pid))
+
+    def check_workers(self, simulate):
+        for name, cfg in self.simulations:
+            if name in self.finished:
+                continue
+            worker = self.workers[name]
+            if worker.is_alive():
+                continue
+            if worker.exitcode == 0:
+                logging.info('Simulation %s finished.' % name)
+                self.finished.add(name)
+                continue
+            # Crashed: we restart it after the delay.
+            if name not in self.restart_times:
+                logging.error('Simulation %s crashed (exit code %s), '
+                              'restarting it in %.0f s.'
+                              % (name, worker.exitcode, self.restart_delay))
+                self.restart_times[name] = time.time() + self.restart_delay
+            elif time.time() >= self.restart_times[name]:
+                del self.restart_times[name]
+                # We continue after the last run we know of:
+                last_run_number = self.metrics.get_value(name, 'run_number')
+                if last_run_number:
+                    cfg.first_run_number = int(last_run_number) + 1
+                self.restarts[name] += 1
+                self.start_worker(name, cfg, simulate)
+
+    def handle_signal(self, signal_number, frame):
+        # The daemon is stopped with SIGTERM: we stop the workers with it.
+        # It is sent until we are gone, so we ignore the repeats.
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        self.stop_workers()
+        sys.exit(0)
+
+    def handle_reload(self, signal_number, frame):
+        # The workers reload their configuration themselves (see
+        # fff_reload). A worker restarted after a crash starts with the
+        # configuration it was first started with.
+        for worker in self.workers.values():
+            if worker.is_alive():
+                os.kill(worker.pid, signal.SIGHUP)
+
+    def handle_profile(self, signal_number, frame):
+        # All the workers are profiled (see fff_profiling), each writes its
+        # own profile.
+        for worker in self.workers.values():
+            if worker.is_alive():
+                os.kill(worker.pid, signal.SIGUSR1)
+
+    def stop_workers(self):
+        self.stop_event.set()
+        for worker in self.workers.values():
+            if worker.is_alive():
+                worker.terminate()
+        for worker in self.workers.values():
+            worker.join(5)
+
+    def log_summary(self):
+        for name, cfg in self.simulations:
+            logging.info('Simulation %s: %s (restarted %d times)'
+                         % (name, self.metrics.get_summary(name),
+                            self.restarts[name]))
+
+
+def run_worker(name, cfg, simulate, report_queue):
+    # In the worker process. The supervisor serves the metrics, not us
+    # (because we report them).
+    fff_logging.reinitialize_after_fork(name)
+    # The handlers of the supervisor are not ours: SIGTERM (from
+    # stop_workers) just ends the worker (writing out its log), and until
+    # the simulation installs its own handlers we ignore reload and profile
+    # requests:
+    fff_logging.exit_on_sigterm()
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+    def report(metrics):
+        # Called by the simulation once its metrics exist.
+        def send_reports():
+            while True:
+                report_queue.put((name, metrics.get_samples()))
+                time.sleep(WORKER_REPORT_INTERVAL)
+        reporter = threading.Thread(target=send_reports, name='Reporter')
+        reporter.daemon = True
+        reporter.start()
+        report.metrics = metrics
+    report.metrics = None
+    try:
+        simulate(cfg, report)
+        if report.metrics:
+            report_queue.put((name, report.metrics.get_samples()))
+            # Make sure the last report gets to the supervisor:
+            report_queue.close()
+            report_queue.join_thread()
+    except Exception:
+        logging.exception('Simulation %s failed:' % name)
+        raise
+    finally:
+        # Worker processes end without running the atexit handlers, so we
+        # write out the log ourselves.
+        logging.shutdown()
+
+
+class AggregatedMetrics(object):
+    # The latest metrics of all the simulations. Served like the metrics of a
+    # single simulation, with a simulation label. We also give the totals
+    # without the label: counters are added up, for gauges we give the
+    # maximum.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples_per_simulation = {}
+
+    def update(self, name, samples):
+        with self.lock:
+            self.samples_per_simulation[name] = samples
+
+    def get_value(self, name, metric_name, labels=''):
+        with self.lock:
+            for sample_name, metric_type, help_text, values in \
+                self.samples_per_simulation.get(name, []):
+                if sample_name == 'fff_simulator_' + metric_name:
+                    return dict(values).get(labels, 0)
+        return 0
+
+    def get_summary(self, name):
+        return ('run %d, lumisection %d, %d lumisections written, %d late, '
+                '%d dropped' % (self.get_value(name, 'run_number'),
+                                self.get_value(name, 'lumisection'),
+                                self.get_value(name, 'lumisections_total'),
+                                self.get_value(name,
+                                               'late_lumisections_total'),
+                                self.get_value(name,
+                                               'dropped_lumisections_total')))
+
+    def get_samples(self):
+        # The metrics in the order we first see them, with the totals first.
+        names = []
+        info = {}
+        totals = {}
+        per_simulation = {}
+        with self.lock:
+            for simulation_name, samples in \
+                sorted(self.samples_per_simulation.items()):
+                for name, metric_type, help_text, values in samples:
+                    if name not in info:
+                        names.append(name)
+                        info[name] = (metric_type, help_text)
+                        totals[name] = {}
+                        per_simulation[name] = []
+                    for labels, value in values:
+                        if metric_type == 'counter':
+                            totals[name][labels] = \
+                                totals[name].get(labels, 0) + value
+                        else:
+                            totals[name][labels] = \
+                                max(totals[name].get(labels, value), value)
+                        simulation_label = 'simulation="%s"' % simulation_name
+                        per_simulation[name].append((','.join(
+                            [label for label in [labels, simulation_label]
+                             if label]), value))
+        return [(name, info[name][0], info[name][1],
+                 sorted(totals[name].items()) + per_simulation[name])
+                for name in names]
+
+    def format_prometheus(self):
+        return fff_metrics.format_samples(self.get_samples())
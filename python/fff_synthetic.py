@@ -0,0 +1,131 @@
+# The synthetic source is an alternative to replaying a real source run: it
+# generates data of a configurable size and amount per stream, so that we can
+# do capacity planning without storing a huge source run.
+#
+# For each stream we generate one data file of the configured size, once, at
+# startup. All the lumisections of the stream use this file, each with its
+# own json. Since the data file is published like any other source file (see
+# PublishMode), emitting a lumisection is as cheap as with a real run.
+#
+# The data file is generated in one of these ways, from cheapest to most
+# realistic:
+# - sparse:   The file only has a size, no content. Takes no memory at all,
+#             readers get zeros.
+# - repeat:   A buffer of random bytes, repeated until the file is full.
+# - template: The content of a template file (e.g. a real streamer file),
+#             repeated until the file is full.
+#
+# Each stream is configured in [Synthetic] as "<size in MB>, <amount of
+# lumisections>[, <extension of the data file>]" (see parse_stream_spec).
+# A stream that is not configured there gets the defaults below.
+
+import os
+import mmap
+import logging
+import fff_os_operations
+from fff_source_index import SourceEntry, SourceStream
+
+GENERATION_MODES = ['sparse', 'repeat', 'template']
+
+# For a stream without (part of) a spec:
+DEFAULT_FILE_SIZE_MB = 1.
+DEFAULT_LUMI_AMOUNT = 100
+DEFAULT_DATA_EXTENSION = '.dat'
+
+class SyntheticSource(object):
+
+    def __init__(self, synthetic_dir, run_number, stream_specs,
+                 generation='sparse', template_file='', events_per_lumi=1000):
+        # The stream specs are (stream name, file size in bytes, amount of
+        # lumisections, extension of the data file) for each stream, in the
+        # order of the streams (see parse_stream_spec).
+        self.synthetic_dir = synthetic_dir
+        self.run_number = run_number
+        self.source_run = 'run%d' % run_number
+        if generation not in GENERATION_MODES:
+            logging.error('Unknown synthetic generation %s, using sparse '
+                          'instead.' % generation)
+            generation = 'sparse'
+        if generation == 'template' and not template_file:
+            logging.error('No template file for synthetic generation, using '
+                          'repeat instead.')
+            generation = 'repeat'
+        if not os.path.exists(synthetic_dir):
+            os.makedirs(synthetic_dir, 0755)
+        self.streams = []
+        for stream_name, file_size, lumi_amount, extension in stream_specs:
+            data_name = '%s_ls0000_%s_Synthetic%s' % (self.source_run,
+                                                      stream_name, extension)
+            data_path = os.path.join(synthetic_dir, data_name)
+            generate_data_file(data_path, file_size, generation,
+                               template_file)
+            entries = []
+            for lumi_number in range(1, lumi_amount + 1):
+                json_info = {'data': [str(events_per_lumi),
+                                      str(events_per_lumi), '0', data_name,
+                                      str(file_size), '0', '-1', '0']}
+                json_path = os.path.join(synthetic_dir, '%s_ls%04d_%s.jsn'
+                                         % (self.source_run, lumi_number,
+                                            stream_name))
+                entries.append(SourceEntry(json_path, json_info, data_path))
+            self.streams.append(SourceStream(entries))
+            logging.info('Generated synthetic %s: %d lumisections of %d '
+                         'bytes (%s).' % (stream_name, lumi_amount, file_size,
+                                          generation))
+
+    def is_outdated(self):
+        # Nobody changes the synthetic data behind our back.
+        return False
+
+
+def parse_stream_spec(stream_name, spec=None):
+    # Gives the stream spec (see SyntheticSource) from its configuration,
+    # "<size in MB>, <amount of lumisections>[, <extension>]". Whatever is
+    # missing (or the whole spec, if None) gets the default.
+    values = [value.strip() for value in (spec or '').split(',')]
+    try:
+        file_size = float(values[0] or DEFAULT_FILE_SIZE_MB)
+        lumi_amount = DEFAULT_LUMI_AMOUNT
+        if len(values) > 1 and values[1]:
+            lumi_amount = int(values[1])
+    except ValueError:
+        logging.error('Invalid synthetic spec "%s" of %s, using the '
+                      'defaults instead.' % (spec, stream_name))
+        file_size, lumi_amount = DEFAULT_FILE_SIZE_MB, DEFAULT_LUMI_AMOUNT
+    extension = DEFAULT_DATA_EXTENSION
+    if len(values) > 2 and values[2]:
+        extension = values[2]
+        if not extension.startswith('.'):
+            extension = '.' + extension
+    return stream_name, int(file_size * 1e6), lumi_amount, extension
+
+def generate_data_file(data_path, file_size, generation, template_file=''):
+    # We generate into a new file and rename it, so that files published from
+    # an earlier generation (hardlinks) are never overwritten.
+    temporary_path = fff_os_operations.get_temporary_path(data_path)
+    with open(temporary_path, 'wb') as data_file:
+        if generation == 'sparse':
+            data_file.truncate(file_size)
+        elif generation == 'repeat':
+            _write_repeated(data_file, os.urandom(min(file_size, 1 << 20)),
+                            file_size)
+        else:
+            with open(template_file, 'rb') as template:
+                template_size = os.fstat(template.fileno()).st_size
+                if not template_size:
+                    raise Exception('Template file %s is empty.'
+                                    % template_file)
+                template_map = mmap.mmap(template.fileno(), 0,
+                                         access=mmap.ACCESS_READ)
+                try:
+                    _write_repeated(data_file, template_map, file_size)
+                finally:
+                    template_map.close()
+    fff_os_operations.commit_file(temporary_path, data_path)
+
+def _write_repeated(data_file, content, file_size):
+    remaining = file_size
+    while remaining > 0:
+        chunk = content[:min(remaining, len(content))]
+        data_file.write(chunk)
+        remaining -= len(chunk)
@@ -0,0 +1,207 @@
+# Trace-driven replay: instead of writing every stream at a constant rate,
+# we replay how the lumisections of a real run came in, with their real
+# timing and sizes.
+#
+# The trace gives, per lumisection, how long it lasted and how many data
+# bytes each stream had. It comes from one of:
+# - source: The source run itself. The sizes are those of its data files,
+#           the timing comes from the modification times of its json files
+#           (when the DAQ wrote them). If those carry no timing (e.g. they
+#           were all copied at once), every lumisection lasts SecondsPerLumi.
+#           Lumisections without any source file are not in the trace, their
+#           time is part of the lumisection before them.
+# - csv:    A CSV file with a header line "lumi,seconds,<stream>,..." and one
+#           line per lumisection with its duration and, per stream, the data
+#           bytes (empty for no file). Streams that are not in the file have
+#           no files.
+#
+# When replaying, the durations are multiplied by the TimeScale and the
+# volumes by the VolumeScale. A stream publishes the source files of the
+# lumisection (or, if the source has none for that lumisection, the next
+# file of the stream), as many times as needed to get closest to its volume.
+# What is left over (e.g. 2.5 copies asked, 2 written) is carried over to
+# the next lumisection, so that the total volume matches the trace. Copies of
+# a file in the same lumisection get their own names.
+#
+# We keep track of how closely the replay matches the trace: the volume
+# written against the volume in the trace, and how far behind the trace
+# timing we published (the lateness of the scheduler).
+
+import os
+import csv
+import logging
+from fff_os_operations import LUMI_FILE_PATTERN
+
+TRACE_SOURCES = ['source', 'csv']
+
+class TraceLumi(object):
+
+    def __init__(self, lumi_number, seconds, stream_bytes):
+        # Per stream number, the data bytes in the trace (None for no file).
+        self.lumi_number = lumi_number
+        self.seconds = seconds
+        self.stream_bytes = stream_bytes
+
+    def has_files(self):
+        return any([value is not None for value in self.stream_bytes])
+
+
+def get_lumi_number(entry):
+    # The lumisection of a source entry, from its json file name.
+    match = LUMI_FILE_PATTERN.match(os.path.basename(entry.json_path))
+    if match:
+        return int(match.group(2))
+    return 0
+
+def build_source_trace(streams, seconds_per_lumi):
+    # The trace of the source run, from its index (see fff_source_index).
+    stream_bytes = {}
+    json_times = {}
+    for stream_number, stream in enumerate(streams):
+        for entry in stream.entries:
+            lumi_number = get_lumi_number(entry)
+            if not lumi_number:
+                continue
+            values = stream_bytes.setdefault(lumi_number,
+                                             [None] * len(streams))
+            values[stream_number] = (values[stream_number] or 0) + \
+                                    entry.data_size
+            if entry.json_mtime is not None:
+                json_times[lumi_number] = min(json_times.get(lumi_number,
+                                                             entry.json_mtime),
+                                              entry.json_mtime)
+    lumi_numbers = sorted(stream_bytes.keys())
+    durations = [seconds_per_lumi] * len(lumi_numbers)
+    if len(json_times) == len(lumi_numbers) and len(lumi_numbers) > 1 and \
+       json_times[lumi_numbers[-1]] > json_times[lumi_numbers[0]]:
+        # Each lumisection lasts until the next one came in. We cannot know
+        # that for the last one, so it gets the average.
+        durations = [max(json_times[next_lumi] - json_times[lumi], 0.)
+                     for lumi, next_lumi in zip(lumi_numbers,
+                                                lumi_numbers[1:])]
+        durations.append(sum(durations) / len(durations))
+    else:
+        logging.info('The source files carry no timing, replaying every '
+                     'lumisection in %.1f s.' % seconds_per_lumi)
+    return [TraceLumi(lumi_number, seconds, stream_bytes[lumi_number])
+            for lumi_number, seconds in zip(lumi_numbers, durations)]
+
+def load_csv_trace(trace_file, stream_names):
+    # The trace of a CSV file (see above).
+    trace = []
+    with open(trace_file, 'rb') as csv_file:
+        reader = csv.reader(csv_file)
+        header = [column.strip() for column in reader.next()]
+        if header[:2] != ['lumi', 'seconds']:
+            raise Exception('Trace %s does not start with lumi,seconds.'
+                            % trace_file)
+        for stream_name in header[2:]:
+            if stream_name not in stream_names:
+                logging.warning('Ignoring stream %s of trace %s, we do not '
+                                'simulate it.' % (stream_name, trace_file))
+        for row in reader:
+            if not row or not row[0].strip():
+                continue
+            values = dict(zip(header, [value.strip() for value in row]))
+            stream_bytes = [None] * len(stream_names)
+            for stream_number, stream_name in enumerate(stream_names):
+                if values.get(stream_name):
+                    stream_bytes[stream_number] = \
+                        int(float(values[stream_name]))
+            trace.append(TraceLumi(int(values['lumi']),
+                                   float(values['seconds']), stream_bytes))
+    trace.sort(key=lambda trace_lumi: trace_lumi.lumi_number)
+    logging.info('Loaded trace of %d lumisections from %s.'
+                 % (len(trace), trace_file))
+    return trace
+
+
+class TraceReplay(object):
+
+    def __init__(self, trace, streams, time_scale=1., volume_scale=1.):
+        self.time_scale = time_scale
+        self.volume_scale = volume_scale
+        self.lumis = {}
+        self.last_lumi_number = 0
+        self.streams = []
+        self.stream_lumis = []
+        self.update(trace, streams)
+        # Per stream, the volume we still owe the trace:
+        self.carry = [0.] * len(streams)
+        # Fidelity bookkeeping:
+        self.replayed_lumis = 0
+        self.target_bytes = 0
+        self.written_bytes = 0
+        self.total_volume_error = 0.
+        self.total_lateness = 0.
+        self.max_lateness = 0.
+
+    def update(self, trace, streams):
+        # Called when the source index was rebuilt (and the trace with it).
+        self.lumis = dict([(trace_lumi.lumi_number, trace_lumi)
+                           for trace_lumi in trace])
+        self.last_lumi_number = max(self.lumis.keys() or [0])
+        self.streams = streams
+        # Per stream, the source entries of each lumisection:
+        self.stream_lumis = []
+        for stream in streams:
+            entries_per_lumi = {}
+            for entry in stream.entries:
+                entries_per_lumi.setdefault(get_lumi_number(entry),
+                                            []).append(entry)
+            self.stream_lumis.append(entries_per_lumi)
+
+    def get_lumi_amount(self):
+        return self.last_lumi_number
+
+    def get_lumi(self, lumi_number):
+        # The trace lumisection, or None if the trace does not have it.
+        return self.lumis.get(lumi_number)
+
+    def get_seconds(self, trace_lumi):
+        return trace_lumi.seconds * self.time_scale
+
+    def plan_lumi(self, trace_lumi):
+        # Gives, per stream, the source entries to publish for the trace
+        # lumisection.
+        entries_per_stream = []
+        for stream_number, stream in enumerate(self.streams):
+            trace_bytes = trace_lumi.stream_bytes[stream_number]
+            if trace_bytes is None or not len(stream):
+                entries_per_stream.append([])
+                continue
+            entries = self.stream_lumis[stream_number].get(
+                          trace_lumi.lumi_number) or [stream.next_entry()]
+            entries_size = sum([entry.data_size for entry in entries])
+            if not entries_size:
+                entries_per_stream.append(entries)
+                continue
+            wanted = self.carry[stream_number] + \
+                     trace_bytes * self.volume_scale
+            copies = int(wanted / entries_size + 0.5)
+            self.carry[stream_number] = wanted - copies * entries_size
+            entries_per_stream.append(entries * copies)
+        return entries_per_stream
+
+    def record_lumi(self, trace_lumi, bytes_written, lateness):
+        target_bytes = sum([value for value in trace_lumi.stream_bytes
+                            if value]) * self.volume_scale
+        self.replayed_lumis += 1
+        self.target_bytes += target_bytes
+        self.written_bytes += bytes_written
+        if target_bytes:
+            self.total_volume_error += abs(bytes_written - target_bytes) / \
+                                       target_bytes
+        self.total_lateness += lateness
+        self.max_lateness = max(self.max_lateness, lateness)
+
+    def get_summary(self):
+        lumis = max(self.replayed_lumis, 1)
+        return ('%d lumisections, %.1f MB of %.1f MB in the trace (%.1f%%), '
+                'mean volume error %.1f%% per lumisection, behind the trace '
+                'timing %.3f s on average, %.3f s at most'
+                % (self.replayed_lumis, self.written_bytes / 1e6,
+                   self.target_bytes / 1e6,
+                   100. * self.written_bytes / max(self.target_bytes, 1),
+                   100. * self.total_volume_error / lumis,
+                   self.total_lateness / lumis, self.max_lateness))